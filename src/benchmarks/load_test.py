@@ -0,0 +1,403 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import json
+import time
+import httpx
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+from os import path
+from typing import Dict, List, Tuple
+from data.database import Database, ConnectionPool
+from data.embedding_store import EmbeddingStore
+from models.matching import ListingSimilarity
+from web_service.response_cache import ResponseCache
+from benchmarks.synthetic import make_synthetic_database
+from benchmarks.run_benchmarks import BENCHMARKS_DIR, git_commit
+
+# relative weight of each route in the default request mix
+DEFAULT_MIX = {'listings': 1, 'listing': 5, 'similar': 4}
+LISTINGS_PAGE_SIZE = 10
+
+
+def configure_app(data_dir: str) -> 'FastAPI':
+    """ points the web service at the database and embedding store of `data_dir`
+        (see `make_synthetic_database`) and returns its app
+    """
+    from web_service import api
+
+    db_path = path.join(data_dir, 'airbnb.db')
+    api.pool = ConnectionPool(db_path)
+    api.cache = ResponseCache(db_name=db_path)
+    api.matcher = ListingSimilarity(
+        db=Database(db_path),
+        store=EmbeddingStore(path.join(data_dir, 'embeddings.npy'), path.join(data_dir, 'embedding_ids.npy'))
+    )
+    return api.app
+
+
+class Workload:
+    """ A random sequence of requests of a weighted mix of routes. Listing ids (and pages of
+        `/listings`) follow a Zipfian distribution, so a few popular listings get most requests.
+    """
+    def __init__(
+        self,
+        ids: List[int],
+        mix: Dict[str, float]=None,
+        zipf_s: float=1.1,
+        seed: int=0
+    ) -> None:
+        """ initializes a workload
+
+        Args:
+            ids (List[int]): ids of the listings of the database
+            mix (Dict[str, float], optional): relative weight of each route (`listings`, `listing`
+                and `similar`). Defaults to DEFAULT_MIX.
+            zipf_s (float, optional): exponent of the Zipfian distribution, higher is more skewed. Defaults to 1.1.
+            seed (int, optional): random seed. Defaults to 0.
+        """
+        mix = mix if mix else DEFAULT_MIX
+        self.rng = np.random.default_rng(seed)
+        self.routes = list(mix)
+        weights = np.array([mix[route] for route in self.routes], dtype=np.float64)
+        self.route_cdf = np.cumsum(weights / weights.sum())
+
+        # popularity rank of each listing is random
+        self.ids = self.rng.permutation(np.asarray(ids))
+        self.id_cdf = self.__zipf_cdf(len(self.ids), zipf_s)
+        self.page_cdf = self.__zipf_cdf(max(len(self.ids) // LISTINGS_PAGE_SIZE, 1), zipf_s)
+
+    @staticmethod
+    def __zipf_cdf(n: int, s: float) -> np.ndarray:
+        weights = 1 / np.arange(1, n + 1) ** s
+        return np.cumsum(weights / weights.sum())
+
+    def __sample(self, cdf: np.ndarray) -> int:
+        return min(int(np.searchsorted(cdf, self.rng.random())), len(cdf) - 1)
+
+    def next(self) -> Tuple[str, str]:
+        """ returns the route and the url of the next request """
+        route = self.routes[self.__sample(self.route_cdf)]
+        if route == 'listings':
+            return route, f'/listings?skip={self.__sample(self.page_cdf) * LISTINGS_PAGE_SIZE}&limit={LISTINGS_PAGE_SIZE}'
+
+        listing_id = self.ids[self.__sample(self.id_cdf)]
+        if route == 'listing':
+            return route, f'/listings/{listing_id}'
+        return route, f'/listings/{listing_id}/similar'
+
+
+def latency_stats(
+    latencies: List[float],
+    errors: int,
+    duration: float
+) -> Dict:
+    """ summarizes the latencies (in seconds) of the requests of a route
+
+    Returns:
+        Dict: number of requests, throughput, error rate and latency percentiles in ms
+    """
+    latencies = np.array(latencies) * 1000
+    count = len(latencies)
+    if not count:
+        return {'requests': 0, 'errors': 0}
+    return {
+        'requests': count,
+        'errors': errors,
+        'error_rate': errors / count,
+        'throughput_rps': count / duration,
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+    }
+
+
+async def run_level(
+    client: httpx.AsyncClient,
+    workload: Workload,
+    concurrency: int,
+    duration: float,
+    warmup: float=0.
+) -> Dict:
+    """ sends requests of the workload from `concurrency` concurrent users for `duration` seconds.
+        Every user sends its next request as soon as it gets a response (closed loop).
+
+    Args:
+        client (httpx.AsyncClient): client of the web service
+        workload (Workload): requests to send
+        concurrency (int): number of concurrent users
+        duration (float): seconds of the measured run
+        warmup (float, optional): seconds of unmeasured requests before the run. Defaults to 0.
+
+    Returns:
+        Dict: stats of each route (see `latency_stats`), of all routes and status codes of the errors
+    """
+    latencies = {route: [] for route in workload.routes}
+    errors = {route: 0 for route in workload.routes}
+    error_codes = {}
+    start = time.perf_counter()
+    measure_from = start + warmup
+    end = measure_from + duration
+
+    async def user() -> None:
+        while time.perf_counter() < end:
+            route, url = workload.next()
+            sent = time.perf_counter()
+            try:
+                status_code = (await client.get(url)).status_code
+            except httpx.HTTPError as e:
+                status_code = type(e).__name__
+            received = time.perf_counter()
+            if sent < measure_from:
+                continue
+
+            latencies[route].append(received - sent)
+            if not isinstance(status_code, int) or status_code >= 400:
+                errors[route] += 1
+                error_codes[str(status_code)] = error_codes.get(str(status_code), 0) + 1
+
+    await asyncio.gather(*[user() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - measure_from
+
+    return {
+        'concurrency': concurrency,
+        'duration_s': elapsed,
+        'total': latency_stats(sum(latencies.values(), []), sum(errors.values()), elapsed),
+        'routes': {route: latency_stats(latencies[route], errors[route], elapsed) for route in workload.routes},
+        'error_codes': error_codes,
+    }
+
+
+async def run_load_test(
+    base_url: str,
+    transport: httpx.AsyncBaseTransport,
+    workload: Workload,
+    concurrency_levels: List[int],
+    duration: float,
+    warmup: float,
+    timeout: float=30.
+) -> List[Dict]:
+    """ runs the workload at each concurrency level, one after the other. The response cache
+        of the web service is kept warm across levels, as in production.
+
+    Returns:
+        List[Dict]: results of each level (see `run_level`), with the server side stats
+    """
+    levels = []
+    async with httpx.AsyncClient(base_url=base_url, transport=transport, timeout=timeout,
+                                 limits=httpx.Limits(max_connections=max(concurrency_levels))) as client:
+        for concurrency in concurrency_levels:
+            print(f'{concurrency} concurrent users...')
+            level = await run_level(client, workload, concurrency, duration, warmup)
+            level['server'] = {
+                'db': (await client.get('/stats/db')).json(),
+                'cache': (await client.get('/stats/cache')).json(),
+                'matcher': (await client.get('/stats/matcher')).json(),
+            }
+            levels.append(level)
+    return levels
+
+
+def serve(
+    data_dir: str,
+    port: int
+) -> None:
+    """ runs the web service on localhost with uvicorn, on the database of `data_dir` """
+    import uvicorn
+    uvicorn.run(configure_app(data_dir), host='127.0.0.1', port=port, log_level='warning')
+
+
+def wait_for_server(
+    base_url: str,
+    process: subprocess.Popen,
+    timeout: float=120.
+) -> None:
+    """ waits for the web service to accept requests
+
+    Raises:
+        RuntimeError: if the server exits or is not up after `timeout` seconds
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'the server exited with code {process.returncode}')
+        try:
+            if httpx.get(f'{base_url}/stats/db', timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'the server did not start within {timeout}s')
+
+
+def load_test(
+    n: int=10000,
+    concurrency_levels: List[int]=None,
+    duration: float=10.,
+    warmup: float=2.,
+    mix: Dict[str, float]=None,
+    zipf_s: float=1.1,
+    mode: str='uvicorn',
+    port: int=8999,
+    data_dir: str=None,
+    seed: int=0
+) -> Dict:
+    """ load tests the web service on a synthetic database
+
+    Args:
+        n (int, optional): number of listings of the synthetic database. Defaults to 10000.
+        concurrency_levels (List[int], optional): numbers of concurrent users. Defaults to [1, 8, 32, 64].
+        duration (float, optional): measured seconds per level. Defaults to 10.
+        warmup (float, optional): unmeasured seconds per level. Defaults to 2.
+        mix (Dict[str, float], optional): relative weight of each route. Defaults to DEFAULT_MIX.
+        zipf_s (float, optional): exponent of the Zipfian id distribution. Defaults to 1.1.
+        mode (str, optional): `uvicorn` to serve the app in a separate process on localhost, or
+            `inprocess` to call it through its ASGI interface, without network. Defaults to 'uvicorn'.
+        port (int, optional): port of the uvicorn server. Defaults to 8999.
+        data_dir (str, optional): directory of the synthetic database, reused if it exists.
+            Defaults to None (a temporary directory).
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        Dict: run metadata and results of each concurrency level
+    """
+    assert mode in ['uvicorn', 'inprocess'], '`mode` must be `uvicorn` or `inprocess`'
+    concurrency_levels = concurrency_levels if concurrency_levels else [1, 8, 32, 64]
+
+    tmp_dir = None
+    if not data_dir:
+        data_dir = tmp_dir = tempfile.mkdtemp(prefix='load-test-')
+    if not path.exists(path.join(data_dir, 'airbnb.db')):
+        print(f'Building a synthetic database of {n} listings in {data_dir}...')
+        os.makedirs(data_dir, exist_ok=True)
+        make_synthetic_database(data_dir, n, seed)
+
+    db = Database(path.join(data_dir, 'airbnb.db'), read_only=True)
+    ids = [row['id'] for row in db.fetch_all('SELECT id FROM listing')]
+    db.close()
+    workload = Workload(ids, mix, zipf_s, seed)
+
+    process, api = None, None
+    try:
+        if mode == 'uvicorn':
+            base_url, transport = f'http://127.0.0.1:{port}', None
+            process = subprocess.Popen(
+                [sys.executable, path.abspath(__file__), '--serve', '--data-dir', data_dir, '--port', str(port)],
+                cwd=path.dirname(path.abspath(__file__))
+            )
+            wait_for_server(base_url, process)
+        else:
+            from web_service import api
+            base_url, transport = 'http://testserver', httpx.ASGITransport(app=configure_app(data_dir))
+            # lifespan events are not sent by the ASGI transport
+            api.build_similarity_index()
+
+        levels = asyncio.run(run_load_test(base_url, transport, workload, concurrency_levels, duration, warmup))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if api is not None:
+            api.close_connections()
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            **git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'params': {
+                'n': len(ids), 'mode': mode, 'duration': duration, 'warmup': warmup,
+                'mix': mix if mix else DEFAULT_MIX, 'zipf_s': zipf_s, 'seed': seed
+            },
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+        },
+        'levels': levels,
+    }
+
+
+def compare_results(
+    baseline: Dict,
+    report: Dict
+) -> None:
+    """ prints the throughput and p99 latency of each level of a report relative to a baseline report """
+    print(f'Compared to {baseline["meta"]["commit"]} ({baseline["meta"]["timestamp"]}):')
+    baseline_levels = {level['concurrency']: level for level in baseline['levels']}
+    for level in report['levels']:
+        if level['concurrency'] not in baseline_levels:
+            continue
+        baseline_level = baseline_levels[level['concurrency']]
+        baseline_routes = {'total': baseline_level['total'], **baseline_level['routes']}
+        for route, stats in [('total', level['total']), *level['routes'].items()]:
+            before = baseline_routes.get(route, None)
+            if not before or not before['requests'] or not stats['requests']:
+                continue
+            print((f'{level["concurrency"]:>4} users {route:>8}: '
+                   f'{before["throughput_rps"]:>8.0f} -> {stats["throughput_rps"]:>8.0f} req/s '
+                   f'({stats["throughput_rps"] / before["throughput_rps"]:.2f}x), '
+                   f'p99 {before["p99_ms"]:>8.1f} -> {stats["p99_ms"]:>8.1f} ms ({stats["p99_ms"] / before["p99_ms"]:.2f}x)'))
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """ parses a request mix such as `listings=1,listing=5,similar=4` """
+    weights = dict(item.split('=') for item in mix.split(','))
+    unknown = set(weights) - set(DEFAULT_MIX)
+    if unknown:
+        raise ValueError(f'unknown routes {unknown}, routes are {list(DEFAULT_MIX)}')
+    return {route: float(weight) for route, weight in weights.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the web service on a synthetic database')
+    parser.add_argument('--n', type=int, default=10000, help='number of listings of the synthetic database')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64], help='numbers of concurrent users')
+    parser.add_argument('--duration', type=float, default=10., help='measured seconds per concurrency level')
+    parser.add_argument('--warmup', type=float, default=2., help='unmeasured seconds per concurrency level')
+    parser.add_argument('--mix', type=parse_mix, default=None, help='route weights, e.g. listings=1,listing=5,similar=4')
+    parser.add_argument('--zipf-s', type=float, default=1.1, help='exponent of the Zipfian id distribution')
+    parser.add_argument('--mode', choices=['uvicorn', 'inprocess'], default='uvicorn')
+    parser.add_argument('--port', type=int, default=8999)
+    parser.add_argument('--data-dir', default=None, help='directory of the synthetic database, reused if it exists')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='output json. Defaults to artifacts/benchmarks/load-<timestamp>-<commit>.json')
+    parser.add_argument('--compare', default=None, help='json of a previous run to compare with')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.data_dir, args.port)
+        sys.exit(0)
+
+    report = load_test(
+        args.n, args.concurrency, args.duration, args.warmup, args.mix, args.zipf_s,
+        args.mode, args.port, args.data_dir, args.seed
+    )
+
+    out = args.out
+    if not out:
+        if not path.exists(BENCHMARKS_DIR):
+            os.makedirs(BENCHMARKS_DIR)
+        out = path.join(BENCHMARKS_DIR, f'load-{time.strftime("%Y%m%d-%H%M%S")}-{report["meta"]["commit"] or "unknown"}.json')
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for level in report['levels']:
+        for route, stats in [('total', level['total']), *level['routes'].items()]:
+            if not stats['requests']:
+                continue
+            print((f'{level["concurrency"]:>4} users {route:>8}: {stats["throughput_rps"]:>8.0f} req/s, '
+                   f'p50 {stats["p50_ms"]:>7.1f} ms, p99 {stats["p99_ms"]:>7.1f} ms, {stats["error_rate"]:.2%} errors'))
+    print(f'Results written to {out}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare_results(json.load(f), report)
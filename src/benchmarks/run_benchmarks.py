@@ -0,0 +1,286 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import json
+import time
+import torch
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+from os import path
+import project_config as pc
+from typing import Callable, Dict, List
+from data import utils as du
+from data.database import Database, db_setup, listing_location_setup
+from data.embedding_store import encode_embedding
+from data.make_dataset import (
+    apply_heuristic_filters, top_k_similar, filter_by_distance, distance_mask,
+    similar_listing_rows, populate_db, populate_similar_listings
+)
+from models.listing import Listing
+from models.matching import ListingSimilarity
+from models.listing_embedding import ListingEmbedder
+from benchmarks.synthetic import synthetic_raw_listings, synthetic_embeddings
+from benchmarks.tiny_model import TinyListingEmbedder
+
+BENCHMARKS_DIR = path.join(pc.BASE_ARTIFACTS_DIR, 'benchmarks')
+
+BENCHMARKS = [
+    'load_listings', 'construct_summaries', 'apply_heuristic_filters', 'top_k_similar',
+    'filter_by_distance', 'distance_mask', 'populate_db', 'retrieve', 'embedder'
+]
+
+
+def timed(
+    fn: Callable,
+    repeat: int=3,
+    items: int=None
+) -> Dict:
+    """ calls `fn` `repeat` times and summarizes its wall time
+
+    Args:
+        fn (Callable): function to time, called without arguments
+        repeat (int, optional): number of calls. Defaults to 3.
+        items (int, optional): number of items processed per call, to report a throughput. Defaults to None.
+
+    Returns:
+        Dict: min, median, p95 and mean time per call in ms, and items per second of the fastest call
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+
+    result = {
+        'repeat': repeat,
+        'min_ms': float(times.min()),
+        'median_ms': float(np.median(times)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'mean_ms': float(times.mean()),
+    }
+    if items:
+        result['items'] = items
+        result['items_per_sec'] = items / (times.min() / 1000)
+    return result
+
+
+def git_commit() -> Dict:
+    """ returns the commit of the working tree and whether it has uncommitted changes """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], text=True).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': dirty}
+
+
+def run_benchmarks(
+    n: int=10000,
+    dim: int=1024,
+    dense_n: int=2000,
+    embed_n: int=1000,
+    num_calls: int=200,
+    repeat: int=3,
+    seed: int=0,
+    only: List[str]=None
+) -> Dict:
+    """ times the hot paths of the precompute and of the web service on synthetic listings
+        (see `synthetic_raw_listings` and `synthetic_embeddings`)
+
+    Args:
+        n (int, optional): number of listings. Defaults to 10000.
+        dim (int, optional): embedding size. Defaults to 1024.
+        dense_n (int, optional): number of listings of the benchmarks building (n, n) matrices. Defaults to 2000.
+        embed_n (int, optional): number of listings embedded with the tiny model. Defaults to 1000.
+        num_calls (int, optional): number of calls of each `Listing.retrieve_*` benchmark. Defaults to 200.
+        repeat (int, optional): number of runs of the other benchmarks. Defaults to 3.
+        seed (int, optional): random seed. Defaults to 0.
+        only (List[str], optional): benchmarks to run, among `BENCHMARKS`. Defaults to None (all).
+
+    Returns:
+        Dict: run metadata and results of each benchmark
+    """
+    only = only or BENCHMARKS
+    rng = np.random.default_rng(seed)
+    work_dir = tempfile.mkdtemp(prefix='benchmarks-')
+    results = {}
+
+    print(f'Generating {n} synthetic listings...')
+    raw_df = synthetic_raw_listings(n, seed)
+    df = du.clean_listings(raw_df).reset_index(drop=True)
+    embeddings = synthetic_embeddings(n, dim, seed=seed)
+
+    try:
+        if 'load_listings' in only:
+            print('load_listings...')
+            raw_path = path.join(work_dir, 'listings.csv.gz')
+            raw_df.to_csv(raw_path, index=False)
+            results['load_listings'] = timed(lambda: du.load_listings(raw_path, verbose=False), repeat, n)
+
+        if 'construct_summaries' in only:
+            print('construct_summaries...')
+            results['construct_summaries'] = timed(lambda: ListingEmbedder.construct_summaries(df), repeat, n)
+
+        if 'apply_heuristic_filters' in only:
+            print('apply_heuristic_filters...')
+            dense_df = df.iloc[:dense_n].copy()
+            scores = embeddings[:dense_n] @ embeddings[:dense_n].T
+            results['apply_heuristic_filters'] = timed(lambda: apply_heuristic_filters(scores.copy(), dense_df), repeat, len(dense_df))
+
+        top_k = {}
+        if any(name in only for name in ['top_k_similar', 'filter_by_distance', 'distance_mask', 'retrieve']):
+            # the candidates are reused by the distance and database benchmarks, so they run only once
+            print('top_k_similar...')
+            result = timed(lambda: top_k.update(zip(['indices', 'scores'], top_k_similar(embeddings, df, 10 * ListingSimilarity.TOP_N))), 1, n)
+            if 'top_k_similar' in only:
+                results['top_k_similar'] = result
+        top_indices, top_scores = top_k.get('indices', None), top_k.get('scores', None)
+
+        if 'filter_by_distance' in only:
+            print('filter_by_distance...')
+            rows = rng.choice(n, min(n, num_calls), replace=False)
+
+            def filter_rows():
+                for i in rows:
+                    candidates = top_indices[i][top_indices[i] >= 0]
+                    filter_by_distance(df.iloc[i], df.iloc[candidates])
+            results['filter_by_distance'] = timed(filter_rows, repeat, len(rows))
+
+        if 'distance_mask' in only:
+            print('distance_mask...')
+            results['distance_mask'] = timed(lambda: distance_mask(top_indices, df), repeat, n)
+
+        if any(name in only for name in ['populate_db', 'retrieve']):
+            print('populate_db...')
+            db_path = path.join(work_dir, 'airbnb.db')
+            db_df = df.copy()
+            db_df['embedding'] = [encode_embedding(embedding) for embedding in embeddings]
+            db_df['log_price'] = du.log_price(db_df.price.to_numpy(dtype=np.float64))
+
+            def populate():
+                for suffix in ['', '-journal']:
+                    if path.exists(db_path + suffix):
+                        os.remove(db_path + suffix)
+                db_setup(create_indexes=False, db_name=db_path)
+                db = Database(db_path)
+                populate_db(db_df, db)
+                db.close()
+            results['populate_db'] = timed(populate, repeat, n)
+
+            db = Database(db_path)
+            populate_similar_listings(similar_listing_rows(top_indices, top_scores, df), db)
+            listing_location_setup(db)
+            db.close()
+
+        if 'retrieve' in only:
+            print('Listing.retrieve_*...')
+            db = Database(db_path, read_only=True)
+            ids = df.id.to_numpy()
+            sorted_ids = np.sort(ids)
+            locations = df[['latitude', 'longitude']].to_numpy()
+            log_prices = du.log_price(df.price.to_numpy(dtype=np.float64))
+            room_types = sorted(df.room_type.unique())
+            columns = Listing.ITEM_COLUMNS
+
+            def calls(fn: Callable) -> Callable:
+                """ calls `fn` with a new random listing position on every call """
+                positions = iter(rng.integers(0, n, num_calls))
+                return lambda: fn(int(next(positions)))
+
+            retrieve = {
+                'retrieve_by_id': lambda i: Listing.retrieve_by_id(int(ids[i]), db, columns),
+                'retrieve_by_ids_100': lambda i: Listing.retrieve_by_ids(rng.choice(ids, 100).tolist(), db, columns),
+                'retrieve_similar': lambda i: Listing.retrieve_similar(int(ids[i]), db, columns),
+                'retrieve_similar_by_ids_100': lambda i: Listing.retrieve_similar_by_ids(rng.choice(ids, 100).tolist(), db, columns),
+                'retrieve_referencing_ids': lambda i: Listing.retrieve_referencing_ids(int(ids[i]), db),
+                'retrieve_all_100': lambda i: Listing.retrieve_all(i, 100, db, columns),
+                'retrieve_after_100': lambda i: Listing.retrieve_after(int(sorted_ids[i]), 100, db, columns),
+                'retrieve_near_0.5mi': lambda i: Listing.retrieve_near(*locations[i], 0.5, 10, db, columns),
+                'retrieve_ids_by_price_band': lambda i: Listing.retrieve_ids_by_price_band(
+                    room_types, log_prices[i] - ListingSimilarity.MAX_LOG_PRICE_DIFF,
+                    log_prices[i] + ListingSimilarity.MAX_LOG_PRICE_DIFF, df.neighbourhood_cleansed[i], db
+                ),
+            }
+            for name, fn in retrieve.items():
+                results[name] = timed(calls(fn), num_calls)
+            db.close()
+
+        if 'embedder' in only:
+            print('embedder...')
+            embed_df = df.iloc[:embed_n]
+            listing_embedder = TinyListingEmbedder(device='cpu')
+            results['embedder'] = timed(lambda: listing_embedder.from_dataframe(embed_df, batch_size=64), repeat, len(embed_df))
+            listing_embedder.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            **git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'params': {
+                'n': n, 'dim': dim, 'dense_n': dense_n, 'embed_n': embed_n,
+                'num_calls': num_calls, 'repeat': repeat, 'seed': seed
+            },
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'versions': {'numpy': np.__version__, 'pandas': pd.__version__, 'torch': torch.__version__},
+        },
+        'results': results,
+    }
+
+
+def compare_results(
+    baseline: Dict,
+    report: Dict
+) -> None:
+    """ prints the median time of each benchmark of a report relative to a baseline report """
+    print(f'Compared to {baseline["meta"]["commit"]} ({baseline["meta"]["timestamp"]}):')
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        before, after = baseline['results'][name]['median_ms'], result['median_ms']
+        print(f'{name:>30}: {before:>10.2f} ms -> {after:>10.2f} ms ({after / before:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic listings')
+    parser.add_argument('--n', type=int, default=10000, help='number of listings (NYC is about 40000)')
+    parser.add_argument('--dim', type=int, default=1024, help='embedding size')
+    parser.add_argument('--dense-n', type=int, default=2000, help='number of listings of the (n, n) benchmarks')
+    parser.add_argument('--embed-n', type=int, default=1000, help='number of listings embedded with the tiny model')
+    parser.add_argument('--num-calls', type=int, default=200, help='number of calls of each retrieve benchmark')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=None)
+    parser.add_argument('--out', default=None, help='output json. Defaults to artifacts/benchmarks/<timestamp>-<commit>.json')
+    parser.add_argument('--compare', default=None, help='json of a previous run to compare with')
+    args = parser.parse_args()
+
+    report = run_benchmarks(
+        args.n, args.dim, args.dense_n, args.embed_n, args.num_calls, args.repeat, args.seed, args.only
+    )
+
+    out = args.out
+    if not out:
+        if not path.exists(BENCHMARKS_DIR):
+            os.makedirs(BENCHMARKS_DIR)
+        out = path.join(BENCHMARKS_DIR, f'{time.strftime("%Y%m%d-%H%M%S")}-{report["meta"]["commit"] or "unknown"}.json')
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in report['results'].items():
+        throughput = f'{result["items_per_sec"]:>12,.0f} items/s' if 'items_per_sec' in result else ''
+        print(f'{name:>30}: {result["median_ms"]:>10.2f} ms median {throughput}')
+    print(f'Results written to {out}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare_results(json.load(f), report)
@@ -0,0 +1,213 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import numpy as np
+import pandas as pd
+from os import path
+from data import utils as du
+from data.database import Database, db_setup, listing_location_setup
+from data.embedding_store import EMBEDDING_DIM, EmbeddingStore, encode_embedding
+from data.make_dataset import top_k_similar, similar_listing_rows, populate_db, populate_similar_listings
+from models.matching import ListingSimilarity
+
+# neighbourhood group -> neighbourhood -> approximate center (latitude, longitude)
+NYC_NEIGHBOURHOODS = {
+    'Manhattan': {
+        'Harlem': (40.811, -73.946), 'East Village': (40.726, -73.982), 'Upper West Side': (40.787, -73.975),
+        'Upper East Side': (40.774, -73.957), "Hell's Kitchen": (40.764, -73.992), 'Midtown': (40.754, -73.984),
+        'Chelsea': (40.746, -74.001), 'Lower East Side': (40.715, -73.984), 'West Village': (40.736, -74.004),
+        'Financial District': (40.707, -74.009), 'East Harlem': (40.795, -73.939), 'Washington Heights': (40.841, -73.939),
+        'Murray Hill': (40.748, -73.978), 'SoHo': (40.723, -74.003), 'Chinatown': (40.716, -73.997),
+    },
+    'Brooklyn': {
+        'Bedford-Stuyvesant': (40.687, -73.942), 'Williamsburg': (40.714, -73.953), 'Bushwick': (40.694, -73.921),
+        'Crown Heights': (40.671, -73.945), 'Greenpoint': (40.730, -73.951), 'Park Slope': (40.672, -73.978),
+        'Flatbush': (40.641, -73.959), 'Clinton Hill': (40.689, -73.966), 'Fort Greene': (40.689, -73.976),
+        'Prospect-Lefferts Gardens': (40.659, -73.951), 'Sunset Park': (40.645, -74.012), 'East Flatbush': (40.646, -73.930),
+        'Bay Ridge': (40.625, -74.030),
+    },
+    'Queens': {
+        'Astoria': (40.764, -73.923), 'Long Island City': (40.744, -73.949), 'Flushing': (40.765, -73.830),
+        'Ridgewood': (40.704, -73.905), 'Jamaica': (40.702, -73.789), 'Sunnyside': (40.743, -73.920),
+        'Jackson Heights': (40.755, -73.885), 'Elmhurst': (40.738, -73.880),
+    },
+    'Bronx': {
+        'Mott Haven': (40.809, -73.923), 'Concourse': (40.833, -73.920), 'Kingsbridge': (40.880, -73.904),
+        'Fordham': (40.861, -73.890),
+    },
+    'Staten Island': {
+        'St. George': (40.644, -74.077), 'Tompkinsville': (40.636, -74.078),
+    },
+}
+
+ROOM_TYPES = ['Entire home/apt', 'Private room', 'Shared room', 'Hotel room']
+ROOM_TYPE_WEIGHTS = [0.55, 0.42, 0.02, 0.01]
+
+PROPERTY_TYPES = [
+    'Entire rental unit', 'Private room in rental unit', 'Entire home', 'Private room in home',
+    'Entire condo', 'Room in hotel', 'Shared room in rental unit', 'Entire loft', 'Entire townhouse'
+]
+BATHROOMS_TEXTS = ['1 bath', '1 shared bath', '1 private bath', '1.5 baths', '2 baths', '2.5 baths', '3 baths']
+
+# vocabulary of the free text columns
+WORDS = (
+    'the a and with of in to for our your this is near from on at by walk minutes subway train station '
+    'cozy spacious sunny bright quiet charming modern renovated beautiful private clean comfortable '
+    'apartment room studio loft home house condo suite bedroom bedrooms bathroom kitchen living dining '
+    'bed queen king sofa couch desk closet window windows view views rooftop terrace balcony backyard '
+    'park restaurants bars cafes shops museums downtown neighborhood block street avenue brownstone '
+    'building elevator laundry wifi heating air conditioning coffee tea towels linens guests host hosts '
+    'enjoy relax explore stay love welcome live work travel family friends couples business city nyc '
+    'manhattan brooklyn queens bronx island bridge river water light space perfect great best amazing'
+).split()
+
+
+def _texts(
+    rng: np.random.Generator,
+    n: int,
+    mean_words: int,
+    missing_frac: float,
+    html: bool=False
+) -> np.ndarray:
+    """ returns n random texts of a geometric number of words, some of them missing """
+    lengths = rng.geometric(1 / mean_words, n)
+    words = np.array(WORDS, dtype=object)
+    texts = np.empty(n, dtype=object)
+    for i, length in enumerate(lengths):
+        sentence = words[rng.integers(0, len(words), length)]
+        if html and length > 20:
+            sentence[length // 2] += '<br /><br />'
+        texts[i] = ' '.join(sentence)
+    texts[rng.random(n) < missing_frac] = np.nan
+    return texts
+
+
+def synthetic_raw_listings(
+    n: int,
+    seed: int=0
+) -> pd.DataFrame:
+    """ generates n listings with the `COLS_TO_KEEP` columns formatted as in the raw NYC listings
+        csv (e.g. `$1,234.00` prices). The same n and seed always give the same listings.
+
+    Args:
+        n (int): number of listings
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: raw listings
+    """
+    rng = np.random.default_rng(seed)
+
+    neighbourhoods = [
+        (group, name, center)
+        for group, names in NYC_NEIGHBOURHOODS.items() for name, center in names.items()
+    ]
+    # a few neighbourhoods hold most listings
+    weights = 1 / (np.arange(len(neighbourhoods)) + 5)
+    neighbourhood_idx = rng.choice(len(neighbourhoods), n, p=weights / weights.sum())
+    centers = np.array([neighbourhoods[i][2] for i in neighbourhood_idx])
+
+    room_types = rng.choice(ROOM_TYPES, n, p=ROOM_TYPE_WEIGHTS)
+    prices = np.maximum(np.round(np.exp(rng.normal(np.log(150), 0.7, n))), 10)
+    bedrooms = rng.integers(1, 5, n).astype(np.float64)
+    bedrooms[rng.random(n) < 0.15] = np.nan
+    accommodates = np.nan_to_num(bedrooms, nan=1) * rng.integers(1, 3, n)
+
+    ids = np.sort(rng.choice(10**9, n, replace=False)) + 10**6
+    return pd.DataFrame({
+        'id': ids,
+        'listing_url': [f'https://www.airbnb.com/rooms/{id}' for id in ids],
+        'room_type': room_types,
+        'neighbourhood_group_cleansed': [neighbourhoods[i][0] for i in neighbourhood_idx],
+        'neighbourhood_cleansed': [neighbourhoods[i][1] for i in neighbourhood_idx],
+        'bedrooms': bedrooms,
+        'beds': np.nan_to_num(bedrooms, nan=1) + rng.integers(0, 2, n),
+        'bathrooms_text': rng.choice(BATHROOMS_TEXTS, n),
+        'accommodates': accommodates,
+        'price': [f'${price:,.2f}' for price in prices],
+        'latitude': centers[:, 0] + rng.normal(0, 0.008, n),
+        'longitude': centers[:, 1] + rng.normal(0, 0.008, n),
+        'property_type': rng.choice(PROPERTY_TYPES, n),
+        'description': _texts(rng, n, 120, 0.02, html=True),
+        'neighborhood_overview': _texts(rng, n, 50, 0.4),
+        'host_about': _texts(rng, n, 40, 0.45),
+    })[du.COLS_TO_KEEP]
+
+
+def synthetic_listings(
+    n: int,
+    seed: int=0
+) -> pd.DataFrame:
+    """ generates n cleaned listings, as returned by `du.load_listings` (see `synthetic_raw_listings`) """
+    return du.clean_listings(synthetic_raw_listings(n, seed)).reset_index(drop=True)
+
+
+def synthetic_embeddings(
+    n: int,
+    dim: int=EMBEDDING_DIM,
+    num_clusters: int=None,
+    noise: float=0.25,
+    seed: int=0
+) -> np.ndarray:
+    """ generates n random l2 normalized embeddings scattered around random cluster centers,
+        so listings of a cluster pass the min cosine similarity filter of the matcher
+
+    Args:
+        n (int): number of embeddings
+        dim (int, optional): embedding size. Defaults to EMBEDDING_DIM.
+        num_clusters (int, optional): number of clusters. Defaults to n // 20.
+        noise (float, optional): norm of the noise added to the centers, the cosine similarity
+            of two embeddings of a cluster is about 1 / (1 + noise^2). Defaults to 0.25.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        np.ndarray: float32 embeddings of shape (n, dim)
+    """
+    rng = np.random.default_rng(seed)
+    num_clusters = num_clusters if num_clusters else max(n // 20, 1)
+
+    centers = rng.standard_normal((num_clusters, dim), dtype=np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    embeddings = centers[rng.integers(0, num_clusters, n)]
+    embeddings += rng.standard_normal((n, dim), dtype=np.float32) * (noise / np.sqrt(dim))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings
+
+
+def make_synthetic_database(
+    data_dir: str,
+    n: int,
+    seed: int=0
+) -> pd.DataFrame:
+    """ builds a database and an embedding store of n synthetic listings, with their similar
+        listings, as `make_dataset.py` does for the real listings
+
+    Args:
+        data_dir (str): directory of the database (`airbnb.db`) and of the embedding store
+        n (int): number of listings
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: listings of the database
+    """
+    db_path = path.join(data_dir, 'airbnb.db')
+    if path.exists(db_path):
+        raise FileExistsError(f'{db_path} already exists')
+
+    df = synthetic_listings(n, seed)
+    embeddings = synthetic_embeddings(n, seed=seed)
+    top_indices, top_scores = top_k_similar(embeddings, df, ListingSimilarity.TOP_N * 10)
+
+    listings_df = df.copy()
+    listings_df['embedding'] = [encode_embedding(embedding) for embedding in embeddings]
+    listings_df['log_price'] = du.log_price(listings_df.price.to_numpy(dtype=np.float64))
+
+    db_setup(create_indexes=False, db_name=db_path)
+    db = Database(db_path)
+    populate_db(listings_df, db)
+    populate_similar_listings(similar_listing_rows(top_indices, top_scores, df), db)
+    listing_location_setup(db)
+    db.close()
+
+    EmbeddingStore(path.join(data_dir, 'embeddings.npy'), path.join(data_dir, 'embedding_ids.npy')).save(df.id.to_numpy(), embeddings)
+    return df
@@ -0,0 +1,67 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import re
+import torch
+import string
+from os import path
+import project_config as pc
+from benchmarks.synthetic import WORDS, synthetic_listings
+from models.listing_embedding import ListingEmbedder
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+TINY_MODEL_DIR = path.join(pc.BASE_ARTIFACTS_DIR, 'benchmarks', 'tiny-bert')
+
+
+def save_tiny_model(
+    model_dir: str=TINY_MODEL_DIR,
+    hidden_size: int=32,
+    num_layers: int=2,
+    seed: int=0
+) -> None:
+    """ saves a tiny randomly initialized BERT and a word level tokenizer covering the vocabulary
+        of the synthetic listings, so tokens per listing are close to those of the real model
+
+    Args:
+        model_dir (str, optional): directory of the model. Defaults to TINY_MODEL_DIR.
+        hidden_size (int, optional): size of the embeddings. Defaults to 32.
+        num_layers (int, optional): number of transformer layers. Defaults to 2.
+        seed (int, optional): random seed of the weights. Defaults to 0.
+    """
+    info_summaries, host_descs = ListingEmbedder.construct_summaries(synthetic_listings(500, seed))
+    summary_words = {word for text in info_summaries + host_descs for word in re.findall(r'[a-z]+', text.lower())}
+
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+    vocab += sorted(set(WORDS) | summary_words) + list(string.digits + string.punctuation)
+    vocab += [f'##{char}' for char in string.ascii_lowercase + string.digits]
+
+    if not path.exists(model_dir):
+        os.makedirs(model_dir)
+    vocab_path = path.join(model_dir, 'vocab.txt')
+    with open(vocab_path, 'w') as f:
+        f.write('\n'.join(vocab))
+
+    torch.manual_seed(seed)
+    config = BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=2,
+        intermediate_size=2 * hidden_size,
+        max_position_embeddings=512
+    )
+    BertModel(config).save_pretrained(model_dir)
+    BertTokenizerFast(vocab_path, model_max_length=512).save_pretrained(model_dir)
+
+
+class TinyListingEmbedder(ListingEmbedder):
+    """ A `ListingEmbedder` backed by a tiny random model (see `save_tiny_model`), saved on first use.
+        Its embeddings are meaningless, but summaries, tokenization, batching, caching and replicas
+        run as with the real model, so they can be timed offline.
+    """
+    MODEL_NAME = TINY_MODEL_DIR
+
+    def __init__(self, *args, **kwargs) -> None:
+        if not path.exists(path.join(self.MODEL_NAME, 'config.json')):
+            save_tiny_model(self.MODEL_NAME)
+        super().__init__(*args, **kwargs)
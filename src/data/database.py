@@ -1,21 +1,56 @@
 import os, sys
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
 
+import time
+import pickle
+import asyncio
 import sqlite3
+import threading
+import numpy as np
+import pandas as pd
 from os import path
 import project_config as pc
 from data import utils as du
-from typing import Dict, List, Tuple
+from data.metrics import Histogram
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Callable, Any
+
+QUERY_TYPES = {'select', 'insert', 'update', 'delete', 'replace', 'create', 'drop', 'alter', 'pragma', 'with', 'explain'}
+QUERY_DURATION = Histogram(
+    'db_query_duration_seconds', 'Time spent executing queries and fetching their rows', ['type']
+)
+QUERY_ROWS = Histogram(
+    'db_query_rows', 'Number of rows returned by queries', ['type'], 
+    buckets=(0, 1, 10, 50, 100, 500, 1000, 10000)
+)
+
+
+def query_type(query: str) -> str:
+    """ returns the lowercased first keyword of a query, e.g. `select` """
+    words = query.split(None, 1)
+    keyword = words[0].lower() if words else ''
+    return keyword if keyword in QUERY_TYPES else 'other'
+
 
 class Database:
     """ A basic class to represent airbnb database """
-    def __init__(self, db_name: str=None) -> None:
+    def __init__(
+        self, 
+        db_name: str=None,
+        read_only: bool=False,
+        check_same_thread: bool=True
+    ) -> None:
         """ initializes a database object
 
         Args:
             db_name (str): name of the database
+            read_only (bool, optional): whether to open the database in read-only mode. Defaults to False.
+            check_same_thread (bool, optional): whether only the creating thread may use the
+                connection. Defaults to True.
         """
         self.db_name = pc.DATABASE_PATH if not db_name else db_name
+        self.read_only = read_only
+        self.check_same_thread = check_same_thread
         self.connection = None
         self.cursor = None
     
@@ -27,7 +62,12 @@ class Database:
         return d
 
     def connect(self) -> None:
-        self.connection = sqlite3.connect(self.db_name)
+        if self.read_only:
+            self.connection = sqlite3.connect(
+                f'file:{path.abspath(self.db_name)}?mode=ro', uri=True, check_same_thread=self.check_same_thread
+            )
+        else:
+            self.connection = sqlite3.connect(self.db_name, check_same_thread=self.check_same_thread)
         self.connection.row_factory = Database.dict_factory
         self.cursor = self.connection.cursor()
     
@@ -37,44 +77,64 @@ class Database:
     def __execute(
         self, 
         query: str, 
-        params: Dict=None
-    ) -> None:
+        params: Dict=None,
+        fetch: Callable[[], Any]=None
+    ) -> Any:
+        """ executes a query and returns the rows fetched by `fetch`, if given. 
+            The time spent and the number of rows returned are recorded by query type.
+        """
         if not self.connection:
             self.connect()
 
+        start = time.perf_counter()
         if params:
             self.cursor.execute(query, params)
         else:
             self.cursor.execute(query)
-        return
+        result = fetch() if fetch else None
+        elapsed = time.perf_counter() - start
+
+        labels = (query_type(query),)
+        QUERY_DURATION.observe(elapsed, labels)
+        QUERY_ROWS.observe(len(result) if isinstance(result, list) else int(result is not None), labels)
+        return result
 
     def executemany(
         self, 
         query: str, 
-        params: List
+        params: List,
+        commit: bool=True
     ) -> None:
         if not self.connection:
             self.connect()
         self.cursor.executemany(query, params)
-        self.connection.commit()
+        if commit:
+            self.connection.commit()
         return
     
     def execute(
         self, 
         query: str, 
-        params: Dict=None
+        params: Dict=None,
+        commit: bool=True
     ) -> None:
         self.__execute(query, params)
-        self.connection.commit()
+        if commit:
+            self.connection.commit()
         return
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def rollback(self) -> None:
+        self.connection.rollback()
         
     def fetch_all(
         self, 
         query: str, 
         params: Dict=None
     ) -> List:
-        self.__execute(query, params)
-        return self.cursor.fetchall()
+        return self.__execute(query, params, lambda: self.cursor.fetchall())
     
     def fetch_many(
         self, 
@@ -82,30 +142,350 @@ class Database:
         params: Dict=None,
         size: int=1
     ) -> List:
-        self.__execute(query, params)
-        return self.cursor.fetchmany(size)
+        return self.__execute(query, params, lambda: self.cursor.fetchmany(size))
 
     def fetch_one(
         self, 
         query: str, 
         params: Dict=None
     ) -> Tuple:
-        self.__execute(query, params)
-        return self.cursor.fetchone()
+        return self.__execute(query, params, lambda: self.cursor.fetchone())
     
 
-def db_setup():
-    """ sets up the initial database """
-    if os.path.exists(pc.DATABASE_PATH):
-        return
+class ConnectionPool:
+    """ A pool of sqlite connections for concurrent, non-blocking database access.
 
-    if not path.exists(path.dirname(pc.DATABASE_PATH)):
-        os.makedirs(path.dirname(pc.DATABASE_PATH))
-    
-    print('Setting up database for the first time...')
+        Queries run on a thread pool and every worker thread gets its own connections,
+        read-only by default, so requests are not serialized through a single cursor and
+        the event loop is never blocked. The database is switched to WAL mode so readers
+        do not block on (and are not blocked by) the occasional writer.
+
+        When the database file is replaced, e.g. by `make_dataset.install_database`, connections
+        to the replaced file are reopened by their thread on its next query, so no write is lost
+        to the old file.
+    """
+    def __init__(
+        self, 
+        db_name: str=None,
+        max_workers: int=None
+    ) -> None:
+        """ initializes a connection pool. Connections are opened lazily.
+
+        Args:
+            db_name (str, optional): name of the database. Defaults to pc.DATABASE_PATH.
+            max_workers (int, optional): number of worker threads, i.e. max number of concurrent
+                queries. Defaults to the `DB_POOL_SIZE` env var or 8.
+        """
+        self.db_name = pc.DATABASE_PATH if not db_name else db_name
+        self.max_workers = max_workers if max_workers else int(pc.ENV_VARS.get('DB_POOL_SIZE', None) or 8)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='db')
+
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__wal_inode = None
+        self.__databases = []
+
+        # stats
+        self.num_tasks = 0
+        self.num_active = 0
+        self.total_wait_time = 0.
+        self.max_wait_time = 0.
+
+    def __read_inode(self) -> int:
+        """ returns the inode of the database file, which changes when the file is replaced """
+        if not path.exists(self.db_name):
+            return None
+        return os.stat(self.db_name).st_ino
+
+    def __enable_wal(self, inode: int) -> None:
+        """ switches the database to WAL mode, which is persistent, once per database file """
+        if self.__wal_inode == inode:
+            return
+        with self.__lock:
+            if self.__wal_inode == inode or inode is None:
+                return
+            connection = sqlite3.connect(self.db_name)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.close()
+            self.__wal_inode = inode
+
+    def database(self, write: bool=False) -> Database:
+        """ returns the connection of the calling thread
+
+        Args:
+            write (bool, optional): whether a writable connection is needed. Defaults to False.
+
+        Returns:
+            Database: database object owned by the calling thread
+        """
+        inode = self.__read_inode()
+        self.__enable_wal(inode)
+
+        attr = 'writer' if write else 'reader'
+        db = getattr(self.__local, attr, None)
+        if db is not None and getattr(self.__local, f'{attr}_inode') != inode:
+            # the database file was replaced, the connection still reads the old one
+            with self.__lock:
+                if db in self.__databases:
+                    self.__databases.remove(db)
+            if db.connection:
+                db.close()
+            db = None
+        if db is None:
+            # only used by this thread, but closed by the thread closing the pool
+            db = Database(self.db_name, read_only=not write, check_same_thread=False)
+            setattr(self.__local, attr, db)
+            setattr(self.__local, f'{attr}_inode', inode)
+            with self.__lock:
+                self.__databases.append(db)
+        return db
+
+    async def run(
+        self, 
+        fn: Callable, 
+        *args, 
+        write: bool=False, 
+        **kwargs
+    ) -> Any:
+        """ runs `fn(*args, db=<connection>, **kwargs)` on the pool without blocking the event loop
+
+        Args:
+            fn (Callable): function taking a `db` keyword argument, e.g. `Listing.retrieve_by_id`
+            write (bool, optional): whether `fn` writes to the database. Defaults to False.
+
+        Returns:
+            Any: return value of `fn`
+        """
+        submitted = time.perf_counter()
+
+        def task():
+            wait_time = time.perf_counter() - submitted
+            with self.__lock:
+                self.num_tasks += 1
+                self.num_active += 1
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+            try:
+                return fn(*args, db=self.database(write), **kwargs)
+            finally:
+                with self.__lock:
+                    self.num_active -= 1
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, task)
+
+    def stats(self) -> Dict:
+        """ returns the pool size and the time tasks waited for a worker """
+        with self.__lock:
+            return {
+                'max_workers': self.max_workers,
+                'connections': len(self.__databases),
+                'active': self.num_active,
+                'tasks': self.num_tasks,
+                'mean_wait_ms': 1000 * self.total_wait_time / self.num_tasks if self.num_tasks else 0.,
+                'max_wait_ms': 1000 * self.max_wait_time,
+            }
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        with self.__lock:
+            for db in self.__databases:
+                if db.connection:
+                    db.close()
+            self.__databases = []
+
+
+def _column_values(column: pd.Series) -> List:
+    """ returns the values of a column as python objects, with None for missing values """
+    return column.astype(object).where(column.notna(), None).tolist()
+
+
+def bulk_load(
+    db: Database,
+    table: str,
+    df: pd.DataFrame,
+    indexes: List[str]=None,
+    batch_size: int=10000,
+    cache_size_kb: int=262144,
+    verbose: bool=True
+) -> int:
+    """ inserts all rows of a dataframe into a table in a single transaction.
+        Rows are streamed as tuples straight from the column arrays, journaling and 
+        fsyncs are relaxed for the duration of the load and indexes are created once
+        the data is in. Nothing is inserted if the load fails.
+
+    Args:
+        db (Database): database object
+        table (str): name of the table, its columns must match the dataframe columns
+        df (pd.DataFrame): rows to insert
+        indexes (List[str], optional): `CREATE INDEX` statements run after the load. Defaults to None.
+        batch_size (int, optional): number of rows converted at once. Defaults to 10000.
+        cache_size_kb (int, optional): sqlite page cache size during the load. Defaults to 262144.
+        verbose (bool, optional): whether to report the load throughput. Defaults to True.
+
+    Returns:
+        int: number of inserted rows
+    """
+    start = time.perf_counter()
+    cols = list(df.columns)
+    query = f'INSERT INTO {table} ({", ".join(cols)}) VALUES ({", ".join(["?"] * len(cols))})'
+
+    # pragmas restored after the load
+    journal_mode = db.fetch_one('PRAGMA journal_mode')['journal_mode']
+    synchronous = db.fetch_one('PRAGMA synchronous')['synchronous']
+    cache_size = db.fetch_one('PRAGMA cache_size')['cache_size']
+
+    db.fetch_one('PRAGMA journal_mode = MEMORY')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute(f'PRAGMA cache_size = {-cache_size_kb}')
+    try:
+        for i in range(0, len(df), batch_size):
+            chunk = df.iloc[i:i + batch_size]
+            db.executemany(query, zip(*[_column_values(chunk[col]) for col in cols]), commit=False)
+        for index in indexes or []:
+            db.execute(index, commit=False)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        db.fetch_one(f'PRAGMA journal_mode = {journal_mode}')
+        db.execute(f'PRAGMA synchronous = {synchronous}')
+        db.execute(f'PRAGMA cache_size = {cache_size}')
+
+    if verbose:
+        elapsed = time.perf_counter() - start
+        print(f'Loaded {len(df)} rows into {table} in {elapsed:.2f}s ({len(df) / max(elapsed, 1e-9):,.0f} rows/sec)')
+    return len(df)
+
+
+def similar_listing_setup(db: Database, create_indexes: bool=True) -> None:
+    """ creates the similar listing table and its reverse lookup index if needed """
+    db.execute(f'CREATE TABLE IF NOT EXISTS similar_listing ({du.SIMILAR_LISTING_TABLE_SCHEMA}) WITHOUT ROWID')
+    if create_indexes:
+        for index in du.SIMILAR_LISTING_INDEXES:
+            db.execute(index)
+
+
+def listing_location_setup(db: Database) -> None:
+    """ creates the spatial index of the listing locations, indexes the stored listings
+        and creates the triggers keeping it in sync with the listing table
+    """
+    try:
+        db.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS listing_location USING rtree({du.LISTING_LOCATION_SCHEMA})', commit=False)
+        db.execute(
+            'INSERT OR REPLACE INTO listing_location SELECT id, latitude, latitude, longitude, longitude FROM listing',
+            commit=False
+        )
+        for trigger in du.LISTING_LOCATION_TRIGGERS:
+            db.execute(trigger, commit=False)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def migrate_similar_listings(
+    db: Database=None,
+    batch_size: int=1000
+) -> None:
+    """ moves legacy pickled `similar_listings` of the listing table to the similar listing table.
+        Scores of legacy similar listings are unknown and stored as NULL.
+
+    Args:
+        db (Database, optional): database object. Defaults to the project database.
+        batch_size (int, optional): number of listings migrated per transaction. Defaults to 1000.
+    """
+    db = db if db else Database()
+    similar_listing_setup(db)
+
+    last_id = -1
+    while True:
+        rows = db.fetch_all(
+            'SELECT id, similar_listings FROM listing '
+            'WHERE similar_listings IS NOT NULL AND id > :last_id ORDER BY id LIMIT :limit',
+            {'last_id': last_id, 'limit': batch_size}
+        )
+        if not rows:
+            break
+
+        db.executemany(
+            'INSERT OR REPLACE INTO similar_listing (listing_id, rank, similar_id, score) VALUES (?, ?, ?, NULL)',
+            [(row['id'], rank, similar_id) 
+             for row in rows for rank, similar_id in enumerate(pickle.loads(row['similar_listings']))]
+        )
+        db.executemany('UPDATE listing SET similar_listings = NULL WHERE id = ?', [(row['id'],) for row in rows])
+        last_id = rows[-1]['id']
+
+
+def migrate_log_prices(
+    db: Database=None,
+    batch_size: int=1000
+) -> None:
+    """ adds the `log_price` column to a listing table created without it, fills it
+        and creates the listing indexes (see `du.LISTING_INDEXES`)
+
+    Args:
+        db (Database, optional): database object. Defaults to the project database.
+        batch_size (int, optional): number of listings updated per transaction. Defaults to 1000.
+    """
+    db = db if db else Database()
+    db.execute('ALTER TABLE listing ADD COLUMN log_price REAL')
+
+    last_id = -1
+    while True:
+        rows = db.fetch_all(
+            'SELECT id, price FROM listing WHERE id > :last_id ORDER BY id LIMIT :limit',
+            {'last_id': last_id, 'limit': batch_size}
+        )
+        if not rows:
+            break
+
+        log_prices = du.log_price(np.array([row['price'] for row in rows], dtype=np.float64))
+        db.executemany(
+            'UPDATE listing SET log_price = ? WHERE id = ?',
+            [(float(log_price), row['id']) for log_price, row in zip(log_prices, rows)]
+        )
+        last_id = rows[-1]['id']
+
+    for index in du.LISTING_INDEXES:
+        db.execute(index)
+
+
+def db_setup(create_indexes: bool=True, db_name: str=None):
+    """ sets up the initial database. Databases created before the similar listing table
+        are migrated (see `migrate_similar_listings`), as well as databases created before the
+        spatial index (see `listing_location_setup`) or the `log_price` column (see `migrate_log_prices`).
+
+    Args:
+        create_indexes (bool, optional): whether to create the secondary and spatial indexes 
+            of a new database. Set to False before a `bulk_load`. Defaults to True.
+        db_name (str, optional): name of the database. Defaults to pc.DATABASE_PATH.
+    """
+    db_name = pc.DATABASE_PATH if not db_name else db_name
+    if not path.exists(path.dirname(db_name)):
+        os.makedirs(path.dirname(db_name))
+
+    db = Database(db_name)
+    if not os.path.exists(db_name):
+        print('Setting up database for the first time...')
+        db.execute(f'CREATE TABLE IF NOT EXISTS listing ({du.LISTING_TABLE_SCHEMA})')
+        similar_listing_setup(db, create_indexes)
+        if create_indexes:
+            for index in du.LISTING_INDEXES:
+                db.execute(index)
+            listing_location_setup(db)
+        db.close()
+        return
 
-    db = Database()
-    db.execute(f'CREATE TABLE IF NOT EXISTS listing ({du.LISTING_TABLE_SCHEMA})')
+    if not db.fetch_one("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'similar_listing'"):
+        print('Moving similar listings to the similar_listing table...')
+        migrate_similar_listings(db)
+    if not any(column['name'] == 'log_price' for column in db.fetch_all('PRAGMA table_info(listing)')):
+        print('Adding log prices to listings...')
+        migrate_log_prices(db)
+    if not db.fetch_one("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'listing_location'"):
+        print('Indexing listing locations...')
+        listing_location_setup(db)
     db.close()
 
 
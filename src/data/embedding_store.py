@@ -0,0 +1,220 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import pickle
+import numpy as np
+from os import path
+from tqdm import tqdm
+import project_config as pc
+from typing import List
+from data.database import Database
+
+# hidden size of BAAI/bge-large-en
+EMBEDDING_DIM = 1024
+
+# dtype of newly written embeddings (float32 or float16), always little-endian
+EMBEDDING_DTYPE = np.dtype(pc.ENV_VARS.get('EMBEDDING_DTYPE', None) or 'float32').newbyteorder('<')
+
+
+def encode_embedding(embedding: np.ndarray, dtype: np.dtype=EMBEDDING_DTYPE) -> bytes:
+    """ serializes an embedding as raw little-endian bytes
+
+    Args:
+        embedding (np.ndarray): embedding of shape (EMBEDDING_DIM,)
+        dtype (np.dtype, optional): float32 or float16. Defaults to EMBEDDING_DTYPE.
+
+    Returns:
+        bytes: raw embedding bytes
+    """
+    return np.asarray(embedding, dtype=dtype).tobytes()
+
+
+def is_pickle(blob: bytes) -> bool:
+    """ whether a blob looks like a legacy pickled embedding (protocol 2+ header and STOP opcode) """
+    return blob[:1] == b'\x80' and blob[1:2] in (b'\x02', b'\x03', b'\x04', b'\x05') and blob[-1:] == b'.'
+
+
+def decode_embedding(blob: bytes) -> np.ndarray:
+    """ deserializes an embedding stored by `encode_embedding` without copying, whatever its size.
+        The dtype of EMBEDDING_DIM embeddings is inferred from the blob size, so databases written
+        with either dtype are read correctly. Raw blobs of other sizes (e.g. synthetic embeddings) 
+        are read as EMBEDDING_DTYPE. Legacy pickled lists are still supported.
+
+    Args:
+        blob (bytes): raw embedding bytes or a legacy pickled list of floats
+
+    Returns:
+        np.ndarray: read-only embedding of shape (d,)
+    """
+    if len(blob) == EMBEDDING_DIM * 4:
+        return np.frombuffer(blob, dtype='<f4')
+    if len(blob) == EMBEDDING_DIM * 2:
+        return np.frombuffer(blob, dtype='<f2')
+    if is_pickle(blob):
+        try:
+            return np.asarray(pickle.loads(blob), dtype=np.float32)
+        except Exception:
+            # raw bytes that happen to look like a pickle
+            pass
+    return np.frombuffer(blob, dtype=EMBEDDING_DTYPE)
+
+
+class EmbeddingStore:
+    """ A side-car embedding matrix (`.npy`) with an id -> row index.
+
+        The matrix is memory-mapped on load, so any component gets a zero-copy view of all
+        embeddings without going through the database.
+    """
+    def __init__(
+        self,
+        embeddings_path: str=None,
+        ids_path: str=None
+    ) -> None:
+        """ initializes an embedding store
+
+        Args:
+            embeddings_path (str, optional): path to the embedding matrix. Defaults to pc.EMBEDDINGS_PATH.
+            ids_path (str, optional): path to the listing ids of the rows. Defaults to pc.EMBEDDING_IDS_PATH.
+        """
+        self.embeddings_path = pc.EMBEDDINGS_PATH if not embeddings_path else embeddings_path
+        self.ids_path = pc.EMBEDDING_IDS_PATH if not ids_path else ids_path
+        self.ids = None
+        self.embeddings = None
+
+    def exists(self) -> bool:
+        return path.exists(self.embeddings_path) and path.exists(self.ids_path)
+
+    def save(
+        self,
+        ids: np.ndarray,
+        embeddings: np.ndarray,
+        dtype: np.dtype=EMBEDDING_DTYPE
+    ) -> None:
+        """ writes the embedding matrix and its ids, sorted by id
+
+        Args:
+            ids (np.ndarray): listing ids of shape (n,)
+            embeddings (np.ndarray): embeddings of shape (n, d)
+            dtype (np.dtype, optional): float32 or float16. Defaults to EMBEDDING_DTYPE.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+
+        if not path.exists(path.dirname(self.embeddings_path)):
+            os.makedirs(path.dirname(self.embeddings_path))
+
+        # files are replaced rather than overwritten, readers keep their memory-mapped version
+        for file_path, array in [(self.embeddings_path, np.asarray(embeddings, dtype=dtype)[order]), 
+                                 (self.ids_path, ids[order])]:
+            with open(f'{file_path}.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(f'{file_path}.tmp', file_path)
+
+    def update(
+        self,
+        ids: np.ndarray,
+        embeddings: np.ndarray,
+        removed_ids: List[int]=None,
+        dtype: np.dtype=EMBEDDING_DTYPE
+    ) -> 'EmbeddingStore':
+        """ adds or replaces the embeddings of some listings, drops the removed listings
+            and reloads the store
+
+        Args:
+            ids (np.ndarray): listing ids of the new or changed embeddings of shape (m,)
+            embeddings (np.ndarray): new or changed embeddings of shape (m, d)
+            removed_ids (List[int], optional): ids of the listings to drop. Defaults to None.
+            dtype (np.dtype, optional): float32 or float16. Defaults to EMBEDDING_DTYPE.
+
+        Returns:
+            EmbeddingStore: self
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        embeddings = np.asarray(embeddings, dtype=dtype)
+        if self.exists():
+            self.load()
+            # an empty update, e.g. removals only, has the width of the stored embeddings
+            embeddings = embeddings.reshape(len(ids), -1 if len(ids) else self.embeddings.shape[1])
+            keep = ~np.isin(self.ids, np.concatenate([ids, np.asarray(removed_ids or [], dtype=np.int64)]))
+            ids = np.concatenate([self.ids[keep], ids])
+            embeddings = np.concatenate([np.asarray(self.embeddings[keep], dtype=dtype), embeddings])
+        else:
+            embeddings = embeddings.reshape(len(ids), -1)
+
+        self.save(ids, embeddings, dtype)
+        return self.load()
+
+    def load(self, mmap_mode: str='r') -> 'EmbeddingStore':
+        """ memory-maps the embedding matrix
+
+        Args:
+            mmap_mode (str, optional): `np.load` mmap mode. Defaults to 'r'.
+
+        Returns:
+            EmbeddingStore: self
+        """
+        self.ids = np.load(self.ids_path)
+        self.embeddings = np.load(self.embeddings_path, mmap_mode=mmap_mode)
+        return self
+
+    def rows(self, ids: List[int]) -> np.ndarray:
+        """ returns the row of each id in the embedding matrix, -1 if the id is not stored """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+
+        rows = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        rows[self.ids[rows] != ids] = -1
+        return rows
+
+    def get(self, id: int) -> np.ndarray:
+        """ returns the embedding of a listing, or None if it is not stored """
+        row = self.rows([id])[0]
+        return None if row < 0 else self.embeddings[row]
+
+
+def migrate_db(
+    db: Database=None,
+    store: EmbeddingStore=None,
+    batch_size: int=1000
+) -> None:
+    """ rewrites legacy pickled embeddings as raw bytes and writes the side-car embedding matrix
+
+    Args:
+        db (Database, optional): database object. Defaults to the project database.
+        store (EmbeddingStore, optional): embedding store. Defaults to the project store.
+        batch_size (int, optional): number of rows rewritten per transaction. Defaults to 1000.
+    """
+    db = db if db else Database()
+    store = store if store else EmbeddingStore()
+
+    ids, embeddings = [], []
+    last_id = None
+    num_rows = db.fetch_one('SELECT COUNT(*) AS n FROM listing WHERE embedding IS NOT NULL')['n']
+    with tqdm(total=num_rows) as progress:
+        while True:
+            rows = db.fetch_all(
+                'SELECT id, embedding FROM listing WHERE embedding IS NOT NULL AND id > :last_id ORDER BY id LIMIT :limit',
+                {'last_id': -1 if last_id is None else last_id, 'limit': batch_size}
+            )
+            if not rows:
+                break
+
+            batch = [(row['id'], decode_embedding(row['embedding'])) for row in rows]
+            db.executemany(
+                'UPDATE listing SET embedding = ? WHERE id = ?',
+                [(encode_embedding(embedding), id) for id, embedding in batch]
+            )
+            ids.extend(id for id, _ in batch)
+            embeddings.extend(embedding for _, embedding in batch)
+            last_id = rows[-1]['id']
+            progress.update(len(rows))
+
+    if ids:
+        store.save(np.array(ids), np.stack(embeddings))
+    db.execute('VACUUM')
+
+
+if __name__ == '__main__':
+    print('Migrating embeddings to raw bytes and writing the embedding matrix...')
+    migrate_db()
@@ -2,18 +2,29 @@ import os, sys
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
 
 import torch
-import pickle
+import shutil
+import sqlite3
+import argparse
 import numpy as np
 import pandas as pd
 from os import path
 from tqdm import tqdm
-from typing import List
+import project_config as pc
+from functools import partial
+from typing import List, Tuple, Dict
 from data import utils as du
-from haversine import haversine
-from data.database import Database, db_setup
+from haversine import haversine, haversine_vector, Unit
+from data.database import Database, db_setup, bulk_load, listing_location_setup
+from data.pipeline import Pipeline
+from data.embedding_store import EmbeddingStore, EMBEDDING_DTYPE, encode_embedding
+from models.listing import Listing
 from models.matching import ListingSimilarity
+from models.embedding_cache import EmbeddingCache
 from models.listing_embedding import ListingEmbedder
 
+# number of rows / columns of the similarity matrix processed at once
+SIMILARITY_BLOCK_SIZE = 2048
+
 
 def filter_by_price(df: pd.DataFrame) -> np.ndarray:
     """ filter by price abs(log10(price) - log10(reference_price)) <= self.MAX_LOG_PRICE_DIFF
@@ -24,9 +35,7 @@ def filter_by_price(df: pd.DataFrame) -> np.ndarray:
     Returns:
         np.ndarray: boolean array of shape (n, n) where n is the number of listings
     """
-    prices = df.price.to_numpy()
-    prices[prices == 0] = 1
-    log_prices = np.log10(prices)
+    log_prices = du.log_price(df.price.to_numpy(dtype=np.float64))
     return np.abs(log_prices[:, None] - log_prices) <= ListingSimilarity.MAX_LOG_PRICE_DIFF
 
 
@@ -43,6 +52,83 @@ def filter_by_neighborhood(df: pd.DataFrame) -> np.ndarray:
     return neighbourhoods[:, None] != neighbourhoods
 
 
+def top_k_similar(
+    embeddings: np.ndarray,
+    df: pd.DataFrame,
+    k: int,
+    block_size: int=SIMILARITY_BLOCK_SIZE,
+    queries: np.ndarray=None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ finds the top k most similar listings for every listing, block by block.
+        The cosine similarity matrix is never materialized. Row and column tiles of size 
+        `block_size` are scored, the price / neighbourhood / min cosine similarity filters are
+        applied within the tile and only a running top k per row is kept (partial selection).
+        Peak memory is O(n * k + block_size^2).
+
+    Args:
+        embeddings (np.ndarray): l2 normalized embeddings of shape (n, d)
+        df (pd.DataFrame): all data, aligned with `embeddings`
+        k (int): number of similar listings to keep per listing
+        block_size (int, optional): tile size. Defaults to SIMILARITY_BLOCK_SIZE.
+        queries (np.ndarray, optional): positional indices of the listings to find similar 
+            listings for, among all listings. Defaults to None (all listings).
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: positional indices and cosine similarities of shape (q, k),
+            where q is the number of queries, sorted by descending similarity. Rows with less than k matching listings are padded 
+            with index -1 and score 0.
+    """
+    n = embeddings.shape[0]
+    k = min(k, n)
+    queries = np.arange(n) if queries is None else np.asarray(queries, dtype=np.int64)
+    q = len(queries)
+
+    prices = df.price.to_numpy(dtype=np.float64, copy=True)
+    prices[prices == 0] = 1
+    log_prices = np.log10(prices)
+    neighbourhoods = pd.factorize(df.neighbourhood_cleansed)[0]
+
+    top_indices = np.full((q, k), -1, dtype=np.int64)
+    top_scores = np.zeros((q, k), dtype=embeddings.dtype)
+    for row_start in tqdm(range(0, q, block_size)):
+        row_end = min(row_start + block_size, q)
+        rows = queries[row_start:row_end]
+        best_indices = np.full((row_end - row_start, k), -1, dtype=np.int64)
+        best_scores = np.full((row_end - row_start, k), -np.inf, dtype=embeddings.dtype)
+
+        for col_start in range(0, n, block_size):
+            col_end = min(col_start + block_size, n)
+            scores = embeddings[rows] @ embeddings[col_start:col_end].T
+
+            # heuristic filters, same as `apply_heuristic_filters` but on a single tile
+            mask = np.abs(log_prices[rows, None] - log_prices[col_start:col_end]) <= ListingSimilarity.MAX_LOG_PRICE_DIFF
+            mask &= neighbourhoods[rows, None] != neighbourhoods[col_start:col_end]
+            mask &= scores > ListingSimilarity.MIN_COS_SIMILARITY
+            scores[~mask] = -np.inf
+
+            # merge the tile into the running top k
+            cand_scores = np.concatenate([best_scores, scores], axis=1)
+            cand_indices = np.concatenate([
+                best_indices, 
+                np.broadcast_to(np.arange(col_start, col_end), scores.shape)
+            ], axis=1)
+            top = np.argpartition(-cand_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(cand_scores, top, axis=1)
+            best_indices = np.take_along_axis(cand_indices, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_indices = np.take_along_axis(best_indices, order, axis=1)
+
+        filtered_out = np.isneginf(best_scores)
+        best_indices[filtered_out] = -1
+        best_scores[filtered_out] = 0
+        top_indices[row_start:row_end] = best_indices
+        top_scores[row_start:row_end] = best_scores
+
+    return top_indices, top_scores
+
+
 def filter_by_distance(
     cur_row, 
     cur_df: pd.DataFrame
@@ -70,6 +156,94 @@ def filter_by_distance(
     return matching_ids
 
 
+def distance_mask(
+    top_indices: np.ndarray,
+    df: pd.DataFrame,
+    queries: np.ndarray=None
+) -> np.ndarray:
+    """ computes the great-circle distance of every (listing, candidate) pair in one pass
+        and marks the first `TOP_N` candidates further than `MIN_DISTANCE` away.
+
+    Args:
+        top_indices (np.ndarray): positional indices of candidates of shape (n, k), 
+            ordered by preference and padded with -1 (see `top_k_similar`)
+        df (pd.DataFrame): all data
+        queries (np.ndarray, optional): positional indices of the listings the candidates 
+            belong to (see `top_k_similar`). Defaults to None (all listings).
+
+    Returns:
+        np.ndarray: boolean mask of the kept candidates of shape (n, k)
+    """
+    n, k = top_indices.shape
+    valid = top_indices >= 0
+    candidates = np.where(valid, top_indices, 0)
+
+    locations = df[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+    dists = haversine_vector(
+        np.repeat(locations if queries is None else locations[queries], k, axis=0), 
+        locations[candidates.ravel()], 
+        unit=Unit.MILES
+    ).reshape(n, k)
+
+    keep = valid & (dists > ListingSimilarity.MIN_DISTANCE)
+    keep &= np.cumsum(keep, axis=1) <= ListingSimilarity.TOP_N
+    return keep
+
+
+def filter_by_distance_batch(
+    top_indices: np.ndarray,
+    df: pd.DataFrame
+) -> List[List[int]]:
+    """ vectorized version of `filter_by_distance` for all listings at once (see `distance_mask`)
+
+    Args:
+        top_indices (np.ndarray): positional indices of candidates of shape (n, k), 
+            ordered by preference and padded with -1 (see `top_k_similar`)
+        df (pd.DataFrame): all data
+
+    Returns:
+        List[List[int]]: for each listing, list of ids outside of the distance threshold
+    """
+    keep = distance_mask(top_indices, df)
+    ids = df.id.to_numpy()
+    return [ids[top_indices[i][keep[i]]].tolist() for i in range(len(top_indices))]
+
+
+def similar_listing_rows(
+    top_indices: np.ndarray,
+    top_scores: np.ndarray,
+    df: pd.DataFrame,
+    queries: np.ndarray=None
+) -> pd.DataFrame:
+    """ builds the rows of the similar listing table from the candidates of all listings,
+        keeping the candidates outside of the distance threshold (see `distance_mask`).
+        Listings left without similar listings get a `Listing.NO_SIMILAR_ID` row, so they
+        are not matched again on demand.
+
+    Args:
+        top_indices (np.ndarray): positional indices of candidates of shape (n, k), 
+            ordered by preference and padded with -1 (see `top_k_similar`)
+        top_scores (np.ndarray): cosine similarities of the candidates of shape (n, k)
+        df (pd.DataFrame): all data
+        queries (np.ndarray, optional): positional indices of the listings the candidates 
+            belong to (see `top_k_similar`). Defaults to None (all listings).
+
+    Returns:
+        pd.DataFrame: `listing_id`, `rank`, `similar_id` and `score` of every similar listing
+    """
+    keep = distance_mask(top_indices, df, queries)
+    rows, _ = np.nonzero(keep)
+    ids = df.id.to_numpy()
+    listing_ids = ids if queries is None else ids[queries]
+    unmatched = listing_ids[~keep.any(axis=1)]
+    return pd.DataFrame({
+        'listing_id': np.concatenate([listing_ids[rows], unmatched]),
+        'rank': np.concatenate([(np.cumsum(keep, axis=1) - 1)[keep], np.zeros(len(unmatched), dtype=np.int64)]),
+        'similar_id': np.concatenate([ids[top_indices[keep]], np.full(len(unmatched), Listing.NO_SIMILAR_ID)]),
+        'score': np.concatenate([top_scores[keep].astype(np.float64), np.full(len(unmatched), np.nan)]),
+    })
+
+
 def apply_heuristic_filters(
     scores: np.ndarray, 
     df: pd.DataFrame
@@ -93,59 +267,250 @@ def populate_db(
     df: pd.DataFrame, 
     db: Database
 ) -> None:
-    """ populates the database with listings from the dataframe """
-    listings = list(df.T.to_dict().values())
-    for listing in listings:
-        for key, val in listing.items():
-            if pd.isna(val):
-                listing[key] = None
-
-    cols = list(listings[0].keys())
-    db.executemany(f'INSERT INTO listing ({", ".join(cols)}) VALUES (:{", :".join(cols)});', listings)
+    """ populates the database with listings from the dataframe (see `bulk_load`) and creates their indexes """
+    bulk_load(db, 'listing', df, indexes=du.LISTING_INDEXES)
     return
 
 
+def populate_similar_listings(
+    similar_df: pd.DataFrame, 
+    db: Database
+) -> None:
+    """ populates the similar listing table with rows built by `similar_listing_rows`
+        and creates its indexes
+    """
+    bulk_load(db, 'similar_listing', similar_df, indexes=du.SIMILAR_LISTING_INDEXES)
+    return
+
+
+def stage_load(
+    raw_path: str, 
+    paths: Dict[str, str]
+) -> None:
+    """ load stage: cleans the raw listings and writes them as parquet """
+    du.load_listings(raw_path).to_parquet(paths['listings.parquet'])
+
+
+def stage_embed(
+    listings_path: str, 
+    device: str, 
+    batch_size: int, 
+    embedder_kwargs: Dict, 
+    paths: Dict[str, str]
+) -> None:
+    """ embed stage: computes the embeddings of all listings """
+    df = pd.read_parquet(listings_path)
+
+    embedding_cache = EmbeddingCache()
+    listing_embedder = ListingEmbedder(device=device, cache=embedding_cache, **embedder_kwargs)
+    embeddings = listing_embedder.from_dataframe(df, batch_size)
+    listing_embedder.close()
+    np.save(paths['embeddings.npy'], np.asarray(embeddings, dtype=np.float32))
+
+    cache_stats = embedding_cache.stats()
+    print((f'Embedding cache: {cache_stats["hits"]} hits, {cache_stats["misses"]} misses '
+           f'({cache_stats["hit_rate"]:.1%} hit rate), {cache_stats["evictions"]} evictions, '
+           f'{cache_stats["entries"]} entries'))
+    embedding_cache.close()
+
+
+def stage_similarity(
+    listings_path: str, 
+    embeddings_path: str, 
+    k: int, 
+    block_size: int, 
+    paths: Dict[str, str]
+) -> None:
+    """ similarity stage: finds the top k candidates of all listings """
+    df = pd.read_parquet(listings_path)
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+
+    top_n_similar, top_n_scores = top_k_similar(embeddings, df, k, block_size)
+    np.save(paths['indices.npy'], top_n_similar)
+    np.save(paths['scores.npy'], top_n_scores)
+
+
+def stage_neighbors(
+    listings_path: str, 
+    indices_path: str, 
+    scores_path: str, 
+    paths: Dict[str, str]
+) -> None:
+    """ neighbors stage: applies the distance filter and builds the similar listing rows """
+    df = pd.read_parquet(listings_path)
+    similar_df = similar_listing_rows(np.load(indices_path), np.load(scores_path), df)
+    similar_df.to_parquet(paths['similar_listings.parquet'])
+
+
+def stage_database(
+    listings_path: str, 
+    embeddings_path: str, 
+    similar_listings_path: str, 
+    paths: Dict[str, str]
+) -> None:
+    """ database stage: populates a new database with the listings, their embeddings 
+        and their similar listings
+    """
+    db_path = paths['airbnb.db']
+    if path.exists(db_path):
+        os.remove(db_path)
+
+    df = pd.read_parquet(listings_path)
+    df['embedding'] = [encode_embedding(embedding) for embedding in np.load(embeddings_path, mmap_mode='r')]
+    df['log_price'] = du.log_price(df.price.to_numpy(dtype=np.float64))
+
+    # populate database, indexes are created after the data is in
+    db_setup(create_indexes=False, db_name=db_path)
+    print('Populating database with listings and precomputed embeddings...')
+    db = Database(db_path)
+    populate_db(df, db)
+
+    print('Populating database with similar listings...')
+    populate_similar_listings(pd.read_parquet(similar_listings_path), db)
+
+    print('Indexing listing locations...')
+    listing_location_setup(db)
+    db.close()
+
+
+def install_database(db_path: str, timeout: float=30.) -> None:
+    """ replaces the project database with a database built by `stage_database`.
+        An existing database is overwritten in place with the sqlite backup API rather than
+        replaced on disk: the write-ahead log of a running web service is never deleted, its 
+        uncommitted writes are not lost and its connections read the new database on their next query.
+
+    Args:
+        db_path (str): path of the new database
+        timeout (float, optional): seconds to wait for other connections to release the 
+            database. Defaults to 30.
+
+    Raises:
+        RuntimeError: if the existing database stays locked by another connection
+    """
+    if not path.exists(pc.DATABASE_PATH):
+        if not path.exists(path.dirname(pc.DATABASE_PATH)):
+            os.makedirs(path.dirname(pc.DATABASE_PATH))
+
+        # journal files left by a deleted database must not be applied to the new one
+        for suffix in ['-wal', '-shm', '-journal']:
+            if path.exists(pc.DATABASE_PATH + suffix):
+                os.remove(pc.DATABASE_PATH + suffix)
+
+        tmp_path = f'{pc.DATABASE_PATH}.tmp'
+        shutil.copyfile(db_path, tmp_path)
+        os.replace(tmp_path, pc.DATABASE_PATH)
+        return
+
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(pc.DATABASE_PATH, timeout=timeout)
+    try:
+        # the write-ahead log must be fully checkpointed, i.e. no other connection is writing
+        busy, _, _ = target.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        if busy:
+            raise RuntimeError(f'{pc.DATABASE_PATH} is locked by another connection, stop the web service and try again')
+        source.backup(target)
+        # writes the new pages to the database file, where the response cache of the web service sees them
+        target.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    except sqlite3.OperationalError as e:
+        raise RuntimeError(f'could not install the database into {pc.DATABASE_PATH}: {e}') from e
+    finally:
+        target.close()
+        source.close()
+
+
 def precompute_and_make_db(
     device: str, 
-    batch_size: int
+    batch_size: int,
+    block_size: int=SIMILARITY_BLOCK_SIZE,
+    embedder_kwargs: Dict=None,
+    force: bool=False,
+    profiling: bool=None
 ) -> None:
-    """ precomputes embeddings for all listings and populates the database from a dataframe
+    """ precomputes embeddings and similar listings for all listings and populates the database.
+        Runs as a checkpointed pipeline (see `Pipeline`) of load, embed, similarity, neighbors 
+        and database stages. A rerun resumes from the first stage whose parameters or inputs
+        changed, e.g. changing `MIN_DISTANCE` does not recompute the embeddings.
 
     Args:
         device (str): device for computing embeddings (cuda / cpu)
-        batch_size (int): batch size for computing embeddings and populating the database
+        batch_size (int): batch size for computing embeddings
+        block_size (int, optional): tile size for the blockwise similarity search. 
+            Defaults to SIMILARITY_BLOCK_SIZE.
+        embedder_kwargs (Dict, optional): extra `ListingEmbedder` arguments, e.g. tokenizer 
+            workers, torch threads or model replicas. Defaults to None.
+        force (bool, optional): whether to rerun all stages. Defaults to False.
+        profiling (bool, optional): whether to write a sampled profile of every stage that runs
+            to pc.PROFILES_DIR. Defaults to the `PROFILING` env var.
     """
-    # load data
-    df = du.load_nyc_listings()
+    embedder_kwargs = embedder_kwargs or {}
+    pipeline = Pipeline(force=force, profiling=profiling)
+
+    raw_path = du.download_nyc_listings()
+    raw_stat = os.stat(raw_path)
+    listings = pipeline.run(
+        'load', partial(stage_load, raw_path), ['listings.parquet'],
+        params={'raw': [raw_path, raw_stat.st_size, raw_stat.st_mtime_ns], 'columns': du.COLS_TO_KEEP}
+    )['listings.parquet']
 
     print('Compute all listings embeddings...')
-    listing_embedder = ListingEmbedder(device=device)
-    embeddings = listing_embedder.from_dataframe(df, batch_size)
+    embeddings = pipeline.run(
+        'embed', partial(stage_embed, listings, device, batch_size, embedder_kwargs), ['embeddings.npy'],
+        params={'model': ListingEmbedder.MODEL_NAME, 'backend': embedder_kwargs.get('backend', 'torch')},
+        inputs=['load']
+    )['embeddings.npy']
 
     print('Find similar listings and apply heuristic filters...')
-    cos_similarities = embeddings @ embeddings.T
-    cos_similarities = apply_heuristic_filters(cos_similarities, df)
-    top_n_similar = np.argsort(cos_similarities, axis=1)[:, -ListingSimilarity.TOP_N * 10:]
-    top_n_similar = top_n_similar[:, ::-1]
+    candidates = pipeline.run(
+        'similarity', partial(stage_similarity, listings, embeddings, ListingSimilarity.TOP_N * 10, block_size),
+        ['indices.npy', 'scores.npy'],
+        params={
+            'k': ListingSimilarity.TOP_N * 10, 
+            'max_log_price_diff': ListingSimilarity.MAX_LOG_PRICE_DIFF,
+            'min_cos_similarity': ListingSimilarity.MIN_COS_SIMILARITY
+        },
+        inputs=['load', 'embed']
+    )
+    similar_listings = pipeline.run(
+        'neighbors', partial(stage_neighbors, listings, candidates['indices.npy'], candidates['scores.npy']),
+        ['similar_listings.parquet'],
+        params={
+            'top_n': ListingSimilarity.TOP_N, 'min_distance': ListingSimilarity.MIN_DISTANCE,
+            'no_similar_id': Listing.NO_SIMILAR_ID
+        },
+        inputs=['load', 'similarity']
+    )['similar_listings.parquet']
 
-    # serialize and add embeddings to dataframe
-    df['embedding'] = df.apply(lambda row: pickle.dumps(embeddings[row.name].tolist()), axis=1)
-    df['similar_listings'] = df.apply(lambda row: pickle.dumps(filter_by_distance(row, df.iloc[top_n_similar[row.name]])), axis=1)
+    db_path = pipeline.run(
+        'database', partial(stage_database, listings, embeddings, similar_listings), ['airbnb.db'],
+        params={
+            'embedding_dtype': str(EMBEDDING_DTYPE),
+            'schemas': [
+                du.LISTING_TABLE_SCHEMA, du.LISTING_INDEXES, du.SIMILAR_LISTING_TABLE_SCHEMA, du.SIMILAR_LISTING_INDEXES,
+                du.LISTING_LOCATION_SCHEMA, du.LISTING_LOCATION_TRIGGERS
+            ]
+        },
+        inputs=['load', 'embed', 'neighbors']
+    )['airbnb.db']
 
-    # populate database
-    db_setup()
-    print('Populating database with listings and precomputed embeddings...')
-    db = Database()
-    for i in tqdm(range(0, df.shape[0], batch_size)):
-        populate_db(df.iloc[i:i+batch_size], db)
-    db.close()
+    if pipeline.ran('database') or not path.exists(pc.DATABASE_PATH):
+        print('Installing the database and writing the embedding matrix...')
+        install_database(db_path)
+        EmbeddingStore().save(pd.read_parquet(listings, columns=['id']).id.to_numpy(), np.load(embeddings))
+
+    pipeline.report()
 
 
 if __name__ == '__main__':
-    import project_config as pc
-    
-    if not path.exists(pc.DATABASE_PATH):
-        device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-        precompute_and_make_db(device=device, batch_size=400 if device == 'cuda:0' else 64)
-    else:
-        print('Database already exists. Delete the database and try again if necessary.')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Precompute similar listings and populate the database')
+    parser.add_argument('--force', action='store_true', help='rerun all stages, even if they are up to date')
+    parser.add_argument('--profile', action='store_true', help='profile every stage that runs, as with PROFILING=1')
+    args = parser.parse_args()
+
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    precompute_and_make_db(
+        device=device, 
+        batch_size=400 if device == 'cuda:0' else 64,
+        embedder_kwargs=None if device == 'cuda:0' else {'num_tokenizer_workers': 2},
+        force=args.force,
+        profiling=True if args.profile else None
+    )
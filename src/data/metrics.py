@@ -0,0 +1,182 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import math
+import bisect
+import threading
+from typing import List, Tuple
+
+# buckets (in seconds) of latency histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+
+class MetricsRegistry:
+    """ A set of metrics rendered together in the Prometheus text format (see `render`) """
+    def __init__(self) -> None:
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def register(self, metric: 'Metric') -> 'Metric':
+        """ adds a metric to the registry. A metric is defined again when its module is imported 
+            twice (e.g. as `database` and `data.database`) or reloaded: the registered metric is
+            kept if it has the same type, labels and buckets, otherwise it is replaced.
+
+        Returns:
+            Metric: the registered metric, whose values `metric` should share
+        """
+        with self.__lock:
+            registered = self.__metrics.get(metric.name, None)
+            if registered is not None and registered._definition() == metric._definition():
+                return registered
+            self.__metrics[metric.name] = metric
+            return metric
+
+    def render(self) -> str:
+        """ returns all metrics in the Prometheus text exposition format (version 0.0.4) """
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        return ''.join(metric.render() for metric in metrics)
+
+
+REGISTRY = MetricsRegistry()
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    """ A named metric with a value per combination of label values.
+        Updates only take a lock and touch a dict, the text format is built when scraped.
+    """
+    TYPE = None
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: List[str]=None,
+        registry: MetricsRegistry=REGISTRY
+    ) -> None:
+        """ initializes a metric and adds it to a registry
+
+        Args:
+            name (str): metric name, e.g. `db_query_duration_seconds`
+            documentation (str): help text of the metric
+            label_names (List[str], optional): names of the labels. Defaults to None (no labels).
+            registry (MetricsRegistry, optional): registry of the metric. Defaults to REGISTRY.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names or [])
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registered = registry.register(self)
+            # both definitions of a metric update the same values
+            self._values = registered._values
+            self._lock = registered._lock
+
+    def _definition(self) -> Tuple:
+        """ returns what a metric defined again must match to share the values of this metric """
+        return (self.TYPE, self.label_names)
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        """ returns the (name suffix, formatted labels, value) of every sample """
+        with self._lock:
+            return [('', _format_labels(self.label_names, labels), value) for labels, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+        lines += [f'{self.name}{suffix}{labels} {_format_value(value)}' for suffix, labels, value in self._samples()]
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """ A monotonically increasing value, e.g. a number of requests """
+    TYPE = 'counter'
+
+    def inc(self, labels: Tuple=(), amount: float=1.) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.) + amount
+
+
+class Gauge(Metric):
+    """ A value that goes up and down, e.g. a number of requests in flight """
+    TYPE = 'gauge'
+
+    def inc(self, labels: Tuple=(), amount: float=1.) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.) + amount
+
+    def dec(self, labels: Tuple=(), amount: float=1.) -> None:
+        self.inc(labels, -amount)
+
+    def set(self, value: float, labels: Tuple=()) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """ Counts of observations in cumulative buckets, with their sum and count """
+    TYPE = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: List[str]=None,
+        buckets: Tuple[float, ...]=LATENCY_BUCKETS,
+        registry: MetricsRegistry=REGISTRY
+    ) -> None:
+        """ initializes a histogram and adds it to a registry
+
+        Args:
+            name (str): metric name, e.g. `db_query_duration_seconds`
+            documentation (str): help text of the metric
+            label_names (List[str], optional): names of the labels. Defaults to None (no labels).
+            buckets (Tuple[float, ...], optional): sorted upper bounds of the buckets,
+                a `+Inf` bucket is added. Defaults to LATENCY_BUCKETS.
+            registry (MetricsRegistry, optional): registry of the metric. Defaults to REGISTRY.
+        """
+        assert 'le' not in (label_names or []), '`le` is reserved for the bucket bounds'
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names, registry)
+
+    def _definition(self) -> Tuple:
+        return super()._definition() + (self.buckets,)
+
+    def observe(self, value: float, labels: Tuple=()) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels, None)
+            if state is None:
+                # per bucket counts (the last bucket is +Inf), sum
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.]
+            state[0][index] += 1
+            state[1] += value
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+
+        samples = []
+        bounds = [_format_value(bound) for bound in self.buckets + (math.inf,)]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                samples.append(('_bucket', _format_labels(self.label_names + ('le',), labels + (bound,)), cumulative))
+            formatted = _format_labels(self.label_names, labels)
+            samples.append(('_sum', formatted, total))
+            samples.append(('_count', formatted, cumulative))
+        return samples
@@ -0,0 +1,143 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import json
+import time
+import hashlib
+from os import path
+import project_config as pc
+from data.profiling import profile
+from typing import Dict, List, Callable, Any
+
+
+class Pipeline:
+    """ A checkpointed sequence of named stages.
+
+        Every stage writes its artifacts under `artifacts_dir`, in files versioned by a key
+        computed from the stage parameters and the keys of the stages it depends on. A manifest
+        records the key of the last completed run of each stage, so a rerun skips the stages
+        whose parameters and inputs are unchanged and resumes from the first stage that is not.
+    """
+    def __init__(
+        self,
+        artifacts_dir: str=None,
+        force: bool=False,
+        profiling: bool=None
+    ) -> None:
+        """ initializes a pipeline and loads its manifest
+
+        Args:
+            artifacts_dir (str, optional): directory of the stage artifacts.
+                Defaults to `pipeline` under pc.BASE_ARTIFACTS_DIR.
+            force (bool, optional): whether to rerun all stages. Defaults to False.
+            profiling (bool, optional): whether to profile every stage that runs and write its 
+                stacks to pc.PROFILES_DIR (see `profile`). Defaults to pc.PROFILING_ENABLED.
+        """
+        self.artifacts_dir = path.join(pc.BASE_ARTIFACTS_DIR, 'pipeline') if not artifacts_dir else artifacts_dir
+        self.manifest_path = path.join(self.artifacts_dir, 'manifest.json')
+        self.force = force
+        self.profiling = pc.PROFILING_ENABLED if profiling is None else profiling
+        self.timings = {}
+
+        if not path.exists(self.artifacts_dir):
+            os.makedirs(self.artifacts_dir)
+
+        self.manifest = {}
+        if path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+
+    def __save_manifest(self) -> None:
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def stage_key(
+        self,
+        name: str,
+        params: Dict,
+        inputs: List[str]
+    ) -> str:
+        """ returns the version of a stage given its parameters and the versions of its inputs """
+        payload = json.dumps({
+            'stage': name,
+            'params': params,
+            'inputs': {stage: self.manifest[stage]['key'] for stage in inputs},
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+    def run(
+        self,
+        name: str,
+        fn: Callable[[Dict[str, str]], Any],
+        artifacts: List[str],
+        params: Dict=None,
+        inputs: List[str]=None
+    ) -> Dict[str, str]:
+        """ runs a stage, unless it already completed with the same parameters and inputs
+
+        Args:
+            name (str): name of the stage
+            fn (Callable[[Dict[str, str]], Any]): stage function, called with the path of each
+                artifact, which it must write
+            artifacts (List[str]): file names of the artifacts of the stage, e.g. `embeddings.npy`
+            params (Dict, optional): json serializable parameters the artifacts depend on. Defaults to None.
+            inputs (List[str], optional): names of the stages whose artifacts are used. Defaults to None.
+
+        Returns:
+            Dict[str, str]: path of each artifact
+        """
+        inputs = inputs or []
+        missing = [stage for stage in inputs if stage not in self.manifest]
+        if missing:
+            raise RuntimeError(f'stage `{name}` depends on stages that did not run: {missing}')
+
+        key = self.stage_key(name, params or {}, inputs)
+        paths = {artifact: path.join(self.artifacts_dir, f'{name}-{key}-{artifact}') for artifact in artifacts}
+
+        entry = self.manifest.get(name, None)
+        if (not self.force and entry and entry['key'] == key
+                and all(path.exists(artifact_path) for artifact_path in paths.values())):
+            print(f'[{name}] up to date, skipping')
+            self.timings[name] = None
+            return paths
+
+        # a stage interrupted while writing its artifacts must not be skipped on the next run
+        previous = self.manifest.pop(name, None)
+        if previous is not None:
+            self.__save_manifest()
+
+        print(f'[{name}] running...')
+        start = time.perf_counter()
+        with profile(f'pipeline-{name}', self.profiling):
+            fn(paths)
+        elapsed = time.perf_counter() - start
+
+        self.manifest[name] = {
+            'key': key,
+            'params': params or {},
+            'inputs': inputs,
+            'artifacts': paths,
+            'seconds': elapsed,
+            'completed_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        self.__save_manifest()
+        self.timings[name] = elapsed
+
+        # artifacts of the replaced version are removed
+        for artifact_path in (previous or {}).get('artifacts', {}).values():
+            if artifact_path not in paths.values() and path.exists(artifact_path):
+                os.remove(artifact_path)
+        print(f'[{name}] done in {elapsed:.1f}s')
+        return paths
+
+    def ran(self, name: str) -> bool:
+        """ whether a stage ran (rather than being skipped) in this pipeline run """
+        return self.timings.get(name, None) is not None
+
+    def report(self) -> None:
+        """ prints the time spent in each stage of this run """
+        for name, seconds in self.timings.items():
+            print(f'{name:>12}: {"skipped" if seconds is None else f"{seconds:.1f}s"}')
+        print(f'{"total":>12}: {sum(seconds for seconds in self.timings.values() if seconds):.1f}s')
@@ -0,0 +1,153 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import re
+import time
+import threading
+from os import path
+import project_config as pc
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+# leaf frames of threads waiting for work, their stacks are not recorded
+IDLE_FRAMES = {('threading.py', 'wait'), ('selectors.py', 'select'), ('queue.py', 'get'), ('thread.py', '_worker')}
+
+
+class StackSampler:
+    """ A sampling profiler of all the threads of the process.
+
+        While at least one recording is active, a background thread takes the Python stacks of
+        all threads every `interval` seconds (see `sys._current_frames`) and counts them in every
+        active recording, in the folded format of flamegraph tools: `thread;frame;...;frame count`.
+        Stacks of idle threads (see `IDLE_FRAMES`) are skipped. Nothing runs while no recording is active.
+    """
+    def __init__(self, interval: float=None) -> None:
+        """ initializes a sampler. The sampling thread is started on the first recording.
+
+        Args:
+            interval (float, optional): seconds between two samples. Defaults to the
+                `PROFILING_INTERVAL_MS` env var or 5 ms.
+        """
+        self.interval = interval if interval else float(pc.ENV_VARS.get('PROFILING_INTERVAL_MS', None) or 5) / 1000
+        self.__recordings = {}
+        self.__next_id = 0
+        self.__lock = threading.Lock()
+        self.__active = threading.Event()
+        self.__thread = None
+        self.__frame_labels = {}
+
+    def start(self) -> int:
+        """ starts a recording
+
+        Returns:
+            int: id of the recording, to pass to `stop`
+        """
+        with self.__lock:
+            recording_id = self.__next_id
+            self.__next_id += 1
+            self.__recordings[recording_id] = {}
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='stack-sampler', daemon=True)
+                self.__thread.start()
+            self.__active.set()
+        return recording_id
+
+    def stop(self, recording_id: int) -> Dict[str, int]:
+        """ stops a recording
+
+        Returns:
+            Dict[str, int]: number of samples of each folded stack
+        """
+        with self.__lock:
+            stacks = self.__recordings.pop(recording_id, {})
+            if not self.__recordings:
+                self.__active.clear()
+        return stacks
+
+    def __frame_label(self, frame) -> str:
+        key = (frame.f_code, frame.f_lineno)
+        label = self.__frame_labels.get(key, None)
+        if label is None:
+            label = self.__frame_labels[key] = (
+                f'{frame.f_code.co_name} ({path.basename(frame.f_code.co_filename)}:{frame.f_lineno})'
+            )
+        return label
+
+    def __sample(self) -> Dict[str, int]:
+        """ returns the folded stacks of all busy threads but the sampling thread """
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = {}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id or (path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(self.__frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(thread_id, str(thread_id)))
+            stack = ';'.join(reversed(labels))
+            stacks[stack] = stacks.get(stack, 0) + 1
+        return stacks
+
+    def __run(self) -> None:
+        while True:
+            self.__active.wait()
+            stacks = self.__sample()
+            with self.__lock:
+                for recording in self.__recordings.values():
+                    for stack, count in stacks.items():
+                        recording[stack] = recording.get(stack, 0) + count
+            time.sleep(self.interval)
+
+
+sampler = StackSampler()
+
+
+def write_folded_stacks(
+    stacks: Dict[str, int],
+    name: str,
+    profiles_dir: str=None
+) -> str:
+    """ writes folded stacks to `<profiles_dir>/<timestamp>-<name>.folded`, e.g. for
+        `flamegraph.pl` or speedscope
+
+    Args:
+        stacks (Dict[str, int]): number of samples of each folded stack
+        name (str): name of the profile, characters other than letters, digits, `.`, `-` and `_` are replaced
+        profiles_dir (str, optional): directory of the profiles. Defaults to pc.PROFILES_DIR.
+
+    Returns:
+        str: path of the profile
+    """
+    profiles_dir = pc.PROFILES_DIR if not profiles_dir else profiles_dir
+    if not path.exists(profiles_dir):
+        os.makedirs(profiles_dir, exist_ok=True)
+
+    timestamp = time.strftime('%Y%m%d-%H%M%S') + f'{time.time() % 1:.3f}'[1:]
+    file_path = path.join(profiles_dir, f'{timestamp}-{re.sub(r"[^A-Za-z0-9_.-]+", "_", name)}.folded')
+    with open(file_path, 'w') as f:
+        f.writelines(f'{stack} {count}\n' for stack, count in stacks.items())
+    return file_path
+
+
+@contextmanager
+def profile(name: str, enabled: bool=None) -> Iterator[None]:
+    """ samples the stacks of all threads while the block runs and writes them (see `write_folded_stacks`)
+
+    Args:
+        name (str): name of the profile
+        enabled (bool, optional): whether to profile the block. Defaults to pc.PROFILING_ENABLED.
+    """
+    enabled = pc.PROFILING_ENABLED if enabled is None else enabled
+    if not enabled:
+        yield
+        return
+
+    recording_id = sampler.start()
+    try:
+        yield
+    finally:
+        stacks = sampler.stop(recording_id)
+        if stacks:
+            print(f'Profile written to {write_folded_stacks(stacks, name)}')
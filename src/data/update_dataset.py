@@ -0,0 +1,374 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import time
+import torch
+import argparse
+import numpy as np
+import pandas as pd
+from typing import List, Tuple, Dict
+from data import utils as du
+from haversine import haversine_vector, Unit
+from data.database import Database, _column_values
+from data.embedding_store import EmbeddingStore, encode_embedding
+from data.make_dataset import top_k_similar, similar_listing_rows, SIMILARITY_BLOCK_SIZE
+from models.listing import Listing
+from models.matching import ListingSimilarity
+from models.embedding_cache import EmbeddingCache
+from models.listing_embedding import ListingEmbedder
+
+# columns of the listings needed by the heuristic filters
+FILTER_COLUMNS = ['price', 'neighbourhood_cleansed', 'latitude', 'longitude']
+
+
+def _fetch_by_ids(
+    db: Database,
+    query: str,
+    ids: List[int]
+) -> List[Dict]:
+    """ runs a query with an `IN ({})` placeholder once per chunk of ids and returns all rows """
+    ids = [int(id) for id in ids]
+    rows = []
+    for i in range(0, len(ids), Listing.QUERY_CHUNK_SIZE):
+        chunk = ids[i:i + Listing.QUERY_CHUNK_SIZE]
+        rows.extend(db.fetch_all(query.format(', '.join(['?'] * len(chunk))), chunk))
+    return rows
+
+
+def diff_listings(
+    df: pd.DataFrame,
+    db: Database
+) -> Tuple[List[int], List[int], List[int]]:
+    """ compares a snapshot of all listings with the listings in the database
+
+    Args:
+        df (pd.DataFrame): all listings, as returned by `du.load_listings`
+        db (Database): database object
+
+    Returns:
+        Tuple[List[int], List[int], List[int]]: ids of the added listings, of the listings
+            with a changed column and of the removed listings
+    """
+    stored = pd.DataFrame(
+        db.fetch_all(f'SELECT id, {", ".join(Listing.ITEM_COLUMNS)} FROM listing'),
+        columns=['id'] + Listing.ITEM_COLUMNS
+    ).set_index('id')
+    snapshot = df.set_index('id')
+
+    added = snapshot.index.difference(stored.index)
+    removed = stored.index.difference(snapshot.index)
+    common = snapshot.index.intersection(stored.index)
+
+    changed = np.zeros(len(common), dtype=bool)
+    for col in Listing.ITEM_COLUMNS:
+        new = snapshot.loc[common, col].astype(object)
+        old = stored.loc[common, col].astype(object)
+        changed |= ((new != old) & ~(new.isna() & old.isna())).to_numpy()
+
+    return added.tolist(), common[changed].tolist(), removed.tolist()
+
+
+def write_listings(
+    df: pd.DataFrame,
+    embeddings: np.ndarray,
+    removed_ids: List[int],
+    db: Database,
+    commit: bool=True
+) -> None:
+    """ inserts or replaces the given listings with their embeddings and log prices and deletes
+        the removed listings and their similar listings, in a single transaction
+
+    Args:
+        df (pd.DataFrame): new or changed listings
+        embeddings (np.ndarray): embeddings of the listings of shape (m, d)
+        removed_ids (List[int]): ids of the listings to delete
+        db (Database): database object
+        commit (bool, optional): whether to commit the transaction, otherwise the caller commits
+            or rolls it back. Defaults to True.
+    """
+    df = df.assign(log_price=du.log_price(df.price.to_numpy(dtype=np.float64)))
+    cols = list(df.columns) + ['embedding']
+    try:
+        db.executemany(
+            f'INSERT OR REPLACE INTO listing ({", ".join(cols)}) VALUES ({", ".join(["?"] * len(cols))})',
+            zip(*[_column_values(df[col]) for col in df.columns], [encode_embedding(e) for e in embeddings]),
+            commit=False
+        )
+        for i in range(0, len(removed_ids), Listing.QUERY_CHUNK_SIZE):
+            chunk = [int(id) for id in removed_ids[i:i + Listing.QUERY_CHUNK_SIZE]]
+            placeholders = ', '.join(['?'] * len(chunk))
+            db.execute(f'DELETE FROM listing WHERE id IN ({placeholders})', chunk, commit=False)
+            db.execute(f'DELETE FROM similar_listing WHERE listing_id IN ({placeholders})', chunk, commit=False)
+        if commit:
+            db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def write_similar_listings(
+    listing_ids: List[int],
+    similar_df: pd.DataFrame,
+    db: Database
+) -> None:
+    """ replaces the similar listings of the given listings in a single transaction
+
+    Args:
+        listing_ids (List[int]): ids of the listings whose similar listings are replaced
+        similar_df (pd.DataFrame): their new rows, built by `similar_listing_rows`
+        db (Database): database object
+    """
+    cols = ['listing_id', 'rank', 'similar_id', 'score']
+    try:
+        for i in range(0, len(listing_ids), Listing.QUERY_CHUNK_SIZE):
+            chunk = [int(id) for id in listing_ids[i:i + Listing.QUERY_CHUNK_SIZE]]
+            db.execute(
+                f'DELETE FROM similar_listing WHERE listing_id IN ({", ".join(["?"] * len(chunk))})',
+                chunk, commit=False
+            )
+        db.executemany(
+            f'INSERT INTO similar_listing ({", ".join(cols)}) VALUES (?, ?, ?, ?)',
+            zip(*[_column_values(similar_df[col]) for col in cols]),
+            commit=False
+        )
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def neighbor_thresholds(
+    store: EmbeddingStore,
+    embeddings: np.ndarray,
+    db: Database
+) -> np.ndarray:
+    """ computes, for every stored listing, the similarity a listing needs to enter its similar
+        listings: the similarity of its least similar listing if it has `TOP_N` of them,
+        `MIN_COS_SIMILARITY` otherwise. Legacy similar listings without a score are scored
+        with the embeddings.
+
+    Args:
+        store (EmbeddingStore): loaded embedding store
+        embeddings (np.ndarray): l2 normalized embeddings of the store of shape (n, d)
+        db (Database): database object
+
+    Returns:
+        np.ndarray: thresholds of shape (n,), aligned with the store
+    """
+    thresholds = np.full(len(store.ids), ListingSimilarity.MIN_COS_SIMILARITY, dtype=np.float64)
+    rows = db.fetch_all(
+        'SELECT listing_id, COUNT(*) AS num_similar, COUNT(score) AS num_scored, MIN(score) AS min_score '
+        'FROM similar_listing GROUP BY listing_id'
+    )
+    full = [row for row in rows if row['num_similar'] >= ListingSimilarity.TOP_N]
+
+    scored = [row for row in full if row['num_scored'] == row['num_similar']]
+    positions = store.rows([row['listing_id'] for row in scored])
+    thresholds[positions[positions >= 0]] = np.array([row['min_score'] for row in scored])[positions >= 0]
+
+    legacy = [row['listing_id'] for row in full if row['num_scored'] < row['num_similar']]
+    pairs = _fetch_by_ids(db, 'SELECT listing_id, similar_id FROM similar_listing WHERE listing_id IN ({})', legacy)
+    if pairs:
+        listing_rows = store.rows([pair['listing_id'] for pair in pairs])
+        similar_rows = store.rows([pair['similar_id'] for pair in pairs])
+        valid = (listing_rows >= 0) & (similar_rows >= 0)
+        scores = np.einsum('ij,ij->i', embeddings[listing_rows[valid]], embeddings[similar_rows[valid]])
+        min_scores = pd.Series(scores).groupby(listing_rows[valid]).min()
+        thresholds[min_scores.index.to_numpy()] = min_scores.to_numpy()
+    return thresholds
+
+
+def affected_listings(
+    queries: np.ndarray,
+    embeddings: np.ndarray,
+    corpus: pd.DataFrame,
+    thresholds: np.ndarray,
+    block_size: int=SIMILARITY_BLOCK_SIZE
+) -> np.ndarray:
+    """ finds the listings whose similar listings would change because of new or changed listings,
+        i.e. the listings for which a new or changed listing passes the heuristic and distance
+        filters with a similarity above their threshold (see `neighbor_thresholds`)
+
+    Args:
+        queries (np.ndarray): positional indices of the new or changed listings in the corpus
+        embeddings (np.ndarray): l2 normalized embeddings of the corpus of shape (n, d)
+        corpus (pd.DataFrame): `FILTER_COLUMNS` of all listings, aligned with `embeddings`
+        thresholds (np.ndarray): thresholds of all listings of shape (n,)
+        block_size (int, optional): tile size. Defaults to SIMILARITY_BLOCK_SIZE.
+
+    Returns:
+        np.ndarray: positional indices of the affected listings
+    """
+    n = embeddings.shape[0]
+    prices = corpus.price.to_numpy(dtype=np.float64, copy=True)
+    prices[prices == 0] = 1
+    log_prices = np.log10(prices)
+    neighbourhoods = pd.factorize(corpus.neighbourhood_cleansed)[0]
+    locations = corpus[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+
+    affected = np.zeros(n, dtype=bool)
+    for row_start in range(0, len(queries), block_size):
+        rows = queries[row_start:row_start + block_size]
+        for col_start in range(0, n, block_size):
+            col_end = min(col_start + block_size, n)
+            scores = embeddings[rows] @ embeddings[col_start:col_end].T
+
+            # filters are symmetric, a changed listing enters the similar listings of the listings it matches
+            mask = np.abs(log_prices[rows, None] - log_prices[col_start:col_end]) <= ListingSimilarity.MAX_LOG_PRICE_DIFF
+            mask &= neighbourhoods[rows, None] != neighbourhoods[col_start:col_end]
+            mask &= scores > np.maximum(thresholds[col_start:col_end], ListingSimilarity.MIN_COS_SIMILARITY)
+
+            query_idx, col_idx = np.nonzero(mask)
+            if not len(col_idx):
+                continue
+            dists = haversine_vector(
+                locations[rows[query_idx]], locations[col_start + col_idx], unit=Unit.MILES
+            )
+            affected[col_start + col_idx[dists > ListingSimilarity.MIN_DISTANCE]] = True
+
+    return np.flatnonzero(affected)
+
+
+def update_neighbor_graph(
+    df: pd.DataFrame,
+    removed_ids: List[int],
+    embedder: ListingEmbedder,
+    batch_size: int=64,
+    db: Database=None,
+    store: EmbeddingStore=None,
+    block_size: int=SIMILARITY_BLOCK_SIZE
+) -> List[int]:
+    """ applies a delta of new, changed and removed listings without recomputing the whole
+        similarity graph:
+            1. embeds the new and changed listings only
+            2. writes them, with their embeddings, and deletes the removed listings
+            3. updates the embedding matrix, before the database write is committed so a failed
+               update leaves both unchanged
+            4. finds the listings whose similar listings change: the new and changed listings,
+               the listings that had a changed or removed listing among their similar listings
+               and the listings a new or changed listing now qualifies for (see `affected_listings`)
+            5. recomputes the similar listings of these listings only, against all listings
+
+    Args:
+        df (pd.DataFrame): new and changed listings, with the columns of `du.load_listings`
+        removed_ids (List[int]): ids of the removed listings
+        embedder (ListingEmbedder): embedder of the new and changed listings
+        batch_size (int, optional): batch size for computing embeddings. Defaults to 64.
+        db (Database, optional): database object. Defaults to the project database.
+        store (EmbeddingStore, optional): embedding store. Defaults to the project store.
+        block_size (int, optional): tile size for the similarity search. Defaults to SIMILARITY_BLOCK_SIZE.
+
+    Raises:
+        RuntimeError: if there is no embedding matrix to update
+
+    Returns:
+        List[int]: ids of the listings whose similar listings were recomputed
+    """
+    db = db if db else Database()
+    store = store if store else EmbeddingStore()
+    if not store.exists():
+        raise RuntimeError('no embedding matrix found. Run `make_dataset.py` or `embedding_store.py` first.')
+
+    changed_ids = df.id.tolist()
+    removed_ids = [int(id) for id in removed_ids]
+    if not changed_ids and not removed_ids:
+        return []
+
+    print(f'Embedding {len(changed_ids)} new or changed listings...')
+    embeddings = (embedder.from_dataframe(df, batch_size) if changed_ids
+                  else np.empty((0, store.load().embeddings.shape[1]), dtype=np.float32))
+
+    # listings whose similar listings contain a listing about to change or disappear
+    referencing_ids = {row['listing_id'] for row in _fetch_by_ids(
+        db, 'SELECT DISTINCT listing_id FROM similar_listing WHERE similar_id IN ({})', changed_ids + removed_ids
+    )}
+    referencing_ids = list(referencing_ids.difference(removed_ids))
+
+    print(f'Writing {len(changed_ids)} listings and removing {len(removed_ids)} listings...')
+    write_listings(df, embeddings, removed_ids, db, commit=False)
+    try:
+        store.update(changed_ids, embeddings, removed_ids)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+    corpus = pd.DataFrame(
+        db.fetch_all(f'SELECT id, {", ".join(FILTER_COLUMNS)} FROM listing WHERE embedding IS NOT NULL'),
+        columns=['id'] + FILTER_COLUMNS
+    )
+    corpus = corpus.set_index('id').reindex(store.ids).reset_index()
+    if corpus[FILTER_COLUMNS].isna().values.any():
+        raise RuntimeError('the embedding matrix is out of sync with the database')
+    vectors = np.asarray(store.embeddings, dtype=np.float32)
+
+    print('Finding the listings whose similar listings change...')
+    queries = store.rows(changed_ids)
+    thresholds = neighbor_thresholds(store, vectors, db)
+    affected = affected_listings(queries, vectors, corpus, thresholds, block_size)
+    referencing = store.rows(referencing_ids)
+    recompute = np.union1d(np.union1d(queries, referencing[referencing >= 0]), affected)
+    print((f'{len(recompute)} listings to update: {len(queries)} new or changed, '
+           f'{len(referencing_ids)} referencing a changed or removed listing, {len(affected)} matched'))
+
+    top_indices, top_scores = top_k_similar(vectors, corpus, ListingSimilarity.TOP_N * 10, block_size, recompute)
+    similar_df = similar_listing_rows(top_indices, top_scores, corpus, recompute)
+    recomputed_ids = store.ids[recompute].tolist()
+    write_similar_listings(recomputed_ids, similar_df, db)
+
+    for id in set(recomputed_ids).union(removed_ids):
+        Listing._notify_write(id)
+    return recomputed_ids
+
+
+def update_dataset(
+    listings_url: str,
+    device: str,
+    batch_size: int,
+    embedder_kwargs: Dict=None
+) -> None:
+    """ brings the database up to date with a new snapshot of all listings
+        (see `diff_listings` and `update_neighbor_graph`)
+
+    Args:
+        listings_url (str): path or url to the listings csv
+        device (str): device for computing embeddings (cuda / cpu)
+        batch_size (int): batch size for computing embeddings
+        embedder_kwargs (Dict, optional): extra `ListingEmbedder` arguments. Defaults to None.
+    """
+    start = time.perf_counter()
+    df = du.load_listings(listings_url)
+
+    db = Database()
+    added_ids, updated_ids, removed_ids = diff_listings(df, db)
+    print(f'{len(added_ids)} new, {len(updated_ids)} changed and {len(removed_ids)} removed listings')
+
+    # unchanged listing texts are embedding cache hits
+    embedding_cache = EmbeddingCache()
+    listing_embedder = ListingEmbedder(device=device, cache=embedding_cache, **(embedder_kwargs or {}))
+    recomputed_ids = update_neighbor_graph(
+        df[df.id.isin(added_ids + updated_ids)].reset_index(drop=True), removed_ids,
+        listing_embedder, batch_size, db
+    )
+    listing_embedder.close()
+    embedding_cache.close()
+    # writes the update to the database file, where the response cache of the web service sees it
+    db.execute('PRAGMA wal_checkpoint(PASSIVE)')
+    db.close()
+
+    print(f'Updated the similar listings of {len(recomputed_ids)} listings in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply a new snapshot of the listings to the database')
+    parser.add_argument('listings', nargs='?', default=None,
+                        help='path or url to the listings csv. Defaults to the local copy of the NYC listings')
+    args = parser.parse_args()
+
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    update_dataset(
+        args.listings if args.listings else du.download_nyc_listings(),
+        device=device,
+        batch_size=400 if device == 'cuda:0' else 64,
+        embedder_kwargs=None if device == 'cuda:0' else {'num_tokenizer_workers': 2}
+    )
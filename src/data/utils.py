@@ -1,12 +1,16 @@
 import os, sys
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
 
+import time
+import tracemalloc
+import numpy as np
 from os import path
 import pandas as pd
 import urllib.request
 import project_config as pc
 from pydantic import BaseModel, AnyUrl
-from typing import Union
+from typing import Union, Iterator
+from pandas.api.types import union_categoricals
 
 
 NYC_LISTINGS_URL = 'http://data.insideairbnb.com/united-states/ny/new-york-city/2023-06-05/data/listings.csv.gz'
@@ -31,6 +35,26 @@ COLS_TO_KEEP = [
     'host_about'
 ]
 
+# dtypes of the `COLS_TO_KEEP` columns when parsing listings
+LISTING_DTYPES = {
+    'id': 'int64',
+    'listing_url': 'object',
+    'room_type': 'category',
+    'neighbourhood_group_cleansed': 'category',
+    'neighbourhood_cleansed': 'category',
+    'bedrooms': 'float64',
+    'beds': 'float64',
+    'bathrooms_text': 'category',
+    'accommodates': 'float64',
+    'price': 'object',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'property_type': 'category',
+    'description': 'object',
+    'neighborhood_overview': 'object',
+    'host_about': 'object'
+}
+
 LISTING_TABLE_SCHEMA = ('''
     id INTEGER PRIMARY KEY,
     listing_url TEXT NOT NULL,
@@ -49,8 +73,43 @@ LISTING_TABLE_SCHEMA = ('''
     neighborhood_overview TEXT,
     host_about TEXT,
     embedding BLOB,
-    similar_listings BLOB
+    similar_listings BLOB,
+    log_price REAL
 ''')
+# candidate retrieval of the matcher, a range over the price band of every room type.
+# The neighbourhood makes it a covering index of the candidate ids
+LISTING_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS listing_room_type_log_price ON listing (room_type, log_price, neighbourhood_cleansed)',
+    'CREATE INDEX IF NOT EXISTS listing_neighbourhood ON listing (neighbourhood_cleansed)'
+]
+
+# `similar_listings` of `listing` is legacy, similar listings are stored in this table
+SIMILAR_LISTING_TABLE_SCHEMA = ('''
+    listing_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    similar_id INTEGER NOT NULL,
+    score REAL,
+    PRIMARY KEY (listing_id, rank)
+''')
+SIMILAR_LISTING_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS similar_listing_similar_id ON similar_listing (similar_id)'
+]
+
+# R*Tree spatial index of the listing locations, stored as points (min == max)
+LISTING_LOCATION_SCHEMA = 'id, min_lat, max_lat, min_lon, max_lon'
+# keep the spatial index in sync with the listing table
+LISTING_LOCATION_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS listing_location_insert AFTER INSERT ON listing BEGIN
+        INSERT OR REPLACE INTO listing_location VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS listing_location_update AFTER UPDATE OF id, latitude, longitude ON listing BEGIN
+        DELETE FROM listing_location WHERE id = old.id;
+        INSERT OR REPLACE INTO listing_location VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS listing_location_delete AFTER DELETE ON listing BEGIN
+        DELETE FROM listing_location WHERE id = old.id;
+    END''',
+]
                         
 class ListingItem(BaseModel):
     id: int
@@ -70,39 +129,119 @@ class ListingItem(BaseModel):
     neighborhood_overview: Union[str, None] = None
     host_about: Union[str, None] = None
 
-def load_listings(listing_url: str) -> pd.DataFrame:
-    """ loads listings from a url and returns a dataframe with the relevant columns
-        performs basic cleaning on the data including removing $ and , from price.
+class SimilarListingItem(ListingItem):
+    score: Union[float, None] = None
+
+class NearbyListingItem(ListingItem):
+    distance: float
+
+def log_price(price: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+    """ log10 of a price or an array of prices, free listings are treated as $1 """
+    return np.log10(np.where(np.asarray(price) == 0, 1, price))
+
+
+def clean_listings(data_df: pd.DataFrame) -> pd.DataFrame:
+    """ performs basic cleaning on raw listings including removing $ and , from price.
 
     Args:
-        listing_url (str): url to listings csv
+        data_df (pd.DataFrame): raw listings with the `COLS_TO_KEEP` columns
 
     Returns:
-        pd.DataFrame: dataframe with relevant columns
+        pd.DataFrame: cleaned listings
     """
-    data_df = pd.read_csv(listing_url)
-    data_df = data_df[COLS_TO_KEEP]
+    data_df = data_df[COLS_TO_KEEP].copy()
 
-    data_df.price = data_df.price.str.replace('$', '', regex=False).str.replace(',', '', regex=False).astype(float)
+    data_df.price = data_df.price.str.replace('[$,]', '', regex=True).astype(float)
 
     # no room number means either a studio or a shared room
-    data_df.bedrooms.fillna(0, inplace=True)
-    data_df.bedrooms = data_df.bedrooms.astype('Int64')
+    data_df.bedrooms = data_df.bedrooms.fillna(0).astype('Int64')
 
     data_df.beds = data_df.beds.astype('Int64')
     data_df.accommodates = data_df.accommodates.astype('Int64')
 
     return data_df
 
-def load_nyc_listings() -> pd.DataFrame:
-    """ loads NYC listings from local copy or a url and returns a dataframe with the relevant columns """
+
+def iter_listings(
+    listing_url: str, 
+    chunksize: int=10000
+) -> Iterator[pd.DataFrame]:
+    """ streams listings from a url in cleaned chunks. Only `COLS_TO_KEEP` are parsed,
+        with explicit dtypes (see `LISTING_DTYPES`).
+
+    Args:
+        listing_url (str): url to listings csv
+        chunksize (int, optional): number of listings per chunk. Defaults to 10000.
+
+    Yields:
+        pd.DataFrame: cleaned chunk of listings
+    """
+    reader = pd.read_csv(listing_url, usecols=COLS_TO_KEEP, dtype=LISTING_DTYPES, chunksize=chunksize)
+    for chunk in reader:
+        yield clean_listings(chunk)
+
+
+def load_listings(
+    listing_url: str, 
+    chunksize: int=10000,
+    verbose: bool=True,
+    trace_memory: bool=False
+) -> pd.DataFrame:
+    """ loads listings from a url and returns a dataframe with the relevant columns
+        performs basic cleaning on the data including removing $ and , from price.
+
+    Args:
+        listing_url (str): url to listings csv
+        chunksize (int, optional): number of listings parsed at once. Defaults to 10000.
+        verbose (bool, optional): whether to report the parse time. Defaults to True.
+        trace_memory (bool, optional): whether to report the peak memory allocated by python and 
+            numpy while parsing, with `tracemalloc`. The buffers of the C parser are not traced and 
+            tracing slows the parse down about 2x. Defaults to False.
+
+    Returns:
+        pd.DataFrame: dataframe with relevant columns
+    """
+    # only the peak of this parse is reported, not the process lifetime peak
+    tracing = trace_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        chunks = list(iter_listings(listing_url, chunksize))
+
+        # categories differ between chunks, so they are merged before concatenating
+        for col, dtype in LISTING_DTYPES.items():
+            if dtype == 'category':
+                categories = union_categoricals([chunk[col] for chunk in chunks]).categories
+                for chunk in chunks:
+                    chunk[col] = chunk[col].cat.set_categories(categories)
+        data_df = pd.concat(chunks, ignore_index=True)
+        elapsed = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] / 2 ** 20 if tracing else None
+    finally:
+        if tracing:
+            tracemalloc.stop()
+
+    if verbose:
+        print(f'Loaded {len(data_df)} listings in {elapsed:.2f}s' + (' (traced)' if tracing else ''))
+    if peak_memory is not None:
+        print(f'Peak memory traced while loading listings: {peak_memory:.0f} MB (excluding the C parser buffers)')
+    return data_df
+
+def download_nyc_listings() -> str:
+    """ downloads NYC listings if there is no local copy and returns the path to the local copy """
     if not path.exists(pc.BASE_RAW_DATA_DIR):
         os.makedirs(pc.BASE_RAW_DATA_DIR)
 
     if not path.exists(NYC_LISTING_LOCAL_PATH):
         print('NYC listings not found locally. Downloading from the web...')
         urllib.request.urlretrieve(NYC_LISTINGS_URL, NYC_LISTING_LOCAL_PATH)
-    return load_listings(NYC_LISTING_LOCAL_PATH)
+    return NYC_LISTING_LOCAL_PATH
+
+
+def load_nyc_listings() -> pd.DataFrame:
+    """ loads NYC listings from local copy or a url and returns a dataframe with the relevant columns """
+    return load_listings(download_nyc_listings())
 
 
 if __name__ == '__main__':
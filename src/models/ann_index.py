@@ -0,0 +1,148 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import numpy as np
+from typing import Tuple
+
+
+class IVFIndex:
+    """ An inverted file (IVF) approximate nearest neighbor index for l2 normalized embeddings.
+
+        The embeddings are clustered with spherical k-means into `num_lists` inverted lists.
+        A query is only scored against the listings of its `num_probes` closest clusters,
+        so `num_probes` trades recall (more probes) for latency (less probes).
+        Probing all lists is equivalent to exact search.
+    """
+    def __init__(
+        self,
+        num_lists: int=None,
+        num_probes: int=16,
+        num_iters: int=10,
+        max_train_size: int=50000,
+        seed: int=0
+    ) -> None:
+        """ initializes an empty index
+
+        Args:
+            num_lists (int, optional): number of clusters. If None, 4 * sqrt(n) is used. Defaults to None.
+            num_probes (int, optional): default number of clusters scored per query. Defaults to 16.
+            num_iters (int, optional): number of k-means iterations. Defaults to 10.
+            max_train_size (int, optional): max number of embeddings used to train the clusters. Defaults to 50000.
+            seed (int, optional): random seed. Defaults to 0.
+        """
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.num_iters = num_iters
+        self.max_train_size = max_train_size
+        self.seed = seed
+
+        self.centroids = None
+        self.vectors = None
+        self.positions = None
+        self.list_offsets = None
+
+    def __len__(self) -> int:
+        return 0 if self.positions is None else len(self.positions)
+
+    @staticmethod
+    def __assign(
+        embeddings: np.ndarray,
+        centroids: np.ndarray,
+        block_size: int=4096
+    ) -> np.ndarray:
+        """ returns the closest centroid of each embedding """
+        assignments = np.empty(embeddings.shape[0], dtype=np.int64)
+        for start in range(0, embeddings.shape[0], block_size):
+            assignments[start:start + block_size] = np.argmax(embeddings[start:start + block_size] @ centroids.T, axis=1)
+        return assignments
+
+    def build(self, embeddings: np.ndarray) -> 'IVFIndex':
+        """ clusters the embeddings and builds the inverted lists
+
+        Args:
+            embeddings (np.ndarray): l2 normalized embeddings of shape (n, d)
+
+        Returns:
+            IVFIndex: self
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        n = embeddings.shape[0]
+        rng = np.random.default_rng(self.seed)
+        num_lists = self.num_lists if self.num_lists else int(4 * np.sqrt(n))
+        num_lists = max(1, min(num_lists, n))
+
+        # spherical k-means on a sample of the embeddings
+        train = embeddings
+        if n > self.max_train_size:
+            train = embeddings[rng.choice(n, self.max_train_size, replace=False)]
+        centroids = train[rng.choice(train.shape[0], num_lists, replace=False)].copy()
+        for _ in range(self.num_iters):
+            assignments = self.__assign(train, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, train)
+            counts = np.bincount(assignments, minlength=num_lists)
+
+            # re-seed empty clusters with random embeddings
+            empty = counts == 0
+            sums[empty] = train[rng.choice(train.shape[0], empty.sum())]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.maximum(norms, 1e-12)
+
+        # inverted lists: embeddings are stored contiguously per cluster
+        assignments = self.__assign(embeddings, centroids)
+        order = np.argsort(assignments, kind='stable')
+        self.centroids = centroids
+        self.vectors = embeddings[order]
+        self.positions = order
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=num_lists))])
+        return self
+
+    def probe(
+        self,
+        query: np.ndarray,
+        num_probes: int=None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """ scores the query against all embeddings in its closest clusters
+
+        Args:
+            query (np.ndarray): l2 normalized query embedding of shape (d,)
+            num_probes (int, optional): number of clusters to score. If None, the
+                index default is used. Defaults to None.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: positions (row in the embeddings used to build the index)
+                and cosine similarities of all probed embeddings (unsorted)
+        """
+        if not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        query = np.asarray(query, dtype=np.float32)
+        num_probes = min(num_probes if num_probes else self.num_probes, self.centroids.shape[0])
+        centroid_scores = self.centroids @ query
+        lists = np.argpartition(-centroid_scores, num_probes - 1)[:num_probes]
+
+        rows = np.concatenate([np.arange(self.list_offsets[l], self.list_offsets[l + 1]) for l in lists])
+        return self.positions[rows], self.vectors[rows] @ query
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        num_probes: int=None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """ returns the approximate top k most similar embeddings to the query
+
+        Args:
+            query (np.ndarray): l2 normalized query embedding of shape (d,)
+            k (int): number of neighbors
+            num_probes (int, optional): number of clusters to score. Defaults to None.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: positions and cosine similarities, sorted by descending similarity
+        """
+        positions, scores = self.probe(query, num_probes)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            positions, scores = positions[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return positions[order], scores[order]
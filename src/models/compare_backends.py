@@ -0,0 +1,100 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from typing import Dict
+from data import utils as du
+from models.matching import ListingSimilarity
+from models.listing_embedding import ListingEmbedder
+from data.make_dataset import top_k_similar, filter_by_distance_batch
+
+
+def embed_timed(
+    df: pd.DataFrame,
+    backend: str,
+    batch_size: int,
+    embedder_kwargs: Dict
+) -> Dict:
+    """ embeds all listings of the dataframe with a backend and times the inference """
+    listing_embedder = ListingEmbedder(device='cpu', backend=backend, **embedder_kwargs)
+    start = time.perf_counter()
+    embeddings = listing_embedder.from_dataframe(df, batch_size)
+    elapsed = time.perf_counter() - start
+    listing_embedder.close()
+    return {'embeddings': embeddings, 'seconds': elapsed, 'listings_per_sec': len(df) / elapsed}
+
+
+def compare_backends(
+    df: pd.DataFrame,
+    backend: str,
+    batch_size: int=64,
+    embedder_kwargs: Dict=None
+) -> Dict:
+    """ compares an inference backend against the fp32 pytorch backend on a set of listings.
+        Reports the throughput of both backends, the cosine drift of the embeddings and
+        how many of the final `similar_listings` lists change.
+
+    Args:
+        df (pd.DataFrame): listings to embed, with a default index
+        backend (str): backend to compare, one of `ListingEmbedder.BACKENDS`
+        batch_size (int, optional): batch size for inference. Defaults to 64.
+        embedder_kwargs (Dict, optional): extra `ListingEmbedder` arguments. Defaults to None.
+
+    Returns:
+        Dict: comparison report
+    """
+    embedder_kwargs = embedder_kwargs or {}
+    reference = embed_timed(df, 'torch', batch_size, embedder_kwargs)
+    candidate = embed_timed(df, backend, batch_size, embedder_kwargs)
+
+    # both embeddings are l2 normalized
+    cosines = np.sum(reference['embeddings'] * candidate['embeddings'], axis=1)
+
+    similar_listings = []
+    for embeddings in [reference['embeddings'], candidate['embeddings']]:
+        top_n_similar, _ = top_k_similar(embeddings, df, ListingSimilarity.TOP_N * 10)
+        similar_listings.append(filter_by_distance_batch(top_n_similar, df))
+
+    num_changed = sum(ref != cand for ref, cand in zip(*similar_listings))
+    overlaps = [
+        len(set(ref) & set(cand)) / len(set(ref) | set(cand))
+        for ref, cand in zip(*similar_listings) if ref or cand
+    ]
+
+    return {
+        'backend': backend,
+        'num_listings': len(df),
+        'torch_listings_per_sec': reference['listings_per_sec'],
+        f'{backend}_listings_per_sec': candidate['listings_per_sec'],
+        'speedup': candidate['listings_per_sec'] / reference['listings_per_sec'],
+        'cosine_drift': {
+            'mean': float(1 - cosines.mean()),
+            'max': float(1 - cosines.min()),
+            'p99': float(1 - np.percentile(cosines, 1)),
+        },
+        'similar_listings': {
+            'num_changed': int(num_changed),
+            'frac_changed': num_changed / len(df),
+            'mean_jaccard': float(np.mean(overlaps)) if overlaps else 1.,
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare a ListingEmbedder inference backend against fp32 pytorch')
+    parser.add_argument('--backend', choices=[b for b in ListingEmbedder.BACKENDS if b != 'torch'], default='torch-int8')
+    parser.add_argument('--sample', type=int, default=2000, help='number of NYC listings to compare on (0 for all)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--num-threads', type=int, default=None)
+    args = parser.parse_args()
+
+    df = du.load_nyc_listings()
+    if args.sample:
+        df = df.sample(n=min(args.sample, len(df)), random_state=0).reset_index(drop=True)
+
+    report = compare_backends(df, args.backend, args.batch_size, {'num_threads': args.num_threads})
+    print(json.dumps(report, indent=2))
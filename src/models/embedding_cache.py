@@ -0,0 +1,133 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import time
+import hashlib
+import numpy as np
+from os import path
+import project_config as pc
+from typing import Dict, List
+from data.database import Database
+
+
+class EmbeddingCache:
+    """ A persistent, size-bounded cache of text embeddings keyed by a hash of (model name, text).
+
+        Backed by a sqlite database under the artifacts directory. When the cache grows over
+        `max_entries`, the least recently used embeddings are evicted.
+    """
+    # max number of sqlite variables in a single query
+    QUERY_CHUNK_SIZE = 500
+
+    def __init__(
+        self,
+        cache_path: str=None,
+        max_entries: int=200000
+    ) -> None:
+        """ initializes the cache and creates the cache database if needed
+
+        Args:
+            cache_path (str, optional): path to the cache database. Defaults to pc.EMBEDDING_CACHE_PATH.
+            max_entries (int, optional): max number of cached embeddings. Defaults to 200000.
+        """
+        self.cache_path = pc.EMBEDDING_CACHE_PATH if not cache_path else cache_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not path.exists(path.dirname(self.cache_path)):
+            os.makedirs(path.dirname(self.cache_path))
+        self.db = Database(self.cache_path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS embedding_cache '
+            '(key BLOB PRIMARY KEY, embedding BLOB NOT NULL, last_access REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS embedding_cache_last_access ON embedding_cache (last_access)')
+
+    @staticmethod
+    def key(model_name: str, text: str) -> bytes:
+        """ returns the cache key of a text embedded by a model """
+        return hashlib.sha256(f'{model_name}\0{text}'.encode('utf-8')).digest()
+
+    def get_many(
+        self,
+        model_name: str,
+        texts: List[str]
+    ) -> List[np.ndarray]:
+        """ looks up the embeddings of the texts
+
+        Args:
+            model_name (str): name of the embedding model
+            texts (List[str]): texts to look up
+
+        Returns:
+            List[np.ndarray]: embedding of each text, None for cache misses
+        """
+        keys = [self.key(model_name, text) for text in texts]
+        found = {}
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), self.QUERY_CHUNK_SIZE):
+            chunk = unique_keys[i:i + self.QUERY_CHUNK_SIZE]
+            rows = self.db.fetch_all(
+                f'SELECT key, embedding FROM embedding_cache WHERE key IN ({", ".join(["?"] * len(chunk))})',
+                chunk
+            )
+            found.update((row['key'], np.frombuffer(row['embedding'], dtype='<f4')) for row in rows)
+
+        if found:
+            now = time.time()
+            self.db.executemany('UPDATE embedding_cache SET last_access = ? WHERE key = ?', [(now, key) for key in found])
+
+        embeddings = [found.get(key, None) for key in keys]
+        num_hits = sum(embedding is not None for embedding in embeddings)
+        self.hits += num_hits
+        self.misses += len(keys) - num_hits
+        return embeddings
+
+    def put_many(
+        self,
+        model_name: str,
+        texts: List[str],
+        embeddings: np.ndarray
+    ) -> None:
+        """ stores the embeddings of the texts and evicts the least recently used entries if needed
+
+        Args:
+            model_name (str): name of the embedding model
+            texts (List[str]): embedded texts
+            embeddings (np.ndarray): embeddings of shape (len(texts), d)
+        """
+        now = time.time()
+        self.db.executemany(
+            'INSERT OR REPLACE INTO embedding_cache (key, embedding, last_access) VALUES (?, ?, ?)',
+            [(self.key(model_name, text), np.asarray(embedding, dtype='<f4').tobytes(), now)
+             for text, embedding in zip(texts, embeddings)]
+        )
+
+        num_entries = len(self)
+        if num_entries > self.max_entries:
+            num_evicted = num_entries - self.max_entries
+            self.db.execute(
+                'DELETE FROM embedding_cache WHERE key IN '
+                '(SELECT key FROM embedding_cache ORDER BY last_access LIMIT :n)',
+                {'n': num_evicted}
+            )
+            self.evictions += num_evicted
+
+    def __len__(self) -> int:
+        return self.db.fetch_one('SELECT COUNT(*) AS n FROM embedding_cache')['n']
+
+    def stats(self) -> Dict:
+        """ returns hit / miss statistics since the cache was opened """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.,
+            'evictions': self.evictions,
+            'entries': len(self),
+        }
+
+    def close(self) -> None:
+        self.db.close()
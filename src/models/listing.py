@@ -1,15 +1,84 @@
 import os, sys
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
 
+import math
+import time
 import pickle
+import numpy as np
 import project_config as pc
+from haversine import haversine_vector, Unit
 from data.database import Database
-from data.utils import ListingItem
-from typing import Dict, Any, Hashable, List
+from data.metrics import Counter
+from data.embedding_store import encode_embedding, decode_embedding
+from data import utils as du
+from data.utils import ListingItem, SimilarListingItem, NearbyListingItem
+from typing import Dict, Any, Hashable, List, Callable
+
+DESERIALIZATIONS = Counter('listing_deserializations_total', 'Number of listings created from database rows')
+DESERIALIZATION_SECONDS = Counter(
+    'listing_deserialization_seconds_total', 'Time spent creating listings from database rows'
+)
+BLOB_DECODES = Counter('listing_blob_decodes_total', 'Number of decoded blob columns', ['column'])
+BLOB_DECODE_SECONDS = Counter(
+    'listing_blob_decode_seconds_total', 'Time spent decoding blob columns', ['column']
+)
+
+
+class LazyProperties(dict):
+    """ A dict of listing properties whose blob columns (`embedding` and `similar_listings`)
+        are stored as returned by the database and only deserialized on first access
+        through `[]` or `get`.
+    """
+    DECODERS = {
+        'embedding': decode_embedding,
+        'similar_listings': pickle.loads,
+    }
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = super().__getitem__(key)
+        if isinstance(value, bytes) and key in self.DECODERS:
+            start = time.perf_counter()
+            value = self.DECODERS[key](value)
+            BLOB_DECODE_SECONDS.inc((key,), time.perf_counter() - start)
+            BLOB_DECODES.inc((key,))
+            super().__setitem__(key, value)
+        return value
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        return self[key] if key in self else default
+
 
 class Listing:
     """ A class to represent a listing on Airbnb
     """
+    # columns needed to create a listing object
+    REQUIRED_COLUMNS = [
+        'listing_url', 'price', 'latitude', 'longitude',
+        'room_type', 'neighbourhood_group_cleansed', 'neighbourhood_cleansed'
+    ]
+    # columns needed to create a `ListingItem`
+    ITEM_COLUMNS = [
+        'listing_url', 'room_type', 'neighbourhood_group_cleansed', 'neighbourhood_cleansed',
+        'bedrooms', 'beds', 'bathrooms_text', 'accommodates', 'price', 'latitude', 'longitude',
+        'property_type', 'description', 'neighborhood_overview', 'host_about'
+    ]
+    BLOB_COLUMNS = ['embedding', 'similar_listings']
+    # columns derived from the other columns when a listing is stored
+    DERIVED_COLUMNS = ['log_price']
+    COLUMNS = ITEM_COLUMNS + BLOB_COLUMNS + DERIVED_COLUMNS
+
+    # max number of sqlite variables in a single query
+    QUERY_CHUNK_SIZE = 500
+    # similar id of the row stored for listings matched without any similar listing,
+    # so they are not matched again. It joins no listing and is never returned.
+    NO_SIMILAR_ID = -1
+
+    # slightly below the mean earth radius of `haversine`, so bounding boxes are conservative
+    EARTH_RADIUS_MI = 3958.0
+
+    # callbacks called with the listing id whenever a listing is written to the db
+    write_listeners: List[Callable[[int], None]] = []
+
     def __init__(
         self, 
         id: int,
@@ -43,7 +112,9 @@ class Listing:
     
     @staticmethod
     def __from_db_dict(db_dict: Dict) -> 'Listing':
-        """ creates a listing object from a dict returned by the database
+        """ creates a listing object from a dict returned by the database.
+            Blob columns are decoded lazily (see `LazyProperties`). The number of listings
+            created and the time spent are recorded (see `DESERIALIZATION_SECONDS`).
 
         Args:
             db_dict (Dict): dictionary returned by the database
@@ -51,26 +122,55 @@ class Listing:
         Returns:
             Listing: listing object
         """
+        start = time.perf_counter()
         listing_id = db_dict.pop('id')
-        db_dict['embedding'] = pickle.loads(db_dict['embedding'])
-        db_dict['similar_listings'] = pickle.loads(db_dict['similar_listings'])
-        return Listing(listing_id, db_dict)
+        listing = Listing(listing_id, LazyProperties(db_dict))
+        DESERIALIZATION_SECONDS.inc(amount=time.perf_counter() - start)
+        DESERIALIZATIONS.inc()
+        return listing
 
     @staticmethod
-    def retrieve_by_id(id: int, db: Database=None) -> 'Listing':
+    def _notify_write(id: int) -> None:
+        """ calls all `write_listeners` with the id of a written listing """
+        for listener in Listing.write_listeners:
+            listener(id)
+
+    @staticmethod
+    def _select(columns: List[str]=None) -> str:
+        """ returns the SELECT clause of a column projection of the listing table, all columns if None
+
+        Raises:
+            ValueError: if a column is not a listing column
+        """
+        if columns is None:
+            return 'SELECT listing.*'
+
+        unknown = set(columns) - set(Listing.COLUMNS)
+        if unknown:
+            raise ValueError(f'unknown listing columns: {sorted(unknown)}')
+        return f'SELECT {", ".join(f"listing.{col}" for col in ["id"] + [col for col in columns if col != "id"])}'
+
+    @staticmethod
+    def retrieve_by_id(
+        id: int, 
+        db: Database=None, 
+        columns: List[str]=None
+    ) -> 'Listing':
         """ retrieves a listing by id
 
         Args:
             id (int): listing id
             db (Database, optional): database object. If None, a new 
                 connection will be opened. Defaults to None.
+            columns (List[str], optional): columns to retrieve, must include 
+                `REQUIRED_COLUMNS`. Defaults to None (all columns).
 
         Returns:
             Listing: listing object
         """
         if not db:
             db = Database()
-        row = db.fetch_one('SELECT * FROM listing WHERE id = :id', {'id': id})
+        row = db.fetch_one(f'{Listing._select(columns)} FROM listing WHERE id = :id', {'id': id})
         if not db:
             db.close()
         
@@ -80,20 +180,36 @@ class Listing:
         return Listing.__from_db_dict(row)
 
     @staticmethod
-    def retrieve_by_ids(ids: List[int], db: Database=None) -> List['Listing']:
+    def retrieve_by_ids(
+        ids: List[int], 
+        db: Database=None, 
+        columns: List[str]=None
+    ) -> List['Listing']:
         """ retrieves listings by ids
 
         Args:
             ids (List[int]): list of listing ids
             db (Database, optional): database object. If None, a new 
                 connection will be opened. Defaults to None.
+            columns (List[str], optional): columns to retrieve, must include 
+                `REQUIRED_COLUMNS`. Defaults to None (all columns).
 
         Returns:
             List[Listing]: list of listing objects
         """
+        ids = list(ids)
+        if not ids:
+            return []
+
         if not db:
             db = Database()
-        rows = db.fetch_all(f'SELECT * FROM listing WHERE id IN ({", ".join([str(id) for id in ids])})')
+        rows = []
+        for i in range(0, len(ids), Listing.QUERY_CHUNK_SIZE):
+            chunk = ids[i:i + Listing.QUERY_CHUNK_SIZE]
+            rows.extend(db.fetch_all(
+                f'{Listing._select(columns)} FROM listing WHERE id IN ({", ".join(["?"] * len(chunk))})',
+                chunk
+            ))
         if not db:
             db.close()
         
@@ -102,11 +218,264 @@ class Listing:
         
         return [Listing.__from_db_dict(row) for row in rows]
 
+    @staticmethod
+    def retrieve_similar(
+        id: int, 
+        db: Database=None, 
+        columns: List[str]=None
+    ) -> List['Listing']:
+        """ retrieves the precomputed similar listings of a listing, most similar first.
+            The similarity score of each similar listing is stored as its `score` property.
+
+        Args:
+            id (int): listing id
+            db (Database, optional): database object. If None, a new 
+                connection will be opened. Defaults to None.
+            columns (List[str], optional): columns of the similar listings to retrieve, 
+                must include `REQUIRED_COLUMNS`. Defaults to None (all columns).
+
+        Returns:
+            List[Listing]: list of similar listings, empty if the listing was matched without
+                any similar listing, or None if it was never matched
+        """
+        if not db:
+            db = Database()
+        # the `NO_SIMILAR_ID` row of a listing matched without similar listings joins no listing
+        rows = db.fetch_all(
+            f'{Listing._select(columns)}, similar_listing.score AS score FROM similar_listing '
+            'LEFT JOIN listing ON listing.id = similar_listing.similar_id '
+            'WHERE similar_listing.listing_id = :id ORDER BY similar_listing.rank',
+            {'id': id}
+        )
+        if not db:
+            db.close()
+
+        if not rows:
+            return None
+        return [Listing.__from_db_dict(row) for row in rows if row['id'] is not None]
+
+    @staticmethod
+    def retrieve_similar_by_ids(
+        ids: List[int], 
+        db: Database=None, 
+        columns: List[str]=None
+    ) -> Dict[int, List['Listing']]:
+        """ retrieves the precomputed similar listings of many listings at once: 
+            one query for the listings and one join for all of their similar listings.
+
+        Args:
+            ids (List[int]): list of listing ids
+            db (Database, optional): database object. If None, a new 
+                connection will be opened. Defaults to None.
+            columns (List[str], optional): columns of the similar listings to retrieve, 
+                must include `REQUIRED_COLUMNS`. Defaults to None (all columns).
+
+        Returns:
+            Dict[int, List[Listing]]: similar listings of each found listing, most similar 
+                first, empty for listings matched without any similar listing, or None for 
+                listings never matched
+        """
+        ids = list(ids)
+        if not db:
+            db = Database()
+
+        similar = {}
+        for i in range(0, len(ids), Listing.QUERY_CHUNK_SIZE):
+            chunk = ids[i:i + Listing.QUERY_CHUNK_SIZE]
+            params = ", ".join(["?"] * len(chunk))
+            for row in db.fetch_all(f'SELECT id FROM listing WHERE id IN ({params})', chunk):
+                similar[row['id']] = None
+
+            # the `NO_SIMILAR_ID` row of a listing matched without similar listings joins no listing
+            rows = db.fetch_all(
+                f'{Listing._select(columns)}, similar_listing.score AS score, '
+                'similar_listing.listing_id AS similar_to FROM similar_listing '
+                'LEFT JOIN listing ON listing.id = similar_listing.similar_id '
+                f'WHERE similar_listing.listing_id IN ({params}) '
+                'ORDER BY similar_listing.listing_id, similar_listing.rank',
+                chunk
+            )
+            for row in rows:
+                similar_to = row.pop('similar_to')
+                if similar_to not in similar:
+                    continue
+                if similar[similar_to] is None:
+                    similar[similar_to] = []
+                if row['id'] is not None:
+                    similar[similar_to].append(Listing.__from_db_dict(row))
+        if not db:
+            db.close()
+
+        return similar
+
+    @staticmethod
+    def retrieve_referencing_ids(id: int, db: Database=None) -> List[int]:
+        """ retrieves the ids of the listings that have a listing among their similar listings
+
+        Args:
+            id (int): listing id
+            db (Database, optional): database object. If None, a new 
+                connection will be opened. Defaults to None.
+
+        Returns:
+            List[int]: ids of the referencing listings
+        """
+        if not db:
+            db = Database()
+        rows = db.fetch_all('SELECT listing_id FROM similar_listing WHERE similar_id = :id', {'id': id})
+        if not db:
+            db.close()
+
+        return [row['listing_id'] for row in rows]
+
+    # candidate ids of the matcher, read from the (room_type, log_price, neighbourhood_cleansed) index only
+    PRICE_BAND_QUERY = (
+        'SELECT id FROM listing WHERE room_type IN ({}) '
+        'AND log_price BETWEEN ? AND ? AND neighbourhood_cleansed != ?'
+    )
+
+    @staticmethod
+    def retrieve_ids_by_price_band(
+        room_types: List[str],
+        min_log_price: float,
+        max_log_price: float,
+        excluded_neighbourhood: str,
+        db: Database=None
+    ) -> List[int]:
+        """ retrieves the ids of the listings of some room types within a log price band, outside 
+            of a neighbourhood. Only the index entries within the band are read (see `du.LISTING_INDEXES`).
+
+        Args:
+            room_types (List[str]): room types of the listings
+            min_log_price (float): min log10 price, inclusive
+            max_log_price (float): max log10 price, inclusive
+            excluded_neighbourhood (str): neighbourhood the listings must not be in
+            db (Database, optional): database object. If None, a new 
+                connection will be opened. Defaults to None.
+
+        Returns:
+            List[int]: ids of the listings
+        """
+        if not room_types:
+            return []
+
+        if not db:
+            db = Database()
+        rows = db.fetch_all(
+            Listing.PRICE_BAND_QUERY.format(', '.join(['?'] * len(room_types))),
+            list(room_types) + [float(min_log_price), float(max_log_price), excluded_neighbourhood]
+        )
+        if not db:
+            db.close()
+
+        return [row['id'] for row in rows]
+
+    @staticmethod
+    def _bounding_box(
+        latitude: float, 
+        longitude: float, 
+        radius: float
+    ) -> Dict[str, float]:
+        """ returns a latitude / longitude box containing all points within `radius` miles of a location """
+        angle = radius / Listing.EARTH_RADIUS_MI
+        delta_lat = math.degrees(angle)
+        cos_lat = math.cos(math.radians(latitude))
+        if cos_lat <= math.sin(angle) or abs(longitude) + math.degrees(math.asin(math.sin(angle) / cos_lat)) > 180:
+            # the circle contains a pole or crosses the antimeridian
+            min_lon, max_lon = -180., 180.
+        else:
+            delta_lon = math.degrees(math.asin(math.sin(angle) / cos_lat))
+            min_lon, max_lon = longitude - delta_lon, longitude + delta_lon
+        return {
+            'min_lat': latitude - delta_lat, 'max_lat': latitude + delta_lat, 
+            'min_lon': min_lon, 'max_lon': max_lon
+        }
+
+    @staticmethod
+    def retrieve_distances(
+        latitude: float, 
+        longitude: float, 
+        radius: float, 
+        db: Database=None
+    ) -> Dict[int, float]:
+        """ retrieves the listings within a radius of a location. Candidates are found with the
+            spatial index of the listing locations (`listing_location`), then filtered by their
+            great-circle distance.
+
+        Args:
+            latitude (float): latitude of the location
+            longitude (float): longitude of the location
+            radius (float): radius in miles
+            db (Database, optional): database object. If None, a new 
+                connection will be opened. Defaults to None.
+
+        Returns:
+            Dict[int, float]: distance in miles of each listing within the radius
+        """
+        if not db:
+            db = Database()
+        rows = db.fetch_all(
+            'SELECT listing.id, listing.latitude, listing.longitude FROM listing_location '
+            'JOIN listing ON listing.id = listing_location.id '
+            'WHERE listing_location.max_lat >= :min_lat AND listing_location.min_lat <= :max_lat '
+            'AND listing_location.max_lon >= :min_lon AND listing_location.min_lon <= :max_lon',
+            Listing._bounding_box(latitude, longitude, radius)
+        )
+        if not db:
+            db.close()
+
+        if not rows:
+            return {}
+        dists = haversine_vector(
+            np.broadcast_to([latitude, longitude], (len(rows), 2)),
+            np.array([(row['latitude'], row['longitude']) for row in rows], dtype=np.float64),
+            unit=Unit.MILES
+        )
+        return {row['id']: float(dist) for row, dist in zip(rows, dists) if dist <= radius}
+
+    @staticmethod
+    def retrieve_near(
+        latitude: float, 
+        longitude: float, 
+        radius: float, 
+        limit: int=None,
+        db: Database=None, 
+        columns: List[str]=None
+    ) -> List['Listing']:
+        """ retrieves the listings within a radius of a location, closest first (see `retrieve_distances`).
+            The distance in miles of each listing is stored as its `distance` property.
+
+        Args:
+            latitude (float): latitude of the location
+            longitude (float): longitude of the location
+            radius (float): radius in miles
+            limit (int, optional): max number of listings to retrieve. Defaults to None (all).
+            db (Database, optional): database object. If None, a new 
+                connection will be opened. Defaults to None.
+            columns (List[str], optional): columns to retrieve, must include 
+                `REQUIRED_COLUMNS`. Defaults to None (all columns).
+
+        Returns:
+            List[Listing]: list of listings, closest first
+        """
+        if not db:
+            db = Database()
+        dists = Listing.retrieve_distances(latitude, longitude, radius, db)
+        ids = sorted(dists, key=lambda id: (dists[id], id))[:limit]
+        listings = {listing.id: listing for listing in Listing.retrieve_by_ids(ids, db, columns)}
+        if not db:
+            db.close()
+
+        for listing in listings.values():
+            listing.properties['distance'] = dists[listing.id]
+        return [listings[id] for id in ids if id in listings]
+
     @staticmethod
     def retrieve_all(
         skip: int=0, 
         limit: int=10, 
-        db: Database=None
+        db: Database=None,
+        columns: List[str]=None
     ) -> List['Listing']:
         """ retrieves all listings
 
@@ -115,13 +484,51 @@ class Listing:
             limit (int, optional): number of listings to return. Defaults to 10.
             db (Database, optional): database object. If None, a new 
                 connection will be opened. Defaults to None.
+            columns (List[str], optional): columns to retrieve, must include 
+                `REQUIRED_COLUMNS`. Defaults to None (all columns).
 
         Returns:
             List[Listing]: list of listing objects
         """
         if not db:
             db = Database()
-        rows = db.fetch_all(f'SELECT * FROM listing LIMIT {limit} OFFSET {skip}')
+        rows = db.fetch_all(f'{Listing._select(columns)} FROM listing ORDER BY id LIMIT {limit} OFFSET {skip}')
+        if not db:
+            db.close()
+        
+        if not rows:
+            return []
+        
+        return [Listing.__from_db_dict(row) for row in rows]
+
+    @staticmethod
+    def retrieve_after(
+        after_id: int=None, 
+        limit: int=10, 
+        db: Database=None,
+        columns: List[str]=None
+    ) -> List['Listing']:
+        """ retrieves a page of listings ordered by id using keyset pagination.
+            Unlike `retrieve_all`, the cost of a page does not depend on its depth.
+
+        Args:
+            after_id (int, optional): id of the last listing of the previous page. 
+                Defaults to None (first page).
+            limit (int, optional): number of listings to return. Defaults to 10.
+            db (Database, optional): database object. If None, a new 
+                connection will be opened. Defaults to None.
+            columns (List[str], optional): columns to retrieve, must include 
+                `REQUIRED_COLUMNS`. Defaults to None (all columns).
+
+        Returns:
+            List[Listing]: list of listing objects
+        """
+        if not db:
+            db = Database()
+        rows = db.fetch_all(
+            f'{Listing._select(columns)} FROM listing WHERE id > :after_id ORDER BY id LIMIT :limit',
+            {'after_id': -1 if after_id is None else after_id, 'limit': limit}
+        )
         if not db:
             db.close()
         
@@ -138,12 +545,37 @@ class Listing:
         """
         props = {}
         props.update(self.properties)
-        props.pop('embedding')
-        props.pop('similar_listings')
+        for col in Listing.BLOB_COLUMNS + Listing.DERIVED_COLUMNS + ['score', 'distance']:
+            props.pop(col, None)
         return ListingItem(id=self.id, **props)
 
+    def to_similar_listing_item(self) -> SimilarListingItem:
+        """ converts a listing retrieved by `retrieve_similar` to a SimilarListingItem
+
+        Returns:
+            SimilarListingItem: SimilarListingItem object, including the similarity score
+        """
+        props = {}
+        props.update(self.properties)
+        for col in Listing.BLOB_COLUMNS + Listing.DERIVED_COLUMNS + ['distance']:
+            props.pop(col, None)
+        return SimilarListingItem(id=self.id, **props)
+
+    def to_nearby_listing_item(self) -> NearbyListingItem:
+        """ converts a listing retrieved by `retrieve_near` to a NearbyListingItem
+
+        Returns:
+            NearbyListingItem: NearbyListingItem object, including the distance in miles
+        """
+        props = {}
+        props.update(self.properties)
+        for col in Listing.BLOB_COLUMNS + Listing.DERIVED_COLUMNS + ['score']:
+            props.pop(col, None)
+        return NearbyListingItem(id=self.id, **props)
+
     def store(self, db: Database=None) -> None:
-        """ stores in the db as a new record.
+        """ stores in the db as a new record. 
+            `similar_listings`, if given, are stored in the similar listing table.
 
         Args:
             db (Database, optional): database object. If None, a new 
@@ -152,12 +584,70 @@ class Listing:
         cols = ['id']
         vals = [str(self.id)]
         for prop in self.properties:
+            if prop in ['similar_listings', 'score', 'distance'] + Listing.DERIVED_COLUMNS:
+                continue
             cols.append(prop)
             vals.append(f':{prop}')
 
+        params = {col: self.properties[col] for col in cols[1:]}
+        cols.append('log_price')
+        vals.append(':log_price')
+        params['log_price'] = float(du.log_price(self.properties['price']))
+        if params.get('embedding', None) is not None and not isinstance(params['embedding'], bytes):
+            params['embedding'] = encode_embedding(params['embedding'])
+
+        if not db:
+            db = Database()
+        db.execute(f'INSERT INTO listing ({", ".join(cols)}) VALUES ({", ".join(vals)})', params)
+        if self.properties.get('similar_listings', None) is not None:
+            self.update_similar_listings(self.properties['similar_listings'], db)
+        Listing._notify_write(self.id)
+
+        if not db:
+            db.close()
+        return
+
+    def update_similar_listings(
+        self, 
+        similar_ids: List[int], 
+        db: Database=None,
+        scores: List[float]=None
+    ) -> None:
+        """ stores the similar listings of this listing in the similar listing table, 
+            replacing the previous ones, in a single transaction. Without similar listings,
+            a `NO_SIMILAR_ID` row records that the listing was matched.
+
+        Args:
+            similar_ids (List[int]): ids of the similar listings, most similar first
+            db (Database, optional): database object. If None, a new 
+                connection will be opened. Defaults to None.
+            scores (List[float], optional): similarity scores of the similar listings. 
+                Defaults to None (unknown).
+        """
+        similar_ids = [int(similar_id) for similar_id in similar_ids]
+        scores = [None] * len(similar_ids) if scores is None else [float(score) for score in scores]
+        self.properties['similar_listings'] = similar_ids
+
+        rows = [(self.id, rank, similar_id, score) for rank, (similar_id, score) in enumerate(zip(similar_ids, scores))]
+        if not rows:
+            rows = [(self.id, 0, Listing.NO_SIMILAR_ID, None)]
+
         if not db:
             db = Database()
-        db.execute(f'INSERT INTO listing ({", ".join(cols)}) VALUES ({", ".join(vals)})', self.properties)
+        try:
+            db.executemany(
+                'INSERT OR REPLACE INTO similar_listing (listing_id, rank, similar_id, score) VALUES (?, ?, ?, ?)',
+                rows, commit=False
+            )
+            db.execute(
+                'DELETE FROM similar_listing WHERE listing_id = :id AND rank >= :num_similar', 
+                {'id': self.id, 'num_similar': len(rows)}, commit=False
+            )
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        Listing._notify_write(self.id)
 
         if not db:
             db.close()
@@ -167,6 +657,6 @@ if __name__ == '__main__':
     db = Database()
     listing = Listing.retrieve_by_id(5121, db)
     print(listing)
-    print(listing.properties['similar_listings'])
-    print(Listing.retrieve_by_ids(listing.properties['similar_listings'], db))
+    print([(similar.id, similar.properties['score']) for similar in Listing.retrieve_similar(listing.id, db) or []])
+    print(Listing.retrieve_referencing_ids(listing.id, db))
     db.close()
\ No newline at end of file
@@ -2,16 +2,29 @@ import os, sys
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
 
 import re
+import copy
+import inspect
+import threading
+import multiprocessing
 import numpy as np
 import pandas as pd
+from os import path
 from tqdm import tqdm
 import project_config as pc
-from typing import List
+from itertools import islice
+from collections import deque
+from typing import List, Dict, Tuple, Iterator
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from models.embedding_cache import EmbeddingCache
 
 import torch
 import torch.nn.functional as F
 from transformers import AutoTokenizer, AutoModel
 
+# text cleaners for the host descriptions
+HTML_TAG_RE = re.compile('<.*?>')
+WHITESPACE_RE = re.compile(r'\s+')
+
 
 class ListingEmbedder:
     """ A class to embed listings using BGE-large-en model from HuggingFace 
@@ -24,26 +37,297 @@ class ListingEmbedder:
         The embeddings are the average of the embeddings of the two summaries weighted by their respective coefficients.
     """
 
+    MODEL_NAME = 'BAAI/bge-large-en'
     INFO_SUM_COEF = 3
     FULL_HOST_DESC_COEF = 2
+
+    # number of texts tokenized at once by a tokenizer worker
+    TOKENIZE_CHUNK_SIZE = 1024
+
+    # inference backends: fp32 pytorch (default), pytorch dynamic int8 quantization (cpu only)
+    # and an exported onnx graph run with onnxruntime (cpu only, requires `onnx` and `onnxruntime`)
+    BACKENDS = ('torch', 'torch-int8', 'onnx')
     def __init__(
         self, 
-        device: str='cpu'
+        device: str='cpu',
+        cache: EmbeddingCache=None,
+        num_tokenizer_workers: int=0,
+        prefetch_chunks: int=4,
+        num_threads: int=None,
+        num_interop_threads: int=None,
+        num_replicas: int=1,
+        backend: str='torch'
     ) -> None:
+        """ initializes the embedder
+
+        Args:
+            device (str, optional): device for computing embeddings (cuda / cpu). Defaults to 'cpu'.
+            cache (EmbeddingCache, optional): persistent embedding cache. If given, only texts 
+                missing from the cache are sent to the model. Defaults to None.
+            num_tokenizer_workers (int, optional): number of tokenizer threads preparing batches 
+                ahead of the model. If 0, tokenization and inference run serially. Defaults to 0.
+            prefetch_chunks (int, optional): max number of chunks of `TOKENIZE_CHUNK_SIZE` texts
+                tokenized ahead of the model. Defaults to 4.
+            num_threads (int, optional): torch intra-op threads (process wide). Defaults to None (torch default).
+            num_interop_threads (int, optional): torch inter-op threads (process wide). Defaults to None (torch default).
+            num_replicas (int, optional): number of model replicas running in separate processes,
+                each embedding a shard of the texts. Defaults to 1 (in-process).
+            backend (str, optional): inference backend, one of `BACKENDS`. Defaults to 'torch'.
+        """
+        assert backend in self.BACKENDS, f'`backend` must be one of {self.BACKENDS}'
+        assert backend == 'torch' or device == 'cpu', f'the {backend} backend only runs on cpu'
+
         self.device = device
+        self.cache = cache
+        self.num_tokenizer_workers = num_tokenizer_workers
+        self.prefetch_chunks = prefetch_chunks
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.num_replicas = num_replicas
+        self.backend = backend
+        self.__replica_pool = None
+        self.__onnx_session = None
+        self.__local = threading.local()
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        if num_interop_threads:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError:
+                # can only be set once, before any inter-op parallel work has started
+                pass
 
-        self.tokenizer = AutoTokenizer.from_pretrained('BAAI/bge-large-en', cache_dir=pc.HUGGING_FACE_CACHE_DIR)
-        self.model = AutoModel.from_pretrained('BAAI/bge-large-en', cache_dir=pc.HUGGING_FACE_CACHE_DIR).to(self.device)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.MODEL_NAME, cache_dir=pc.HUGGING_FACE_CACHE_DIR)
+        self.model = AutoModel.from_pretrained(self.MODEL_NAME, cache_dir=pc.HUGGING_FACE_CACHE_DIR).to(self.device)
         self.model.eval()
 
+        if backend == 'torch-int8':
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif backend == 'onnx':
+            self.__onnx_session = self.__load_onnx_session()
+
+    def __load_onnx_session(self):
+        """ exports the model to onnx under the artifacts directory (once) and opens an onnxruntime session """
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError('the onnx backend requires `onnx` and `onnxruntime`: pip install onnx onnxruntime')
+
+        onnx_path = path.join(pc.ONNX_MODEL_DIR, self.MODEL_NAME.replace('/', '--') + '.onnx')
+        if not path.exists(onnx_path):
+            os.makedirs(pc.ONNX_MODEL_DIR, exist_ok=True)
+            dummy_input = self.tokenizer(['an onnx export example', 'example'], padding=True, return_tensors='pt')
+            input_names = list(dummy_input.keys())
+            export_kwargs = {}
+            if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+                # recent torch versions default to the dynamo exporter
+                export_kwargs['dynamo'] = False
+            torch.onnx.export(
+                _OnnxExportWrapper(self.model, input_names),
+                tuple(dummy_input[name] for name in input_names),
+                onnx_path,
+                input_names=input_names,
+                output_names=['last_hidden_state'],
+                dynamic_axes={name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']},
+                opset_version=14,
+                **export_kwargs
+            )
+
+        options = ort.SessionOptions()
+        if self.num_threads:
+            options.intra_op_num_threads = self.num_threads
+        if self.num_interop_threads:
+            options.inter_op_num_threads = self.num_interop_threads
+        return ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    @property
+    def cache_model_name(self) -> str:
+        """ model name used in embedding cache keys, embeddings of different backends are cached separately """
+        return self.MODEL_NAME if self.backend == 'torch' else f'{self.MODEL_NAME}:{self.backend}'
+
     def __embed(self, text: str) -> torch.Tensor:
-        encoded_input = self.tokenizer(text, padding=True, truncation=True, return_tensors='pt').to(self.device)
+        encoded_input = self.tokenizer(text, padding=True, truncation=True, return_tensors='pt')
+        return self.__forward(encoded_input)
+
+    def __forward(self, encoded_input: Dict) -> torch.Tensor:
+        if self.__onnx_session is not None:
+            input_names = [node.name for node in self.__onnx_session.get_inputs()]
+            model_output = self.__onnx_session.run(None, {name: encoded_input[name].numpy() for name in input_names})
+            # Perform cls pooling
+            return torch.from_numpy(model_output[0][:, 0])
+
+        encoded_input = encoded_input.to(self.device)
         with torch.no_grad():
             model_output = self.model(**encoded_input)
             # Perform cls pooling
             sentence_embeddings = model_output[0][:, 0]
         return sentence_embeddings
 
+    @staticmethod
+    def _length_batches(
+        lengths: List[int], 
+        max_batch_tokens: int
+    ) -> List[List[int]]:
+        """ groups texts of similar token length into batches whose padded size 
+            (number of texts * longest text) stays under the token budget.
+
+        Args:
+            lengths (List[int]): token length of each text
+            max_batch_tokens (int): max number of (padded) tokens per batch
+
+        Returns:
+            List[List[int]]: indices of the texts in each batch, longest texts first
+        """
+        batches, batch = [], []
+        for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            # texts are sorted by decreasing length, so the first text sets the padded length
+            if batch and (len(batch) + 1) * lengths[batch[0]] > max_batch_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __thread_tokenizer(self):
+        """ returns a tokenizer owned by the calling thread, fast tokenizers are not thread safe """
+        if threading.current_thread() is threading.main_thread():
+            return self.tokenizer
+        if not hasattr(self.__local, 'tokenizer'):
+            self.__local.tokenizer = copy.deepcopy(self.tokenizer)
+        return self.__local.tokenizer
+
+    def __tokenize_batches(
+        self, 
+        texts: List[str], 
+        offset: int,
+        max_batch_tokens: int
+    ) -> List[Tuple[List[int], Dict]]:
+        """ tokenizes the texts, groups them by length and pads each batch
+
+        Returns:
+            List[Tuple[List[int], Dict]]: indices (shifted by `offset`) and model inputs of each batch
+        """
+        tokenizer = self.__thread_tokenizer()
+        encodings = tokenizer(texts, truncation=True)
+        encodings = [{key: encodings[key][i] for key in encodings} for i in range(len(texts))]
+        batches = self._length_batches([len(enc['input_ids']) for enc in encodings], max_batch_tokens)
+        return [
+            ([offset + i for i in batch], tokenizer.pad([encodings[i] for i in batch], return_tensors='pt'))
+            for batch in batches
+        ]
+
+    def __iter_batches(
+        self, 
+        texts: List[str], 
+        max_batch_tokens: int
+    ) -> Iterator[Tuple[List[int], Dict]]:
+        """ yields batches of model inputs. With tokenizer workers, chunks of texts are tokenized 
+            in a thread pool while the model runs, keeping at most `prefetch_chunks` chunks ahead.
+        """
+        if self.num_tokenizer_workers <= 0:
+            yield from self.__tokenize_batches(texts, 0, max_batch_tokens)
+            return
+
+        chunks = iter(range(0, len(texts), self.TOKENIZE_CHUNK_SIZE))
+        with ThreadPoolExecutor(max_workers=self.num_tokenizer_workers) as pool:
+            def submit(start):
+                return pool.submit(self.__tokenize_batches, texts[start:start + self.TOKENIZE_CHUNK_SIZE], start, max_batch_tokens)
+
+            pending = deque(submit(start) for start in islice(chunks, max(self.prefetch_chunks, 1)))
+            while pending:
+                batches = pending.popleft().result()
+                next_start = next(chunks, None)
+                if next_start is not None:
+                    pending.append(submit(next_start))
+                yield from batches
+
+    def _iter_uncached(
+        self, 
+        texts: List[str], 
+        max_batch_tokens: int, 
+        verbose: bool=False
+    ) -> Iterator[Tuple[List[int], np.ndarray]]:
+        """ runs the model on all texts, yields the indices and embeddings of each batch """
+        for batch, encoded_input in tqdm(self.__iter_batches(texts, max_batch_tokens), disable=not verbose):
+            yield batch, self.__forward(encoded_input).detach().cpu().numpy()
+
+    def __iter_replicas(
+        self, 
+        texts: List[str], 
+        max_batch_tokens: int, 
+        verbose: bool
+    ) -> Iterator[Tuple[List[int], np.ndarray]]:
+        """ splits the texts into one shard per model replica, yields the indices and embeddings of each shard """
+        if self.__replica_pool is None:
+            replica_kwargs = {
+                'device': self.device,
+                'num_tokenizer_workers': self.num_tokenizer_workers,
+                'prefetch_chunks': self.prefetch_chunks,
+                'num_threads': self.num_threads if self.num_threads else max(1, os.cpu_count() // self.num_replicas),
+                'num_interop_threads': self.num_interop_threads,
+                'backend': self.backend,
+            }
+            self.__replica_pool = ProcessPoolExecutor(
+                max_workers=self.num_replicas,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_replica,
+                initargs=(type(self), replica_kwargs)
+            )
+
+        # interleave the texts so that every shard gets a similar length distribution
+        shards = [list(range(i, len(texts), self.num_replicas)) for i in range(self.num_replicas)]
+        futures = [
+            self.__replica_pool.submit(_embed_shard, [texts[i] for i in shard], max_batch_tokens)
+            for shard in shards if shard
+        ]
+        for shard, future in tqdm(zip(shards, futures), total=len(futures), disable=not verbose):
+            yield shard, future.result()
+
+    def close(self) -> None:
+        """ shuts down the model replica processes, if any """
+        if self.__replica_pool is not None:
+            self.__replica_pool.shutdown()
+            self.__replica_pool = None
+
+    def __embed_texts(
+        self, 
+        texts: List[str], 
+        max_batch_tokens: int, 
+        verbose: bool
+    ) -> np.ndarray:
+        """ returns the (unnormalized) embedding of each text. Cached embeddings are reused,
+            each distinct uncached text is sent to the model once and empty texts are skipped
+            (their embedding is all zeros). Texts are batched by token length to minimize padding.
+        """
+        embeddings = np.zeros((len(texts), self.model.config.hidden_size), dtype=np.float32)
+
+        cached = self.cache.get_many(self.cache_model_name, texts) if self.cache is not None else [None] * len(texts)
+        missing = {}
+        for i, (text, embedding) in enumerate(zip(texts, cached)):
+            if embedding is not None:
+                embeddings[i] = embedding
+            elif text != '':
+                missing.setdefault(text, []).append(i)
+
+        missing_texts = list(missing)
+        if not missing_texts:
+            return embeddings
+
+        if self.num_replicas > 1 and len(missing_texts) > 1:
+            results = self.__iter_replicas(missing_texts, max_batch_tokens, verbose)
+        else:
+            results = self._iter_uncached(missing_texts, max_batch_tokens, verbose)
+
+        for batch, batch_embed in results:
+            for i, embedding in zip(batch, batch_embed):
+                embeddings[missing[missing_texts[i]]] = embedding
+
+            if self.cache is not None:
+                self.cache.put_many(self.cache_model_name, [missing_texts[i] for i in batch], batch_embed)
+        return embeddings
+
     @staticmethod
     def __weigted_average(
         embed_a: torch.Tensor,
@@ -59,42 +343,43 @@ class ListingEmbedder:
         info_summaries: List[str], 
         full_host_descriptions: List[str],
         batch_size: int=32,
-        verbose: bool=True
+        verbose: bool=True,
+        max_batch_tokens: int=None
     ) -> np.ndarray:
         """ returns a numpy array of embeddings for each listing
 
         Args:
             info_summaries (List[str]): list of info summaries for each listing
             full_host_descriptions (List[str]): list of full host descriptions for each listing
-            batch_size (int, optional): batch size for inference. Defaults to 32.
+            batch_size (int, optional): batch size for inference, used to set the token budget of
+                a batch to `batch_size` max length texts. Defaults to 32.
             verbose (bool, optional): whether to show progress bar. Defaults to True.
+            max_batch_tokens (int, optional): max number of (padded) tokens per batch. Overrides 
+                `batch_size` if given. Defaults to None.
 
         Returns:
             np.ndarray: numpy array of embeddings for each listing
         """
-        embeddings = []
-        for i in tqdm(range(0, len(info_summaries), batch_size), disable=not verbose):
-            batch_info_sum = info_summaries[i:i+batch_size]
-            batch_info_sum_embed = self.__embed(batch_info_sum)
-            info_sum_weights = torch.ones((len(batch_info_sum), 1), device=self.device) * self.INFO_SUM_COEF
-
-            # full host description can be empty. If so, set the weight to 0
-            batch_host_desc = full_host_descriptions[i:i+batch_size]
-            batch_host_desc_weigted_embed = self.__embed(full_host_descriptions[i:i+batch_size])
-            host_desc_mask = torch.tensor([1 if desc != '' else 0 for desc in batch_host_desc], device=self.device)
-            host_desc_weights = host_desc_mask[:, None] * self.FULL_HOST_DESC_COEF
-
-            avg_embed = self.__weigted_average(
-                batch_info_sum_embed, 
-                batch_host_desc_weigted_embed, 
-                info_sum_weights, 
-                host_desc_weights
-            )
+        if not max_batch_tokens:
+            max_batch_tokens = batch_size * self.model.config.max_position_embeddings
 
-            avg_embed = F.normalize(avg_embed, p=2, dim=1)
-            embeddings.append(avg_embed.detach().cpu().numpy())
-        embeddings = np.concatenate(embeddings)
-        return embeddings
+        info_sum_embed = torch.from_numpy(self.__embed_texts(info_summaries, max_batch_tokens, verbose)).to(self.device)
+        info_sum_weights = torch.ones((len(info_summaries), 1), device=self.device) * self.INFO_SUM_COEF
+
+        # full host description can be empty. If so, set the weight to 0
+        host_desc_embed = torch.from_numpy(self.__embed_texts(full_host_descriptions, max_batch_tokens, verbose)).to(self.device)
+        host_desc_mask = torch.tensor([1 if desc != '' else 0 for desc in full_host_descriptions], device=self.device)
+        host_desc_weights = host_desc_mask[:, None] * self.FULL_HOST_DESC_COEF
+
+        avg_embed = self.__weigted_average(
+            info_sum_embed, 
+            host_desc_embed, 
+            info_sum_weights, 
+            host_desc_weights
+        )
+
+        avg_embed = F.normalize(avg_embed, p=2, dim=1)
+        return avg_embed.detach().cpu().numpy()
 
     @staticmethod
     def construct_info_summary(
@@ -169,7 +454,7 @@ class ListingEmbedder:
         summary = []
 
         def clean_html(txt):
-            return re.sub('<.*?>', '', txt)
+            return HTML_TAG_RE.sub('', txt)
         
         if property_type:
             property_type = f'This is a{"n" if property_type[0].lower() in "aeiou" else ""}'
@@ -193,47 +478,232 @@ class ListingEmbedder:
         
         # remove extra spaces
         summary = summary.strip()
-        summary = re.sub('\s+', ' ', summary)
+        summary = WHITESPACE_RE.sub(' ', summary)
         return summary
 
+    @staticmethod
+    def __join_parts(parts: List[np.ndarray]) -> np.ndarray:
+        """ joins the non-empty parts of each row with '. ' """
+        joined = parts[0]
+        for part in parts[1:]:
+            joined = np.where((joined != '') & (part != ''), joined + '. ' + part, joined + part)
+        return joined
+
+    @staticmethod
+    def construct_info_summaries(df: pd.DataFrame) -> List[str]:
+        """ column-wise version of `construct_info_summary` for all listings of a dataframe.
+            Produces the exact same summaries.
+
+        Args:
+            df (pd.DataFrame): dataframe of listings
+
+        Returns:
+            List[str]: summary of each listing in natural language
+        """
+        def as_str(col: pd.Series) -> np.ndarray:
+            return col.astype(object).map(str).to_numpy(dtype=object)
+
+        def plural(counts: np.ndarray) -> np.ndarray:
+            return np.where(counts > 1, 's', '').astype(object)
+
+        room_type = df.room_type.astype(object).to_numpy()
+        bedrooms = df.bedrooms.astype('Float64').fillna(np.nan).to_numpy(dtype=np.float64)
+        beds = df.beds.astype('Float64').fillna(np.nan).to_numpy(dtype=np.float64)
+        accommodates = df.accommodates.astype('Float64').fillna(0).to_numpy(dtype=np.float64)
+        bathrooms_text = df.bathrooms_text.astype(object).where(df.bathrooms_text.notna(), '').to_numpy()
+
+        type_and_loc = as_str(df.room_type) + ' in ' + as_str(df.neighbourhood_group_cleansed)
+
+        # bed and bath info
+        bed_bath = np.where(
+            (bedrooms == 0) & (room_type == 'Entire home/apt'), 
+            'A studio', 
+            np.where(bedrooms > 0, as_str(df.bedrooms) + ' bedroom' + plural(bedrooms), '')
+        ).astype(object)
+        bed_bath += np.where(
+            beds > 0, 
+            np.where(bed_bath != '', ' with ', '') + as_str(df.beds) + ' bed' + plural(beds), 
+            ''
+        )
+        bed_bath += np.where(
+            bathrooms_text != '', 
+            np.where(bed_bath != '', ' and ', '') + bathrooms_text, 
+            ''
+        )
+
+        max_occupancy = np.where(
+            accommodates > 1, 
+            'Accommodates up to ' + as_str(df.accommodates) + ' people', 
+            np.where(accommodates > 0, 'Accommodates 1 person', '')
+        ).astype(object)
+
+        cost = 'Costs $' + df.price.map('{:.2f}'.format).to_numpy(dtype=object) + ' per night'
+
+        summaries = ListingEmbedder.__join_parts([type_and_loc, bed_bath, max_occupancy, cost])
+        return summaries.tolist()
+
+    @staticmethod
+    def construct_full_host_descriptions(df: pd.DataFrame) -> List[str]:
+        """ column-wise version of `construct_full_host_description` for all listings of a dataframe.
+            Produces the exact same descriptions.
+
+        Args:
+            df (pd.DataFrame): dataframe of listings
+
+        Returns:
+            List[str]: full description by the host of each listing
+        """
+        def non_empty(col: pd.Series) -> pd.Series:
+            return col.astype(object).where(col.notna(), '').astype(str)
+
+        def clean_html(col: pd.Series) -> pd.Series:
+            return col.str.replace(HTML_TAG_RE, '', regex=True)
+
+        property_type = non_empty(df.property_type)
+        description = non_empty(df.description)
+        neighborhood_overview = non_empty(df.neighborhood_overview)
+        host_about = non_empty(df.host_about)
+
+        starts_with_vowel = property_type.str[:1].str.lower().isin(list('aeiou'))
+        property_type = pd.Series(np.where(starts_with_vowel, 'This is an', 'This is a'), index=df.index)
+        property_type = (property_type + ' ' + property_type.str.lower()).where(non_empty(df.property_type) != '', '')
+
+        neighborhood_overview = ('A little about the neighborhood. ' + clean_html(neighborhood_overview)).where(neighborhood_overview != '', '')
+        host_about = ('Host information: ' + clean_html(host_about)).where(host_about != '', '')
+
+        summaries = ListingEmbedder.__join_parts([
+            property_type.to_numpy(dtype=object),
+            clean_html(description).to_numpy(dtype=object),
+            neighborhood_overview.to_numpy(dtype=object),
+            host_about.to_numpy(dtype=object),
+        ])
+
+        # remove extra spaces
+        summaries = pd.Series(summaries, dtype=object).str.strip().str.replace(WHITESPACE_RE, ' ', regex=True)
+        return summaries.tolist()
+
+    @staticmethod
+    def construct_summaries(
+        df: pd.DataFrame, 
+        num_workers: int=0,
+        chunk_size: int=5000
+    ) -> Tuple[List[str], List[str]]:
+        """ returns the info summary and the full host description of all listings of a dataframe.
+
+        Args:
+            df (pd.DataFrame): dataframe of listings
+            num_workers (int, optional): if > 1, chunks of the dataframe are processed in a 
+                process pool. Defaults to 0.
+            chunk_size (int, optional): number of listings per chunk. Defaults to 5000.
+
+        Returns:
+            Tuple[List[str], List[str]]: info summaries and full host descriptions
+        """
+        if num_workers <= 1 or len(df) <= chunk_size:
+            return _construct_summaries_chunk(df)
+
+        chunks = [df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
+        info_summaries, host_descs = [], []
+        # spawned rather than forked, the model and the tokenizer threads may already be running
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for chunk_info_summaries, chunk_host_descs in pool.map(_construct_summaries_chunk, chunks):
+                info_summaries.extend(chunk_info_summaries)
+                host_descs.extend(chunk_host_descs)
+        return info_summaries, host_descs
+
+    def embed_listing(self, properties: Dict) -> np.ndarray:
+        """ returns the embedding of a single listing
+
+        Args:
+            properties (Dict): listing properties (see `Listing`)
+
+        Returns:
+            np.ndarray: embedding of the listing
+        """
+        info_summary = self.construct_info_summary(
+            room_type=properties['room_type'],
+            neighbourhood_group_cleansed=properties['neighbourhood_group_cleansed'],
+            price=properties['price'],
+            bedrooms=properties.get('bedrooms', None) or 0,
+            beds=properties.get('beds', None),
+            bathrooms_text=properties.get('bathrooms_text', None),
+            accommodates=properties.get('accommodates', None) or 0,
+        )
+        host_desc = self.construct_full_host_description(
+            property_type=properties.get('property_type', None),
+            description=properties.get('description', None),
+            neighborhood_overview=properties.get('neighborhood_overview', None),
+            host_about=properties.get('host_about', None),
+        )
+        return self.embed_listings([info_summary], [host_desc], verbose=False)[0]
+
     def from_dataframe(
         self, 
         df: pd.DataFrame, 
-        batch_size: int=32
+        batch_size: int=32,
+        max_batch_tokens: int=None,
+        num_workers: int=0
     ) -> np.ndarray:
         """ returns a numpy array of embeddings for each listing in the dataframe
 
         Args:
             df (pd.DataFrame): dataframe of listings
             batch_size (int, optional): batch size for inference. Defaults to 32.
+            max_batch_tokens (int, optional): max number of (padded) tokens per batch. Overrides 
+                `batch_size` if given. Defaults to None.
+            num_workers (int, optional): number of processes constructing the listing summaries. 
+                Defaults to 0 (in-process).
 
         Returns:
             np.ndarray: numpy array of embeddings for each listing in the dataframe
         """
-        embeddings = []
-        full_summary, host_desc = [], []
-        for _, row in df.iterrows():
-            full_summary.append(self.construct_info_summary(
-                room_type=row.room_type,
-                neighbourhood_group_cleansed=row.neighbourhood_group_cleansed,
-                price=row.price,
-                bedrooms=None if pd.isna(row.bedrooms) else row.bedrooms,
-                beds=None if pd.isna(row.beds) else row.beds,
-                bathrooms_text=None if pd.isna(row.bathrooms_text) else row.bathrooms_text,
-                accommodates=None if pd.isna(row.accommodates) else row.accommodates,
-            ))
-            
-            host_desc.append(self.construct_full_host_description(
-                property_type=None if pd.isna(row.property_type) else row.property_type,
-                description=None if pd.isna(row.description) else row.description,
-                neighborhood_overview=None if pd.isna(row.neighborhood_overview) else row.neighborhood_overview,
-                host_about=None if pd.isna(row.host_about) else row.host_about,
-            ))
+        full_summary, host_desc = self.construct_summaries(df, num_workers=num_workers)
 
         embeddings = self.embed_listings(
             full_summary, 
             host_desc, 
             batch_size=batch_size,
-            verbose=True
+            verbose=True,
+            max_batch_tokens=max_batch_tokens
         )
-        return embeddings
\ No newline at end of file
+        return embeddings
+
+
+class _OnnxExportWrapper(torch.nn.Module):
+    """ exposes the model with positional tensor inputs and the last hidden state as its only output """
+    def __init__(
+        self, 
+        model: torch.nn.Module, 
+        input_names: List[str]
+    ) -> None:
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs: torch.Tensor) -> torch.Tensor:
+        return self.model(**dict(zip(self.input_names, inputs)))[0]
+
+
+def _construct_summaries_chunk(df: pd.DataFrame) -> Tuple[List[str], List[str]]:
+    """ returns the info summaries and full host descriptions of a chunk of listings """
+    return ListingEmbedder.construct_info_summaries(df), ListingEmbedder.construct_full_host_descriptions(df)
+
+
+# model replica of the current worker process, see `ListingEmbedder(num_replicas=...)`
+_replica = None
+
+def _init_replica(embedder_cls: type, kwargs: Dict) -> None:
+    """ loads the model replica of a worker process """
+    global _replica
+    _replica = embedder_cls(**kwargs)
+
+
+def _embed_shard(
+    texts: List[str], 
+    max_batch_tokens: int
+) -> np.ndarray:
+    """ embeds a shard of texts with the model replica of the worker process """
+    embeddings = np.zeros((len(texts), _replica.model.config.hidden_size), dtype=np.float32)
+    for batch, batch_embed in _replica._iter_uncached(texts, max_batch_tokens):
+        embeddings[batch] = batch_embed
+    return embeddings
@@ -2,31 +2,345 @@
 import os, sys
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
 
-from typing import List
+import time
+import threading
+import numpy as np
+from typing import Dict, List, Tuple
+from data import utils as du
+from data.database import Database
+from data.embedding_store import EmbeddingStore, decode_embedding
 from models.listing import Listing
+from models.ann_index import IVFIndex
 
 class ListingSimilarity:
     """ A class to represent a listing similarity model
 
-        Note: this class is not implemented yet, since everything is precomputed for the toy project.
-
         Given a new listing this model will:
             1. retrieves all filtered listings from the database
             2. compute / retrieve the embedding of all listing
             3. computes the cosine similarity between the new listing and all filtered listings
             4. updates database with the new listing's similar listings
             5. returns the top N similar listings
+
+        Online matching is backed by an approximate nearest neighbor index (see `IVFIndex`) over
+        all stored embeddings, built once with `build_index`. `num_probes` trades recall for latency.
+        The exact path (see `exact_similar_ids`) scores all listings returned by an indexed range
+        query over the price band instead (see `_retrieve_filtered_ids`).
     """
     MAX_LOG_PRICE_DIFF = 0.3
     MIN_COS_SIMILARITY = 0.9
     TOP_N = 10
     MIN_DISTANCE = 1.0  # in miles
-    
-    def _retrieve_filtered_listings(self, reference_listing: Listing) -> List[Listing]:
-        # TODO: SQL query to retrieve filtered listings based on heuristic filters
-        raise NotImplementedError
-
-    def find_similar_listings(self, id: int) -> List[Listing]:
-        # TODO: if similar_listings is not in the database 
-        #   retrieve filtered listings, compute embeddings, compute cosine similarity, return top N
-        raise NotImplementedError
+
+    # ANN index defaults
+    ANN_NUM_LISTS = None  # 4 * sqrt(n)
+    ANN_NUM_PROBES = 16
+
+    def __init__(
+        self,
+        db: Database=None,
+        store: EmbeddingStore=None,
+        num_lists: int=ANN_NUM_LISTS,
+        num_probes: int=ANN_NUM_PROBES
+    ) -> None:
+        """ initializes the similarity model. Call `build_index` before finding similar listings.
+
+        Args:
+            db (Database, optional): database object. If None, a new
+                connection will be opened. Defaults to None.
+            store (EmbeddingStore, optional): embedding matrix. If None, the project 
+                store is used when it exists. Defaults to None.
+            num_lists (int, optional): number of clusters of the ANN index. Defaults to ANN_NUM_LISTS.
+            num_probes (int, optional): number of clusters scored per query. Higher
+                is more accurate but slower. Defaults to ANN_NUM_PROBES.
+        """
+        self.db = db if db else Database()
+        self.store = store if store else EmbeddingStore()
+        self.index = IVFIndex(num_lists=num_lists, num_probes=num_probes)
+
+        self.ids = None
+        self.log_prices = None
+        self.neighbourhoods = None
+        self.room_types = None
+        self.room_types_version = None
+
+        # candidate query stats
+        self.__lock = threading.Lock()
+        self.num_filter_queries = 0
+        self.total_filter_candidates = 0
+        self.total_filter_time = 0.
+        self.last_filter_stats = None
+
+    @staticmethod
+    def log_price(price: float) -> float:
+        """ log10 of the price, free listings are treated as $1 """
+        return float(du.log_price(price if price else 1))
+
+    def build_index(self) -> 'ListingSimilarity':
+        """ loads all stored embeddings and the columns needed by the heuristic filters
+            and builds the ANN index. Embeddings are read from the memory-mapped embedding
+            matrix when available and from the database otherwise.
+
+        Returns:
+            ListingSimilarity: self
+        """
+        use_store = self.store.exists()
+        rows = self.db.fetch_all(
+            'SELECT id, price, neighbourhood_cleansed'
+            + ('' if use_store else ', embedding')
+            + ' FROM listing WHERE embedding IS NOT NULL'
+        )
+        if use_store:
+            self.store.load()
+            store_rows = self.store.rows([row['id'] for row in rows])
+            rows = [row for row, store_row in zip(rows, store_rows) if store_row >= 0]
+            embeddings = self.store.embeddings[store_rows[store_rows >= 0]]
+        else:
+            embeddings = [decode_embedding(row['embedding']) for row in rows]
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(rows), -1)
+
+        self.ids = np.array([row['id'] for row in rows], dtype=np.int64)
+        self.log_prices = np.array([self.log_price(row['price']) for row in rows], dtype=np.float64)
+        self.neighbourhoods = np.array([row['neighbourhood_cleansed'] for row in rows], dtype=object)
+        self.room_types = None
+        if len(rows):
+            self.index.build(embeddings)
+        return self
+
+    def __room_types(self, db: Database) -> List[str]:
+        """ returns all room types, read from the (room_type, log_price) index again whenever the
+            database file changes, e.g. after `update_dataset.py` added a room type
+        """
+        stat = os.stat(db.db_name)
+        version = (stat.st_ino, stat.st_mtime_ns)
+        if self.room_types is None or version != self.room_types_version:
+            self.room_types = [row['room_type'] for row in db.fetch_all('SELECT DISTINCT room_type FROM listing')]
+            self.room_types_version = version
+        return self.room_types
+
+    def _retrieve_filtered_ids(
+        self, 
+        reference_listing: Listing,
+        db: Database=None
+    ) -> List[int]:
+        """ retrieves the ids of the listings passing the price and neighbourhood filters of a listing
+            with one range query per room type over the price band (see `Listing.retrieve_ids_by_price_band`).
+            The number of candidates and the latency of the call are kept in `last_filter_stats`.
+
+        Args:
+            reference_listing (Listing): listing to find candidates for
+            db (Database, optional): database object. Defaults to None (the model's own connection).
+
+        Returns:
+            List[int]: ids of the listings within MAX_LOG_PRICE_DIFF of the listing, outside of its neighbourhood
+        """
+        db = db if db else self.db
+        props = reference_listing.properties
+        log_price = self.log_price(props['price'])
+
+        start = time.perf_counter()
+        ids = Listing.retrieve_ids_by_price_band(
+            self.__room_types(db),
+            log_price - self.MAX_LOG_PRICE_DIFF,
+            log_price + self.MAX_LOG_PRICE_DIFF,
+            props['neighbourhood_cleansed'],
+            db
+        )
+        elapsed = time.perf_counter() - start
+
+        with self.__lock:
+            self.num_filter_queries += 1
+            self.total_filter_candidates += len(ids)
+            self.total_filter_time += elapsed
+            self.last_filter_stats = {'id': reference_listing.id, 'candidates': len(ids), 'ms': 1000 * elapsed}
+        return ids
+
+    def _retrieve_filtered_listings(
+        self, 
+        reference_listing: Listing,
+        db: Database=None,
+        columns: List[str]=None
+    ) -> List[Listing]:
+        """ retrieves the listings passing the price and neighbourhood filters of a listing (see `_retrieve_filtered_ids`)
+
+        Args:
+            reference_listing (Listing): listing to find candidates for
+            db (Database, optional): database object. Defaults to None (the model's own connection).
+            columns (List[str], optional): columns to retrieve, must include 
+                `REQUIRED_COLUMNS`. Defaults to None (all columns).
+
+        Returns:
+            List[Listing]: listings within MAX_LOG_PRICE_DIFF of the listing, outside of its neighbourhood
+        """
+        db = db if db else self.db
+        return Listing.retrieve_by_ids(self._retrieve_filtered_ids(reference_listing, db), db, columns)
+
+    def explain_filtered_listings(self, db: Database=None) -> List[str]:
+        """ returns the query plan (EXPLAIN QUERY PLAN) of `_retrieve_filtered_ids`, which should
+            search the covering `listing_room_type_log_price` index rather than scan the listing table
+        """
+        db = db if db else self.db
+        room_types = self.__room_types(db) or ['']
+        rows = db.fetch_all(
+            f'EXPLAIN QUERY PLAN {Listing.PRICE_BAND_QUERY.format(", ".join(["?"] * len(room_types)))}',
+            room_types + [0., 0., '']
+        )
+        return [row['detail'] for row in rows]
+
+    def stats(self) -> Dict:
+        """ returns the number of candidates and the latency of the candidate queries """
+        with self.__lock:
+            n = self.num_filter_queries
+            return {
+                'queries': n,
+                'mean_candidates': self.total_filter_candidates / n if n else 0.,
+                'mean_ms': 1000 * self.total_filter_time / n if n else 0.,
+                'last': self.last_filter_stats,
+            }
+
+    def _rank_candidates(
+        self,
+        reference_listing: Listing,
+        ids: np.ndarray,
+        scores: np.ndarray,
+        db: Database
+    ) -> Tuple[List[int], List[float]]:
+        """ keeps the `TOP_N * 10` most similar candidates, then the `TOP_N` most similar ones 
+            further than MIN_DISTANCE from the listing, same as the offline precompute
+        """
+        num_candidates = self.TOP_N * 10
+        if len(scores) > num_candidates:
+            top = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+            ids, scores = ids[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        ids, scores = ids[order], scores[order]
+
+        # distance filter, listings within MIN_DISTANCE are found with the spatial index
+        props = reference_listing.properties
+        near_ids = Listing.retrieve_distances(props['latitude'], props['longitude'], self.MIN_DISTANCE, db)
+        far = ~np.isin(ids, np.fromiter(near_ids, dtype=np.int64, count=len(near_ids)))
+        return ids[far][:self.TOP_N].tolist(), scores[far][:self.TOP_N].tolist()
+
+    def top_similar_ids(
+        self,
+        reference_listing: Listing,
+        embedding: np.ndarray,
+        num_probes: int=None,
+        db: Database=None
+    ) -> Tuple[List[int], List[float]]:
+        """ finds the ids of the top N similar listings using the ANN index,
+            applying the same heuristic filters as the offline precompute
+
+        Args:
+            reference_listing (Listing): listing to find similar listings for
+            embedding (np.ndarray): l2 normalized embedding of the reference listing
+            num_probes (int, optional): number of clusters scored. Defaults to None (index default).
+            db (Database, optional): database object used for the distance filter. 
+                Defaults to None (the model's own connection).
+
+        Returns:
+            Tuple[List[int], List[float]]: ids of the similar listings, most similar first, 
+                and their cosine similarities
+        """
+        if self.ids is None:
+            raise RuntimeError('the ANN index is not built. Call `build_index` first.')
+
+        positions, scores = self.index.probe(embedding, num_probes)
+
+        # price, neighbourhood and min cosine similarity filters
+        props = reference_listing.properties
+        mask = np.abs(self.log_prices[positions] - self.log_price(props['price'])) <= self.MAX_LOG_PRICE_DIFF
+        mask &= self.neighbourhoods[positions] != props['neighbourhood_cleansed']
+        mask &= scores > self.MIN_COS_SIMILARITY
+        mask &= self.ids[positions] != reference_listing.id
+        return self._rank_candidates(reference_listing, self.ids[positions[mask]], scores[mask], db if db else self.db)
+
+    def exact_similar_ids(
+        self,
+        reference_listing: Listing,
+        embedding: np.ndarray,
+        db: Database=None
+    ) -> Tuple[List[int], List[float]]:
+        """ finds the ids of the top N similar listings by scoring every listing passing the 
+            price and neighbourhood filters (see `_retrieve_filtered_ids`)
+
+        Args:
+            reference_listing (Listing): listing to find similar listings for
+            embedding (np.ndarray): l2 normalized embedding of the reference listing
+            db (Database, optional): database object. Defaults to None (the model's own connection).
+
+        Returns:
+            Tuple[List[int], List[float]]: ids of the similar listings, most similar first, 
+                and their cosine similarities
+        """
+        db = db if db else self.db
+        if self.store.exists():
+            if self.store.ids is None:
+                self.store.load()
+            ids = np.array(self._retrieve_filtered_ids(reference_listing, db), dtype=np.int64)
+            store_rows = self.store.rows(ids)
+            ids = ids[store_rows >= 0]
+            embeddings = self.store.embeddings[store_rows[store_rows >= 0]]
+        else:
+            candidates = self._retrieve_filtered_listings(reference_listing, db, Listing.REQUIRED_COLUMNS + ['embedding'])
+            candidates = [listing for listing in candidates if listing.properties.get('embedding', None) is not None]
+            ids = np.array([listing.id for listing in candidates], dtype=np.int64)
+            embeddings = [listing.properties['embedding'] for listing in candidates]
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+
+        scores = embeddings @ embedding if len(ids) else np.zeros(0, dtype=np.float32)
+        mask = scores > self.MIN_COS_SIMILARITY
+        return self._rank_candidates(reference_listing, ids[mask], scores[mask], db)
+
+    def find_similar_listings(
+        self,
+        id: int,
+        embedder=None,
+        num_probes: int=None,
+        db: Database=None,
+        columns: List[str]=None,
+        exact: bool=False
+    ) -> List[Listing]:
+        """ finds the top N similar listings of a listing and stores them in the database.
+            The stored similar listings of listings already matched are returned as is.
+
+        Args:
+            id (int): listing id
+            embedder (ListingEmbedder, optional): used to embed the listing if it has no
+                stored embedding. Defaults to None.
+            num_probes (int, optional): number of clusters scored. Defaults to None (index default).
+            db (Database, optional): writable database object to use instead of the model's
+                own connection, e.g. one owned by the calling thread. Defaults to None.
+            columns (List[str], optional): columns of the similar listings to retrieve. 
+                Defaults to None (all columns).
+            exact (bool, optional): whether to score all filtered listings instead of probing the
+                ANN index, always the case if the index is not built. Defaults to False.
+
+        Raises:
+            ValueError: if the listing has no embedding and no embedder is given
+
+        Returns:
+            List[Listing]: similar listings with their `score`, or None if the listing does not exist
+        """
+        db = db if db else self.db
+        similar_listings = Listing.retrieve_similar(id, db, columns)
+        if similar_listings is not None:
+            return similar_listings
+
+        listing = Listing.retrieve_by_id(id, db)
+        if listing is None:
+            return None
+
+        embedding = listing.properties.get('embedding', None)
+        if embedding is None:
+            if embedder is None:
+                raise ValueError(f'listing {id} has no embedding and no embedder was provided')
+            embedding = embedder.embed_listing(listing.properties)
+
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if exact or self.ids is None:
+            similar_ids, scores = self.exact_similar_ids(listing, embedding, db)
+        else:
+            similar_ids, scores = self.top_similar_ids(listing, embedding, num_probes, db)
+        listing.update_similar_listings(similar_ids, db, scores)
+        return Listing.retrieve_similar(id, db, columns)
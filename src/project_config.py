@@ -18,7 +18,15 @@ BASE_CODE_DIR = path.abspath(ENV_VARS['CODE_DIR'])
 BASE_DATA_DIR = path.abspath(ENV_VARS['DATA_DIR'])
 BASE_RAW_DATA_DIR = path.join(BASE_DATA_DIR, 'raw')
 DATABASE_PATH = path.join(BASE_DATA_DIR, 'airbnb.db')
+EMBEDDINGS_PATH = path.join(BASE_DATA_DIR, 'embeddings.npy')
+EMBEDDING_IDS_PATH = path.join(BASE_DATA_DIR, 'embedding_ids.npy')
 
 # artifact dirs
 BASE_ARTIFACTS_DIR = path.abspath(ENV_VARS['ARTIFACTS_DIR'])
-HUGGING_FACE_CACHE_DIR = path.join(BASE_ARTIFACTS_DIR, 'hugging_face_cache')
\ No newline at end of file
+HUGGING_FACE_CACHE_DIR = path.join(BASE_ARTIFACTS_DIR, 'hugging_face_cache')
+EMBEDDING_CACHE_PATH = path.join(BASE_ARTIFACTS_DIR, 'embedding_cache.db')
+ONNX_MODEL_DIR = path.join(BASE_ARTIFACTS_DIR, 'onnx')
+PROFILES_DIR = path.join(BASE_ARTIFACTS_DIR, 'profiles')
+
+# sampled profiling of the web service and of the precompute (see `data/profiling.py`)
+PROFILING_ENABLED = str(ENV_VARS.get('PROFILING', None) or '').lower() in ['1', 'true', 'yes']
\ No newline at end of file
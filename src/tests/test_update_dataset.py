@@ -0,0 +1,59 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import numpy as np
+from os import path
+from data.database import Database
+from data.embedding_store import EmbeddingStore
+from data.update_dataset import update_neighbor_graph
+from benchmarks.synthetic import make_synthetic_database, synthetic_embeddings
+
+NUM_LISTINGS = 300
+
+
+class StubEmbedder:
+    """ returns synthetic embeddings instead of running a model """
+    def from_dataframe(self, df, batch_size):
+        return synthetic_embeddings(len(df), seed=1)
+
+
+def synthetic_dataset(data_dir: str):
+    df = make_synthetic_database(str(data_dir), NUM_LISTINGS)
+    db = Database(path.join(data_dir, 'airbnb.db'))
+    store = EmbeddingStore(path.join(data_dir, 'embeddings.npy'), path.join(data_dir, 'embedding_ids.npy'))
+    return df, db, store
+
+
+def test_removal_only_delta(tmp_path):
+    df, db, store = synthetic_dataset(tmp_path)
+    removed_id = int(df.id[0])
+
+    update_neighbor_graph(df.iloc[:0], [removed_id], None, db=db, store=store)
+
+    assert db.fetch_one('SELECT COUNT(*) AS n FROM listing')['n'] == NUM_LISTINGS - 1
+    assert not db.fetch_all('SELECT * FROM similar_listing WHERE listing_id = ? OR similar_id = ?', [removed_id] * 2)
+    store.load()
+    assert store.embeddings.shape[0] == NUM_LISTINGS - 1
+    assert store.rows([removed_id])[0] == -1
+
+    # the database and the embedding matrix are still in sync for the next update
+    update_neighbor_graph(df.iloc[:0], [int(df.id[1])], None, db=db, store=store)
+    assert len(store.load().ids) == NUM_LISTINGS - 2
+    db.close()
+
+
+def test_changed_listing_delta(tmp_path):
+    df, db, store = synthetic_dataset(tmp_path)
+    changed = df.iloc[:1].copy()
+    changed['description'] = 'a brand new description'
+    changed_id = int(changed.id[0])
+
+    recomputed_ids = update_neighbor_graph(changed, [], StubEmbedder(), db=db, store=store)
+
+    assert changed_id in recomputed_ids
+    row = db.fetch_one('SELECT description FROM listing WHERE id = ?', [changed_id])
+    assert row['description'] == 'a brand new description'
+    store.load()
+    assert len(store.ids) == NUM_LISTINGS
+    np.testing.assert_allclose(store.get(changed_id), synthetic_embeddings(1, seed=1)[0])
+    db.close()
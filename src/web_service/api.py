@@ -1,32 +1,155 @@
 import os, sys
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
 
+import json
+import base64
+import binascii
 import project_config as pc
 from pydantic import BaseModel
-from data.database import Database
+from data.database import ConnectionPool
+from data.metrics import REGISTRY
+from web_service.response_cache import ResponseCache
+from web_service.metrics_middleware import MetricsMiddleware
+from web_service.profiling_middleware import ProfilingMiddleware
 from models.listing import Listing
-from data.utils import ListingItem
+from models.matching import ListingSimilarity
+from data.utils import ListingItem, SimilarListingItem, NearbyListingItem
 from typing_extensions import Annotated
+from fastapi.encoders import jsonable_encoder
 from typing import Dict, Any, Union, List
-from fastapi import FastAPI, HTTPException, status, Path, Query
+from fastapi import FastAPI, HTTPException, status, Path, Query, Response
 
 
 app = FastAPI()
-db = Database()
+app.add_middleware(MetricsMiddleware)
+if pc.PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+pool = ConnectionPool()
+matcher = ListingSimilarity()
+cache = ResponseCache()
+
+# max number of listings in a single batch request
+MAX_SIMILAR_BATCH_SIZE = int(pc.ENV_VARS.get('MAX_SIMILAR_BATCH_SIZE', None) or 100)
+
+
+class SimilarListingsBatch(BaseModel):
+    ids: List[int]
+
+
+def invalidate_listing(listing_id: int) -> None:
+    """ drops the cached responses of a listing after it is written to the db """
+    cache.invalidate(('listing', listing_id))
+    cache.invalidate(('similar', listing_id))
+
+
+Listing.write_listeners.append(invalidate_listing)
+
+
+def json_response(content: Any) -> Response:
+    """ serializes the content of a response once, so it can be cached """
+    return Response(content=json.dumps(jsonable_encoder(content)).encode(), media_type='application/json')
+
+
+@app.on_event("startup")
+def build_similarity_index() -> None:
+    """ builds the ANN index used to match listings without precomputed similar listings """
+    if os.path.exists(pool.db_name):
+        matcher.build_index()
+
+        plan = matcher.explain_filtered_listings()
+        if not any('listing_room_type_log_price' in step for step in plan):
+            print(f'WARNING: the candidate query does not use the listing indexes ({plan}). '
+                  'Migrate the database with `cd src/data/; python database.py`')
+
+
+@app.on_event("shutdown")
+def close_connections() -> None:
+    """ closes all pooled database connections """
+    pool.close()
+    if matcher.db.connection:
+        matcher.db.close()
+
+
+@app.get("/stats/db", status_code=status.HTTP_200_OK)
+async def get_db_stats() -> Dict[str, Any]:
+    """ retrieves database connection pool statistics
+
+    Returns:
+        Dict[str, Any]: pool size, number of active queries and time spent waiting for a connection
+    """
+    return pool.stats()
+
+
+@app.get("/stats/cache", status_code=status.HTTP_200_OK)
+async def get_cache_stats() -> Dict[str, Any]:
+    """ retrieves response cache statistics
+
+    Returns:
+        Dict[str, Any]: hit rate, number of cached responses, evictions and invalidations
+    """
+    return cache.stats()
+
+
+@app.get("/stats/matcher", status_code=status.HTTP_200_OK)
+async def get_matcher_stats() -> Dict[str, Any]:
+    """ retrieves statistics of the candidate queries of the exact matching path
+
+    Returns:
+        Dict[str, Any]: number of queries, mean number of candidates and latency, and those of the last query
+    """
+    return matcher.stats()
+
+
+@app.get("/metrics", status_code=status.HTTP_200_OK)
+def get_metrics() -> Response:
+    """ retrieves the request, database query and listing deserialization metrics 
+        in the Prometheus text format
+
+    Returns:
+        Response: metrics of all routes since the service started
+    """
+    return Response(content=REGISTRY.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def encode_cursor(last_id: int) -> str:
+    """ encodes the id of the last listing of a page as an opaque cursor """
+    return base64.urlsafe_b64encode(f'id:{last_id}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    """ decodes a cursor created by `encode_cursor`
+
+    Raises:
+        ValueError: if the cursor is invalid
+    """
+    try:
+        prefix, last_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f'invalid cursor: {cursor}')
+    if prefix != 'id' or not last_id.isdigit():
+        raise ValueError(f'invalid cursor: {cursor}')
+    return int(last_id)
+
 
 @app.get("/listings", status_code=status.HTTP_200_OK)
 async def get_listings(
+    response: Response,
     skip: Annotated[int, Query(title="Number of listings to skip", ge=0)] = 0, 
-    limit: Annotated[int, Query(title="Number of listings to fetch", ge=1)] = 10
+    limit: Annotated[int, Query(title="Number of listings to fetch", ge=1)] = 10,
+    cursor: Annotated[Union[str, None], Query(title="Cursor of the page to fetch")] = None
 ) -> List[ListingItem]:
-    """ retrieves all listings
+    """ retrieves all listings, ordered by ID. 
+        If the page is full, the cursor of the next page is returned in the `X-Next-Cursor` header.
+        Paging with `cursor` is constant time regardless of depth, unlike `skip`.
 
     Args:
         skip (int, optional): number of listings to skip. Defaults to 0.
         limit (int, optional): number of listings to return. Defaults to 10.
+        cursor (str, optional): `X-Next-Cursor` of the previous page. Defaults to None.
 
     Raises:
         HTTPException: 400 limit must be less than or equal to 100
+        HTTPException: 400 if the cursor is invalid or used together with skip
 
     Returns:
         List[ListingItem]: list of listings
@@ -34,15 +157,56 @@ async def get_listings(
     if limit > 100:
         raise HTTPException(status_code=400, detail="limit must be less than or equal to 100")
 
-    listings = Listing.retrieve_all(skip, limit, db)
+    if cursor is not None:
+        if skip:
+            raise HTTPException(status_code=400, detail="cursor and skip cannot be used together")
+        try:
+            after_id = decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        listings = await pool.run(Listing.retrieve_after, after_id, limit, columns=Listing.ITEM_COLUMNS)
+    else:
+        listings = await pool.run(Listing.retrieve_all, skip, limit, columns=Listing.ITEM_COLUMNS)
+
+    if len(listings) == limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(listings[-1].id)
     return [listing.to_listing_item() for listing in listings]
 
 
+@app.get("/listings/near", status_code=status.HTTP_200_OK)
+async def get_listings_near(
+    lat: Annotated[float, Query(title="Latitude of the location", ge=-90, le=90)],
+    lon: Annotated[float, Query(title="Longitude of the location", ge=-180, le=180)],
+    radius_mi: Annotated[float, Query(title="Radius in miles", gt=0)],
+    limit: Annotated[int, Query(title="Number of listings to fetch", ge=1)] = 10
+) -> List[NearbyListingItem]:
+    """ retrieves the listings within a radius of a location, closest first.
+        Listings are looked up in the spatial index of the listing locations.
+
+    Args:
+        lat (float): latitude of the location
+        lon (float): longitude of the location
+        radius_mi (float): radius in miles
+        limit (int, optional): number of listings to return. Defaults to 10.
+
+    Raises:
+        HTTPException: 400 limit must be less than or equal to 100
+
+    Returns:
+        List[NearbyListingItem]: list of listings with their distance in miles, closest first
+    """
+    if limit > 100:
+        raise HTTPException(status_code=400, detail="limit must be less than or equal to 100")
+
+    listings = await pool.run(Listing.retrieve_near, lat, lon, radius_mi, limit, columns=Listing.ITEM_COLUMNS)
+    return [listing.to_nearby_listing_item() for listing in listings]
+
+
 @app.get("/listings/{listing_id}", status_code=status.HTTP_200_OK)
 async def get_listing(
     listing_id: Annotated[int, Path(title="The ID of the item to get", ge=0)]
 ) -> ListingItem:
-    """ retrieves a listing by ID
+    """ retrieves a listing by ID. Responses are cached (see `ResponseCache`).
 
     Args:
         listing_id (int): ID of the listing to retrieve
@@ -53,19 +217,26 @@ async def get_listing(
     Returns:
         ListingItem: listing item
     """
-    listing = Listing.retrieve_by_id(listing_id, db)
+    cached = cache.get(('listing', listing_id))
+    if cached is not None:
+        return Response(content=cached, media_type='application/json')
+
+    listing = await pool.run(Listing.retrieve_by_id, listing_id, columns=Listing.ITEM_COLUMNS)
 
     if listing is None:
         raise HTTPException(status_code=404, detail="Listing not found")
 
-    return listing.to_listing_item()
+    response = json_response(listing.to_listing_item())
+    cache.put(('listing', listing_id), response.body)
+    return response
 
 
 @app.get("/listings/{listing_id}/similar", status_code=status.HTTP_200_OK)
 async def get_similar_listings(
     listing_id: Annotated[int, Path(title="The ID of the item to get", ge=0)]
-) -> List[ListingItem]:
-    """ retrieves similar listings by ID
+) -> List[SimilarListingItem]:
+    """ retrieves similar listings by ID, with their similarity scores. 
+        Responses are cached (see `ResponseCache`).
 
     Args:
         listing_id (int): ID of the listing to retrieve similar listings for
@@ -74,16 +245,71 @@ async def get_similar_listings(
         HTTPException: 404 if listing not found
 
     Returns:
-        List[ListingItem]: List of similar listings
+        List[SimilarListingItem]: List of similar listings, most similar first
     """
-    listing = Listing.retrieve_by_id(listing_id, db)
+    cached = cache.get(('similar', listing_id))
+    if cached is not None:
+        return Response(content=cached, media_type='application/json')
 
-    if listing is None:
+    similar_listings = await pool.run(Listing.retrieve_similar, listing_id, columns=Listing.ITEM_COLUMNS)
+
+    if similar_listings is None:
+        # listing never matched, match it on demand
+        try:
+            similar_listings = await pool.run(
+                matcher.find_similar_listings, listing_id, columns=Listing.ITEM_COLUMNS, write=True
+            )
+        except ValueError:
+            # listing has no embedding
+            similar_listings = []
+
+    if similar_listings is None:
         raise HTTPException(status_code=404, detail="Listing not found")
 
-    similar_listings = Listing.retrieve_by_ids(listing.properties['similar_listings'], db)
-    
-    return [listing.to_listing_item() for listing in similar_listings]
+    response = json_response([listing.to_similar_listing_item() for listing in similar_listings])
+    cache.put(('similar', listing_id), response.body)
+    return response
+
+
+@app.post("/listings/similar:batch", status_code=status.HTTP_200_OK)
+async def get_similar_listings_batch(
+    batch: SimilarListingsBatch
+) -> Dict[int, List[SimilarListingItem]]:
+    """ retrieves similar listings of many listings at once, with their similarity scores. 
+        Stored similar listings of the whole batch are resolved in two queries.
+
+    Args:
+        batch (SimilarListingsBatch): IDs of the listings to retrieve similar listings for
+
+    Raises:
+        HTTPException: 400 if the batch is larger than MAX_SIMILAR_BATCH_SIZE
+
+    Returns:
+        Dict[int, List[SimilarListingItem]]: similar listings of each found listing, most similar
+            first. Missing IDs are omitted
+    """
+    if len(batch.ids) > MAX_SIMILAR_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f"batch size must be less than or equal to {MAX_SIMILAR_BATCH_SIZE}"
+        )
+
+    ids = list(dict.fromkeys(batch.ids))
+    similar_listings = await pool.run(Listing.retrieve_similar_by_ids, ids, columns=Listing.ITEM_COLUMNS)
+
+    for listing_id, listings in similar_listings.items():
+        if listings is None:
+            try:
+                similar_listings[listing_id] = await pool.run(
+                    matcher.find_similar_listings, listing_id, columns=Listing.ITEM_COLUMNS, write=True
+                )
+            except ValueError:
+                # listing has no embedding
+                similar_listings[listing_id] = []
+
+    return {
+        listing_id: [listing.to_similar_listing_item() for listing in similar_listings[listing_id]]
+        for listing_id in ids if listing_id in similar_listings
+    }
 
 
 if __name__ == "__main__":
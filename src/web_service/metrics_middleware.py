@@ -0,0 +1,54 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import time
+from typing import Callable
+from starlette.routing import Match
+from data.metrics import Counter, Gauge, Histogram
+
+REQUESTS = Counter('http_requests_total', 'Number of HTTP requests by route and status code', ['method', 'route', 'status'])
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Latency of HTTP requests by route', ['method', 'route'])
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'Number of HTTP requests being processed by route', ['method', 'route'])
+
+# route label of requests matching no route, so unknown paths do not create new label values
+UNMATCHED_ROUTE = '<unmatched>'
+
+
+class MetricsMiddleware:
+    """ An ASGI middleware recording the latency, status code and number in flight of the HTTP
+        requests of each route (e.g. `/listings/{listing_id}` rather than the requested path).
+        Metrics are exposed in the Prometheus text format by `REGISTRY.render`.
+    """
+    def __init__(self, app: Callable) -> None:
+        self.app = app
+
+    @staticmethod
+    def route(scope: dict) -> str:
+        """ returns the path template of the route matching a request """
+        for route in scope['app'].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return UNMATCHED_ROUTE
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        labels = (scope['method'], self.route(scope))
+        status = [500]
+
+        async def send_wrapper(message: dict) -> None:
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(labels)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_DURATION.observe(time.perf_counter() - start, labels)
+            REQUESTS_IN_FLIGHT.dec(labels)
+            REQUESTS.inc(labels + (str(status[0]),))
@@ -0,0 +1,89 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import time
+import random
+import asyncio
+import project_config as pc
+from collections import deque
+from typing import Callable
+from data.profiling import sampler, write_folded_stacks
+from web_service.metrics_middleware import MetricsMiddleware
+
+
+class ProfilingMiddleware:
+    """ An ASGI middleware profiling a random fraction of the HTTP requests, and every request
+        slower than a threshold, with the stack sampler (see `StackSampler`). The stacks of all
+        threads of the service while a request was in flight, i.e. including the concurrent
+        requests that may have delayed it, are written to pc.PROFILES_DIR as folded stacks.
+
+        Requests that are not sampled are only recorded once they have run for a fraction of the
+        slow threshold (see `SLOW_START_FRACTION`), so fast requests are not profiled at all and
+        the profile of a slow request covers its end. A request blocking the event loop delays
+        the start of its recording.
+    """
+    # max number of profiles written per minute, so a latency spike does not fill the disk
+    MAX_PROFILES_PER_MINUTE = 12
+    # fraction of the slow threshold after which requests that are not sampled start being recorded
+    SLOW_START_FRACTION = 0.5
+
+    def __init__(
+        self,
+        app: Callable,
+        sample_rate: float=None,
+        slow_ms: float=None
+    ) -> None:
+        """ initializes the middleware
+
+        Args:
+            app (Callable): ASGI app
+            sample_rate (float, optional): fraction of the requests profiled. Defaults to the
+                `PROFILING_SAMPLE_RATE` env var or 0.01.
+            slow_ms (float, optional): requests slower than this are profiled, 0 to only profile sampled
+                requests. Defaults to the `PROFILING_SLOW_MS` env var or 1000.
+        """
+        self.app = app
+        self.sample_rate = sample_rate if sample_rate is not None else float(pc.ENV_VARS.get('PROFILING_SAMPLE_RATE', None) or 0.01)
+        self.slow_ms = slow_ms if slow_ms is not None else float(pc.ENV_VARS.get('PROFILING_SLOW_MS', None) or 1000)
+        self.__written = deque()
+
+    def __can_write(self) -> bool:
+        now = time.monotonic()
+        while self.__written and now - self.__written[0] > 60:
+            self.__written.popleft()
+        if len(self.__written) >= self.MAX_PROFILES_PER_MINUTE:
+            return False
+        self.__written.append(now)
+        return True
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        sampled = random.random() < self.sample_rate
+        if scope['type'] != 'http' or not (sampled or self.slow_ms):
+            await self.app(scope, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        recording_ids = []
+        timer = None
+        if sampled:
+            recording_ids.append(sampler.start())
+        else:
+            # requests still running after part of the threshold are recorded, and kept if slow
+            timer = loop.call_later(
+                self.slow_ms * self.SLOW_START_FRACTION / 1000, lambda: recording_ids.append(sampler.start())
+            )
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            elapsed_ms = 1000 * (time.perf_counter() - start)
+            if timer is not None:
+                timer.cancel()
+            stacks = sampler.stop(recording_ids[0]) if recording_ids else {}
+            if (sampled or elapsed_ms >= self.slow_ms) and stacks and self.__can_write():
+                route = MetricsMiddleware.route(scope)
+                # the response is sent, but the event loop must not wait for the disk
+                await loop.run_in_executor(
+                    None, write_folded_stacks, stacks, f'api-{scope["method"]}-{route}-{elapsed_ms:.0f}ms'
+                )
@@ -0,0 +1,126 @@
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+
+import time
+import threading
+from os import path
+import project_config as pc
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
+
+
+class ResponseCache:
+    """ A bounded, thread-safe LRU cache of serialized responses with a time to live.
+
+        Entries are dropped when they expire, when the cache is full (least recently used first)
+        and on `invalidate`. The whole cache is also cleared when the database file changes on
+        disk, e.g. after the dataset is rebuilt by `make_dataset.py` or updated by `update_dataset.py`
+        (which checkpoints its write-ahead log into the database file).
+    """
+    def __init__(
+        self,
+        max_entries: int=None,
+        ttl: float=None,
+        db_name: str=None,
+        check_interval: float=1.
+    ) -> None:
+        """ initializes an empty cache
+
+        Args:
+            max_entries (int, optional): max number of cached responses. Defaults to the
+                `RESPONSE_CACHE_SIZE` env var or 10000.
+            ttl (float, optional): seconds a response stays valid. Defaults to the
+                `RESPONSE_CACHE_TTL` env var or 300.
+            db_name (str, optional): database watched for rebuilds. Defaults to pc.DATABASE_PATH.
+            check_interval (float, optional): min seconds between two checks of the database
+                file. Defaults to 1.
+        """
+        self.max_entries = max_entries if max_entries else int(pc.ENV_VARS.get('RESPONSE_CACHE_SIZE', None) or 10000)
+        self.ttl = ttl if ttl else float(pc.ENV_VARS.get('RESPONSE_CACHE_TTL', None) or 300)
+        self.db_name = pc.DATABASE_PATH if not db_name else db_name
+        self.check_interval = check_interval
+
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__db_version = self.__read_db_version()
+        self.__last_check = time.monotonic()
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __read_db_version(self) -> Tuple:
+        """ returns an identifier of the current state of the database file. The write-ahead log
+            is not watched: the service's own writes land there and only invalidate their listings
+            (see `Listing.write_listeners`).
+        """
+        if not path.exists(self.db_name):
+            return None
+        stat = os.stat(self.db_name)
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def __check_db_version(self) -> None:
+        """ clears the cache if the database file changed since the last check """
+        now = time.monotonic()
+        if now - self.__last_check < self.check_interval:
+            return
+        self.__last_check = now
+
+        db_version = self.__read_db_version()
+        if db_version != self.__db_version:
+            self.__db_version = db_version
+            self.invalidations += len(self.__entries)
+            self.__entries.clear()
+
+    def get(self, key: Hashable) -> bytes:
+        """ returns the cached response of a key, or None if it is not cached or has expired """
+        with self.__lock:
+            self.__check_db_version()
+            entry = self.__entries.get(key, None)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.__entries[key]
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, response: bytes) -> None:
+        """ caches a response and evicts the least recently used ones if the cache is full """
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.ttl, response)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable=None) -> None:
+        """ drops the cached response of a key, or all cached responses if key is None """
+        with self.__lock:
+            if key is None:
+                self.invalidations += len(self.__entries)
+                self.__entries.clear()
+            elif self.__entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def stats(self) -> Dict:
+        """ returns hit / miss statistics since the cache was created """
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.__entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+            }